@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+LOGGER = logging.getLogger(__name__)
+
+# Start low, GitHub's secondary limits punish bursts of concurrent requests
+AIMD_INITIAL_LIMIT = 8
+AIMD_MIN_LIMIT = 1
+AIMD_MAX_LIMIT = 200
+AIMD_DECREASE_FACTOR = 0.5
+# A latency above this multiple of the best one seen is congestion: stop growing
+AIMD_LATENCY_TOLERANCE = 2.0
+# Weight of the newest latency in the moving average
+AIMD_LATENCY_SMOOTHING = 0.2
+# GitHub asks to wait at least a minute after a secondary limit 403 without Retry-After
+SECONDARY_LIMIT_WAIT_SECS = 60
+SERVER_ERROR_WAIT_SECS = 2
+# Callers on other threads run their own event loops, slots they free are polled for
+SLOT_POLL_SECS = 0.05
+
+
+# Seconds to wait from a Retry-After header, in seconds or as an HTTP date. None if absent.
+def get_retry_after_secs(headers):
+    retry_after = headers.get('Retry-After')
+    if not retry_after:
+        return None
+    if retry_after.strip().isdigit():
+        return int(retry_after)
+    try:
+        return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Additive increase, multiplicative decrease of the requests in flight, like TCP congestion
+# control: the limit grows by one per limit's worth of fast successes, and halves on a
+# 403/429/5xx. Failures of requests sent before the last cut are the same congestion event
+# and don't cut again. Retry-After blocks every request until it has passed.
+# The limit bounds the requests in flight of every caller together, also across threads:
+# callers reserve slots for their requests and release them when the responses are in.
+class AimdConcurrencyController:
+    def __init__(self, initial_limit: int = AIMD_INITIAL_LIMIT, min_limit: int = AIMD_MIN_LIMIT,
+                 max_limit: int = AIMD_MAX_LIMIT):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.min_latency_secs = None
+        self.latency_secs = None
+        self.blocked_until = 0
+        self.last_decrease_at = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_limit(self) -> int:
+        return int(self.limit)
+
+    # Take up to `wanted` of the slots left under the limit, 0 when they are all in use
+    def try_reserve(self, wanted: int) -> int:
+        with self._lock:
+            reserved = max(0, min(wanted, self.get_limit() - self.in_flight))
+            self.in_flight += reserved
+            return reserved
+
+    def release(self, count: int):
+        with self._lock:
+            self.in_flight -= count
+
+    # Wait out any Retry-After, then for at least one free slot
+    async def reserve_async(self, wanted: int) -> int:
+        while True:
+            await self.wait_async()
+            reserved = self.try_reserve(wanted)
+            if reserved:
+                return reserved
+            await asyncio.sleep(SLOT_POLL_SECS)
+
+    def on_success(self, latency_secs: float):
+        with self._lock:
+            if self.min_latency_secs is None or latency_secs < self.min_latency_secs:
+                self.min_latency_secs = latency_secs
+            if self.latency_secs is None:
+                self.latency_secs = latency_secs
+            else:
+                self.latency_secs += AIMD_LATENCY_SMOOTHING * (latency_secs - self.latency_secs)
+            if self.latency_secs <= AIMD_LATENCY_TOLERANCE * self.min_latency_secs:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    # `sent_at` is the epoch the failed request was sent at
+    def on_failure(self, sent_at: float, retry_after_secs: float = None):
+        now = time.time()
+        with self._lock:
+            if sent_at >= self.last_decrease_at:
+                self.limit = max(self.min_limit, self.limit * AIMD_DECREASE_FACTOR)
+                self.last_decrease_at = now
+                LOGGER.info("Backing off to %d concurrent requests", self.get_limit())
+            if retry_after_secs:
+                self.blocked_until = max(self.blocked_until, now + retry_after_secs)
+
+    def get_delay(self) -> float:
+        return max(0, self.blocked_until - time.time())
+
+    async def wait_async(self):
+        delay = self.get_delay()
+        if delay > 0:
+            LOGGER.info("Waiting %.1fs before the next requests", delay)
+            await asyncio.sleep(delay)
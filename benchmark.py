@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import calendar
+import optparse
+import random
+import time
+import tracemalloc
+
+from contr import Contributors, parse_github_dates, SECONDS_PER_DAY
+
+'''
+Micro benchmarks of the hot paths, on synthetic data:
+    python3 benchmark.py [--commits 200000] [--logins 2000] [--years 4] [--pages 2000]
+'''
+COMMITS_PER_PAGE = 100
+# Pages fetched per batch by the synthetic page stream
+PAGES_IN_FLIGHT = 20
+
+
+# The former per-epoch scan over every month range, kept as the reference
+def _bucket_by_month_nested(activity: dict, month_start_epochs: list):
+    contributors = [[] for _ in month_start_epochs[1:]]
+    for (login, days) in activity.items():
+        for epochs in days.values():
+            for epoch in set(epochs):
+                for index, (start, end) in enumerate(zip(month_start_epochs, month_start_epochs[1:])):
+                    if epoch >= start and epoch < end:
+                        contributors[index].append(login)
+    return [list(set(month_of_contributors)) for month_of_contributors in contributors]
+
+
+def _make_commits(commit_count: int, login_count: int, years: int, now: float):
+    random.seed(0)
+    commits = []
+    for _ in range(commit_count):
+        epoch = int(now - random.random() * years * 365 * SECONDS_PER_DAY)
+        commits.append({
+            'author': {'login': 'dev' + str(random.randrange(login_count))},
+            'commit': {'author': {'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))}}
+        })
+    return commits
+
+
+# A commits API item, with the fields that make up most of its size
+def _make_api_commit(login: str, epoch: int):
+    date = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+    sha = '%040x' % random.getrandbits(160)
+    git_user = {'name': login, 'email': login + '@example.com', 'date': date}
+    github_user = {'login': login, 'id': hash(login) & 0xffffff, 'type': 'User', 'site_admin': False,
+                   'url': 'https://api.github.com/users/' + login,
+                   'html_url': 'https://github.com/' + login,
+                   'avatar_url': 'https://avatars.githubusercontent.com/u/1?v=4'}
+    return {
+        'sha': sha,
+        'url': 'https://api.github.com/repos/org/repo/commits/' + sha,
+        'commit': {'author': git_user, 'committer': dict(git_user), 'message': 'Change ' * 20,
+                   'tree': {'sha': sha, 'url': 'https://api.github.com/repos/org/repo/git/trees/' + sha}},
+        'author': github_user,
+        'committer': dict(github_user),
+        'parents': [{'sha': sha, 'url': 'https://api.github.com/repos/org/repo/commits/' + sha}]
+    }
+
+
+def _make_api_page(login_count: int, years: int, now: float):
+    return [_make_api_commit('dev' + str(random.randrange(login_count)),
+                             int(now - random.random() * years * 365 * SECONDS_PER_DAY))
+            for _ in range(COMMITS_PER_PAGE)]
+
+
+# Stand-in for Contributors._iter_commit_pages, fetching batches of PAGES_IN_FLIGHT pages
+async def _iter_api_pages(page_count: int, login_count: int, years: int, now: float):
+    for batch_start in range(0, page_count, PAGES_IN_FLIGHT):
+        batch = [_make_api_page(login_count, years, now)
+                 for _ in range(min(PAGES_IN_FLIGHT, page_count - batch_start))]
+        for index in range(len(batch)):
+            page = batch[index]
+            batch[index] = None
+            yield page
+
+
+async def _fold_accumulated(page_count: int, login_count: int, years: int, now: float):
+    commits = []
+    async for page in _iter_api_pages(page_count, login_count, years, now):
+        commits.extend(page)
+    return Contributors._fold_commits_into_activity({}, commits)
+
+
+async def _fold_streamed(page_count: int, login_count: int, years: int, now: float):
+    activity = {}
+    await Contributors._fold_commit_pages_into_activity(
+        activity, {'last_commit_date': None, 'last_commit_sha': None},
+        _iter_api_pages(page_count, login_count, years, now))
+    return activity
+
+
+# Peak memory while folding, above what the resulting activity keeps
+def _peak_transient_bytes(fold, *args):
+    tracemalloc.start()
+    activity = asyncio.run(fold(*args))
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return activity, peak - current
+
+
+def benchmark_commit_page_folding(page_count: int, login_count: int, years: int):
+    now = time.time()
+    random.seed(0)
+    tracemalloc.start()
+    page = _make_api_page(login_count, years, now)
+    page_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del page
+    print("Folding %d pages of %d commits (%.0f KiB per page)" % (page_count, COMMITS_PER_PAGE, page_bytes / 1024))
+    random.seed(0)
+    (accumulated, accumulated_bytes) = _peak_transient_bytes(_fold_accumulated, page_count, login_count, years, now)
+    random.seed(0)
+    (streamed, streamed_bytes) = _peak_transient_bytes(_fold_streamed, page_count, login_count, years, now)
+    print("  peak transient memory accumulating: %.1f MiB, streaming: %.1f MiB"
+          % (accumulated_bytes / 2 ** 20, streamed_bytes / 2 ** 20))
+    if accumulated != streamed:
+        raise Exception("Folded activity differs")
+    # Streaming holds one batch of pages, with room for the temporaries of the fold
+    ceiling = 2 * PAGES_IN_FLIGHT * page_bytes
+    if streamed_bytes > ceiling:
+        raise Exception("Streaming fold peaked at %d bytes, above the %d bytes of the pages in flight"
+                        % (streamed_bytes, ceiling))
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_month_bucketing(commit_count: int, login_count: int, years: int):
+    now = time.time()
+    commits = _make_commits(commit_count, login_count, years, now)
+    date_strings = [commit['commit']['author']['date'] for commit in commits]
+    print("Parsing %d commit dates" % commit_count)
+    (_, strptime_secs) = _timed(lambda: [calendar.timegm(time.strptime(date_string, '%Y-%m-%dT%H:%M:%SZ'))
+                                         for date_string in date_strings])
+    (_, bulk_secs) = _timed(parse_github_dates, date_strings)
+    print("  strptime per commit: %.3fs, bulk: %.3fs (%.1fx)" % (strptime_secs, bulk_secs, strptime_secs / bulk_secs))
+
+    activity = Contributors._fold_commits_into_activity({}, commits)
+    month_start_epochs = Contributors._get_month_start_epochs(12 * years, now)
+    print("Bucketing activity of %d logins into %d months" % (len(activity), 12 * years))
+    (nested, nested_secs) = _timed(_bucket_by_month_nested, activity, month_start_epochs)
+    (vectorized, vectorized_secs) = _timed(Contributors._get_monthly_contributors_from_activity,
+                                           activity, 12 * years, now)
+    print("  nested scan: %.3fs, searchsorted: %.3fs (%.1fx)"
+          % (nested_secs, vectorized_secs, nested_secs / vectorized_secs))
+    if [sorted(month) for month in nested] != [sorted(month) for month in vectorized]:
+        raise Exception("Month bucketing results differ")
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--commits', dest='commits', type='int', default=200000)
+    parser.add_option('--logins', dest='logins', type='int', default=2000)
+    parser.add_option('--years', dest='years', type='int', default=4)
+    parser.add_option('--pages', dest='pages', type='int', default=2000)
+    (options, _) = parser.parse_args()
+    benchmark_month_bucketing(options.commits, options.logins, options.years)
+    benchmark_commit_page_folding(options.pages, options.logins, options.years)
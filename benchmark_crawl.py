@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import optparse
+import os
+import socket
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from os import path
+
+import config
+from logger import sys
+
+'''
+End-to-end crawl benchmarks of the entry points against github_simulator.py, no tokens or network:
+    python3 benchmark_crawl.py [--entry-points dev,dev_async,contr,commits] [--orgs 2] [--repos-per-org 5]
+        [--commits-per-repo 2000] [--latency-ms 20] [--output ./output/crawl_benchmarks.jsonl]
+Reports requests issued, wall time, requests/sec and peak Python memory of each entry point,
+and appends them to --output, one JSON line per run, to track regressions over time.
+The simulator runs in its own process, so its memory is not counted.
+'''
+ENTRY_POINTS = ('dev', 'dev_async', 'contr', 'commits')
+BENCHMARK_PATS = 'simulated-token-1 simulated-token-2'
+BENCHMARK_CHAIN = 'simulated-chain'
+dir_path = path.dirname(path.realpath(__file__))
+
+
+def _get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _start_simulator(options):
+    process = subprocess.Popen(
+        [sys.executable, path.join(dir_path, 'github_simulator.py'), '--port', str(_get_free_port()),
+         '--orgs', str(options.orgs), '--repos-per-org', str(options.repos_per_org),
+         '--commits-per-repo', str(options.commits_per_repo), '--latency-ms', str(options.latency_ms),
+         '--stats-pending-polls', str(options.stats_pending_polls),
+         '--secondary-limit-concurrency', str(options.secondary_limit_concurrency)],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    # The simulator prints its URL once it listens
+    base_url = process.stdout.readline().strip()
+    if not base_url:
+        process.kill()
+        raise Exception("GitHub simulator failed to start")
+    return process, base_url
+
+
+def _simulator_request(base_url: str, path_and_query: str, method: str = 'GET'):
+    request = urllib.request.Request(base_url + path_and_query, method=method, data=b'' if method == 'POST' else None)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+# Point the scripts at the simulator, with empty caches and sync state for every entry point
+def _configure(base_url: str, work_dir: str):
+    os.environ['GITHUB_PATS'] = BENCHMARK_PATS
+    config.config.read_dict({
+        'github': {'api_url': base_url},
+        'cache': {
+            'http_cache_enabled': 'false',
+            'repo_stats_cache_dir': path.join(work_dir, 'repo_stats'),
+            'org_inventory_cache_dir': path.join(work_dir, 'org_inventory')
+        },
+        'sync': {'state_dir': path.join(work_dir, 'sync_state')}
+    })
+
+
+def _get_orgs(options):
+    # Imported once the API URL is configured
+    from github_simulator import SimulatorConfig, get_org_names
+    return get_org_names(SimulatorConfig(orgs=options.orgs))
+
+
+def _with_fresh_repo_stats_cache(oracle, work_dir: str):
+    from repo_stats_cache import RepoStatsCache
+    oracle.repo_stats_cache = RepoStatsCache(path.join(work_dir, 'repo_stats'), config.get_repo_stats_cache_ttl_secs(),
+                                             config.get_repo_stats_cache_max_bytes())
+    return oracle
+
+
+def run_dev(orgs, work_dir: str, years_count: int):
+    from dev import DevOracle
+    oracle = _with_fresh_repo_stats_cache(DevOracle(work_dir, 4), work_dir)
+    # The chain's TOML lists the simulator's orgs
+    oracle._read_orgs_for_chain_from_toml = lambda chain_name: ['https://github.com/' + org for org in orgs]
+    oracle.get_and_save_full_stats(BENCHMARK_CHAIN, years_count)
+
+
+def run_dev_async(orgs, work_dir: str, years_count: int):
+    from dev_async import AsyncDevOracle
+    oracle = _with_fresh_repo_stats_cache(AsyncDevOracle(work_dir, 4), work_dir)
+    oracle._read_orgs_for_chain_from_toml = lambda chain_name: ['https://github.com/' + org for org in orgs]
+    oracle.get_and_save_full_stats(BENCHMARK_CHAIN, years_count)
+
+
+def run_contr(orgs, work_dir: str, years_count: int):
+    from contr import Contributors
+    contributors = Contributors(work_dir)
+
+    async def get_repos_for_protocol(protocol):
+        return [repo.lower() for org in orgs for repo in contributors.org_inventory.get_unforked_repos(org)]
+    contributors.get_repos_for_protocol_from_toml = get_repos_for_protocol
+    asyncio.run(contributors.get_contr_from_toml('protocols/' + BENCHMARK_CHAIN + '.toml', years_count=years_count))
+
+
+def run_commits(orgs, work_dir: str, years_count: int):
+    from get_contributors import RepoStats
+    repo_stats = RepoStats(None, work_dir)
+    repo_stats._read_repos_for_chain_from_toml = lambda chain: [
+        repo for org in orgs for repo in repo_stats.org_inventory.get_unforked_repos(org)]
+    repo_stats.get_and_save_full_stats(BENCHMARK_CHAIN)
+
+
+RUNNERS = {
+    'dev': run_dev,
+    'dev_async': run_dev_async,
+    'contr': run_contr,
+    'commits': run_commits
+}
+
+
+def benchmark_entry_point(entry_point: str, base_url: str, orgs, work_dir: str, years_count: int):
+    work_dir = path.join(work_dir, entry_point)
+    os.makedirs(work_dir)
+    _configure(base_url, work_dir)
+    _simulator_request(base_url, '/_simulator/reset', 'POST')
+    tracemalloc.start()
+    start = time.perf_counter()
+    RUNNERS[entry_point](orgs, work_dir, years_count)
+    wall_secs = time.perf_counter() - start
+    (_, peak_bytes) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = _simulator_request(base_url, '/_simulator/stats')
+    return {
+        'requests': stats['requests'],
+        'wall_secs': round(wall_secs, 3),
+        'requests_per_sec': round(stats['requests'] / wall_secs, 1),
+        'peak_memory_mib': round(peak_bytes / 2 ** 20, 1),
+        'requests_by_endpoint': stats['requests_by_endpoint'],
+        'accepted_202': stats['responses_by_status'].get('202', 0),
+        'secondary_limited': stats['secondary_limited'],
+        'peak_in_flight': stats['peak_in_flight']
+    }
+
+
+def _get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=dir_path,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--entry-points', dest='entry_points', default=','.join(ENTRY_POINTS),
+                      help='Comma separated, some of: ' + ', '.join(ENTRY_POINTS))
+    parser.add_option('--orgs', dest='orgs', type='int', default=2)
+    parser.add_option('--repos-per-org', dest='repos_per_org', type='int', default=5)
+    parser.add_option('--commits-per-repo', dest='commits_per_repo', type='int', default=2000)
+    parser.add_option('--latency-ms', dest='latency_ms', type='int', default=20)
+    parser.add_option('--stats-pending-polls', dest='stats_pending_polls', type='int', default=1)
+    parser.add_option('--secondary-limit-concurrency', dest='secondary_limit_concurrency', type='int', default=40)
+    parser.add_option('--years', dest='years_count', type='int', default=1)
+    parser.add_option('--output', dest='output', default='./output/crawl_benchmarks.jsonl',
+                      help='JSON lines file the results are appended to')
+    (options, _) = parser.parse_args()
+    entry_points = options.entry_points.split(',')
+    for entry_point in entry_points:
+        if entry_point not in ENTRY_POINTS:
+            print("Entry points must be some of " + ", ".join(ENTRY_POINTS))
+            sys.exit(1)
+
+    (simulator, simulator_url) = _start_simulator(options)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as benchmark_dir:
+            for entry_point in entry_points:
+                print("Benchmarking", entry_point, "against", simulator_url)
+                results[entry_point] = benchmark_entry_point(
+                    entry_point, simulator_url, _get_orgs(options), benchmark_dir, options.years_count)
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+    print("%-10s %9s %9s %9s %12s %6s %6s" % ('entry', 'requests', 'wall s', 'req/s', 'peak MiB', '202s', '403s'))
+    for (entry_point, result) in results.items():
+        print("%-10s %9d %9.2f %9.1f %12.1f %6d %6d" % (
+            entry_point, result['requests'], result['wall_secs'], result['requests_per_sec'],
+            result['peak_memory_mib'], result['accepted_202'], result['secondary_limited']))
+
+    os.makedirs(path.dirname(path.abspath(options.output)), exist_ok=True)
+    with open(options.output, 'a') as output_file:
+        output_file.write(json.dumps({
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'revision': _get_git_revision(),
+            'simulator': {'orgs': options.orgs, 'repos_per_org': options.repos_per_org,
+                          'commits_per_repo': options.commits_per_repo, 'latency_ms': options.latency_ms,
+                          'stats_pending_polls': options.stats_pending_polls,
+                          'secondary_limit_concurrency': options.secondary_limit_concurrency},
+            'results': results
+        }) + '\n')
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import calendar
+import os
+import shutil
+import time
+import zlib
+from os import path
+from typing import List, Dict
+
+import pandas as pd
+
+COMMIT_COLUMNS = ['sha', 'repo_id', 'author_id', 'committer_id', 'authored_at', 'committed_at']
+USER_COLUMNS = ['id', 'login', 'type', 'site_admin', 'name', 'email']
+REPO_COLUMNS = ['repo_id', 'chain', 'org', 'repo']
+PARQUET_COMPRESSION = 'zstd'
+
+
+def _parse_github_date(date_string):
+    return calendar.timegm(time.strptime(date_string, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+# Id and users table record of a commit author/committer. GitHub users keep their
+# GitHub id; authors without a GitHub account get a stable negative id from their email.
+def _get_user_record(github_user, git_user):
+    if github_user:
+        return github_user['id'], {
+            'id': github_user['id'],
+            'login': github_user['login'],
+            'type': github_user.get('type'),
+            'site_admin': github_user.get('site_admin', False),
+            'name': None,
+            'email': None
+        }
+    if git_user:
+        identity = (git_user.get('email') or git_user.get('name') or '').lower()
+        user_id = -(zlib.crc32(identity.encode('utf-8')) or 1)
+        return user_id, {
+            'id': user_id,
+            'login': None,
+            'type': 'Anonymous',
+            'site_admin': False,
+            'name': git_user.get('name'),
+            'email': git_user.get('email')
+        }
+    return None, None
+
+
+# Reduce a commit of the GitHub commits API to a fact table row: ids and epochs only.
+# The users it refers to are added to `users` (id -> record).
+def compact_commit(commit: Dict, users: Dict[int, dict]) -> Dict:
+    (author_id, author) = _get_user_record(commit['author'], commit['commit']['author'])
+    (committer_id, committer) = _get_user_record(commit['committer'], commit['commit']['committer'])
+    for (user_id, user) in ((author_id, author), (committer_id, committer)):
+        if user_id is not None and user_id not in users:
+            users[user_id] = user
+    return {
+        'sha': commit['sha'],
+        'author_id': author_id,
+        'committer_id': committer_id,
+        'authored_at': _parse_github_date(commit['commit']['author']['date']),
+        'committed_at': _parse_github_date(commit['commit']['committer']['date'])
+    }
+
+
+# Normalized commit output of get_contributors.py, as zstd compressed parquet:
+#   users.parquet                                 one row per GitHub id/anonymous author
+#   repos.parquet                                 integer repo ids
+#   commits/chain=<chain>/month=<YYYY-MM>/*.parquet   the commits fact table
+# The hive-style partitions let readers load a chain or a few columns only.
+class CommitStore:
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.commits_dir = path.join(root_dir, 'commits')
+        self.users_path = path.join(root_dir, 'users.parquet')
+        self.repos_path = path.join(root_dir, 'repos.parquet')
+        os.makedirs(self.commits_dir, exist_ok=True)
+
+    def _read_table(self, table_path: str, columns: List[str]):
+        if path.exists(table_path):
+            return pd.read_parquet(table_path)
+        return pd.DataFrame(columns=columns)
+
+    # Stable integer ids, new repos are appended to the repos table
+    def _get_repo_ids(self, chain: str, org_and_repos: List[str]) -> Dict[str, int]:
+        repos = self._read_table(self.repos_path, REPO_COLUMNS)
+        chain_repos = repos[repos['chain'] == chain]
+        repo_ids = {org + '/' + repo: int(repo_id)
+                    for (repo_id, org, repo) in zip(chain_repos['repo_id'], chain_repos['org'], chain_repos['repo'])}
+        next_repo_id = int(repos['repo_id'].max()) + 1 if len(repos) else 1
+        new_repos = []
+        for org_and_repo in org_and_repos:
+            if org_and_repo in repo_ids:
+                continue
+            (org, repo) = org_and_repo.split('/')
+            repo_ids[org_and_repo] = next_repo_id
+            new_repos.append({'repo_id': next_repo_id, 'chain': chain, 'org': org, 'repo': repo})
+            next_repo_id += 1
+        if new_repos:
+            repos = pd.concat([repos, pd.DataFrame(new_repos, columns=REPO_COLUMNS)], ignore_index=True)
+            repos['repo_id'] = repos['repo_id'].astype('int64')
+            repos.to_parquet(self.repos_path, compression=PARQUET_COMPRESSION, index=False)
+        return repo_ids
+
+    def _write_users(self, users: Dict[int, dict]):
+        existing_users = self._read_table(self.users_path, USER_COLUMNS)
+        existing_user_ids = set(existing_users['id'])
+        new_users = pd.DataFrame([user for (user_id, user) in users.items()
+                                  if user_id not in existing_user_ids], columns=USER_COLUMNS)
+        if len(new_users) == 0:
+            return
+        all_users = pd.concat([existing_users, new_users], ignore_index=True)
+        all_users['id'] = all_users['id'].astype('int64')
+        all_users.to_parquet(self.users_path, compression=PARQUET_COMPRESSION, index=False)
+
+    # Replace the commits of a chain. `commits_by_repo` maps org/repo to compact commit rows.
+    def write_chain(self, chain: str, commits_by_repo: Dict[str, List[Dict]], users: Dict[int, dict]):
+        self._write_users(users)
+        repo_ids = self._get_repo_ids(chain, list(commits_by_repo))
+        frames = []
+        for (org_and_repo, commits) in commits_by_repo.items():
+            if not commits:
+                continue
+            frame = pd.DataFrame(commits, columns=[column for column in COMMIT_COLUMNS if column != 'repo_id'])
+            frame['repo_id'] = repo_ids[org_and_repo]
+            frames.append(frame)
+
+        chain_dir = path.join(self.commits_dir, 'chain=' + chain)
+        if path.exists(chain_dir):
+            shutil.rmtree(chain_dir)
+        if not frames:
+            return
+        commits = pd.concat(frames, ignore_index=True)[COMMIT_COLUMNS]
+        # Nullable: commits without any author information
+        for column in ('author_id', 'committer_id'):
+            commits[column] = commits[column].astype('Int64')
+        for column in ('authored_at', 'committed_at'):
+            commits[column] = pd.to_datetime(commits[column], unit='s', utc=True)
+        months = commits['authored_at'].dt.strftime('%Y-%m')
+        for (month, month_commits) in commits.groupby(months):
+            month_dir = path.join(chain_dir, 'month=' + month)
+            os.makedirs(month_dir, exist_ok=True)
+            month_commits.to_parquet(path.join(month_dir, 'commits.parquet'),
+                                     compression=PARQUET_COMPRESSION, index=False)
+
+    def get_chains(self) -> List[str]:
+        return sorted(name.split('=', 1)[1] for name in os.listdir(self.commits_dir) if name.startswith('chain='))
+
+    # Commits of one or all chains, only the given columns are read from disk
+    def read_commits(self, chain: str = None, columns: List[str] = None) -> pd.DataFrame:
+        commits_path = path.join(self.commits_dir, 'chain=' + chain) if chain else self.commits_dir
+        if not path.exists(commits_path):
+            return pd.DataFrame(columns=columns or COMMIT_COLUMNS)
+        return pd.read_parquet(commits_path, columns=columns)
+
+    def read_users(self, columns: List[str] = None) -> pd.DataFrame:
+        if not path.exists(self.users_path):
+            return pd.DataFrame(columns=columns or USER_COLUMNS)
+        return pd.read_parquet(self.users_path, columns=columns)
+
+    def read_repos(self) -> pd.DataFrame:
+        return self._read_table(self.repos_path, REPO_COLUMNS)
@@ -1,47 +1,38 @@
-import csv
 import os
 
 import pandas as pd
 
+from query_store import DevQueryStore
+
 
 def compute_all():
-    dir = os.path.abspath('./output')
-    files = os.listdir(dir)
+    store = DevQueryStore(os.path.abspath('./output'))
+    store.build()
 
     # date_range = pd.date_range(start='2017-01-01', end='2021-12-22', freq='M', tz='UTC',
     #                            name='index')
     # pd.DataFrame(date_range).set_index('index')
 
-    for file in files:
-       compute_for_protocol(file)
-
-
-def compute_for_protocol(file):
-    df = pd.read_csv(file)
-        # names=[
-        #     'chain', 'org', 'repo', 'contributor_login', 'contributor_id', 'start_date', 'additions',
-        #     'deletions', 'commits'])
-    df['start_date'] = pd.to_datetime(df['start_date'])
-    date_range = pd.date_range(start=df['start_date'].min(), end=df['start_date'].max(), freq='M')
+    for chain in store.chains():
+       compute_for_protocol(store, chain)
 
-    active = df[df['commits'] > 0]
-    active_contributors_month = active.groupby(pd.Grouper(key='start_date', freq='M')).count()[
-        ['contributor_login']]
-    active_contributors_month['chain'] = df['org'][0]
 
-    active.groupby('contributor_login').sum()[['commits']].sort_values(by='commits',
-                                                                       ascending=False)[:10]
+def compute_for_protocol(store: DevQueryStore, chain: str):
+    # Distinct authors per month, answered from the store's (chain, day) index
+    active_contributors_month = pd.DataFrame(store.active_devs(chain, granularity='month'),
+                                             columns=['month', 'active_contributors']).set_index('month')
+    active_contributors_month['chain'] = chain
     return active_contributors_month
 
 
 def aggregate_protocols():
-    dir = os.path.abspath('./output')
-    files = os.listdir(dir)
+    store = DevQueryStore(os.path.abspath('./output'))
+    store.build()
     dfs = []
-    for file in files:
-       dfs.append(pd.read_csv(file))
+    for chain in store.chains():
+       dfs.append(compute_for_protocol(store, chain))
     df = pd.concat(dfs)
-    df.to_csv(dir + '/all_contributors.csv')
+    df.to_csv(store.output_dir + '/all_contributors.csv')
 
 if __name__ == '__main__':
-    compute_all()
\ No newline at end of file
+    compute_all()
@@ -27,5 +27,85 @@ def remove_chain_from_config(chain):
     config['chains']['targets'] = ', '.join(chains_targets_arr)
 
 
+def get_github_api_url():
+    return config.get('github', 'api_url', fallback='https://api.github.com').rstrip('/')
+
+
 def get_pats():
     return os.getenv('GITHUB_PATS').split(" ")
+
+
+def is_http_cache_enabled():
+    return config.getboolean('cache', 'http_cache_enabled', fallback=True)
+
+
+def get_http_cache_dir():
+    return config.get('cache', 'http_cache_dir', fallback='./cache/http')
+
+
+def get_http_cache_max_bytes():
+    return config.getint('cache', 'http_cache_max_mb', fallback=512) * 1024 * 1024
+
+
+def get_http_cache_max_age_secs():
+    return config.getint('cache', 'http_cache_max_age_days', fallback=30) * 24 * 60 * 60
+
+
+def get_repo_stats_cache_dir():
+    return config.get('cache', 'repo_stats_cache_dir', fallback='./cache/repo_stats')
+
+
+def get_repo_stats_cache_ttl_secs():
+    return config.getint('cache', 'repo_stats_ttl_hours', fallback=24) * 60 * 60
+
+
+def get_repo_stats_cache_max_bytes():
+    return config.getint('cache', 'repo_stats_max_mb', fallback=256) * 1024 * 1024
+
+
+def get_org_inventory_cache_dir():
+    return config.get('cache', 'org_inventory_cache_dir', fallback='./cache/org_inventory')
+
+
+def get_org_inventory_ttl_secs():
+    return config.getint('cache', 'org_inventory_ttl_hours', fallback=24) * 60 * 60
+
+
+def is_request_metrics_enabled():
+    return config.getboolean('metrics', 'request_metrics_enabled', fallback=True)
+
+
+def get_request_metrics_dir():
+    return config.get('metrics', 'request_metrics_dir', fallback='./output/metrics')
+
+
+def get_sync_state_dir():
+    return config.get('sync', 'state_dir', fallback='./output/sync_state')
+
+
+def get_sync_lookback_days():
+    return config.getint('sync', 'lookback_days', fallback=7)
+
+
+def get_git_cache_dir():
+    return config.get('git', 'cache_dir', fallback='./cache/git')
+
+
+def get_git_clone_url_template():
+    return config.get('git', 'clone_url_template', fallback='https://github.com/{repo}.git')
+
+
+def get_log_file():
+    return config.get('logging', 'log_file', fallback='logfile.log')
+
+
+def get_log_level():
+    return config.get('logging', 'log_level', fallback='INFO').upper()
+
+
+def get_log_max_bytes():
+    return config.getint('logging', 'log_max_mb', fallback=10) * 1024 * 1024
+
+
+def get_log_backup_count():
+    return config.getint('logging', 'log_backup_count', fallback=5)
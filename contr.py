@@ -3,73 +3,128 @@
 import asyncio
 import datetime as dt
 import json
+import logging
+import optparse
 import time
-from os import path, remove
-import re
+from os import path
 from logger import sys
 from asyncio import get_event_loop, ensure_future
-import requests
+import numpy as np
 import toml
 from aiohttp import ClientSession
-from gitTokenHelper import GithubPersonalAccessTokenHelper
-from config import get_pats
+from aimd import AimdConcurrencyController, get_retry_after_secs, SECONDARY_LIMIT_WAIT_SECS, SERVER_ERROR_WAIT_SECS
+from github_http import github_get_async, get_last_page_from_link_header, GITHUB_API_URL
+from gitTokenHelper import GithubTokenPool
+from org_inventory import OrgInventory
+from config import get_pats, get_sync_state_dir, get_sync_lookback_days, get_git_cache_dir, get_git_clone_url_template
+from git_engine import GitCloneEngine
+from progress_journal import ContributorsJournal
+from request_metrics import install_request_metrics, set_request_chain
+from stage_profiler import enable_stage_profiling, profile_stage
+from sync_state import SyncStateStore
+
+LOGGER = logging.getLogger(__name__)
 
 dir_path = path.dirname(path.realpath(__file__))
 
-
-async def get_commits(session, pat, org_then_slash_then_repo, page):
-    async with session.get(url='https://api.github.com/repos/' + org_then_slash_then_repo + '/commits?page='
-                               + str(page) + '&per_page=100',
-                           headers={'Authorization': 'Token ' + pat}) as r:
-        if r.status == 200:
-            data = await r.json()
-            rate_limit_remaining = int(r.headers['X-RateLimit-Remaining'])
-            total_pages = None
-            if "link" in r.headers:
-                pages_link = r.headers['link']
-                last_page_link = pages_link.split(",")[1]
-                re_match = re.search(
-                    'page=(.*)&per_page=100>; rel="last"', last_page_link)
-                if re_match:
-                    total_pages = int(re_match.group(1))
-            return {
-                "error": None,
-                "error_code": None,
-                "data": data,
-                "total_pages": total_pages,
-                "rate_limit_remaining": rate_limit_remaining
-            }
-        err_message = await r.text()
+SECONDS_PER_DAY = 24 * 60 * 60
+# contr.py accepts up to 4 years, keep a bit more activity than that
+ACTIVITY_RETENTION_DAYS = 5 * 366
+MONTH_DAYS = 30
+
+
+# Epochs of GitHub's 'YYYY-MM-DDTHH:MM:SSZ' dates, parsed in one numpy call
+def parse_github_dates(date_strings: list):
+    # datetime64 parses naive ISO-8601, the dates are all UTC
+    return np.array([date_string[:19] for date_string in date_strings],
+                    dtype='datetime64[s]').astype(np.int64)
+
+
+# Month index of each epoch by binary search over the sorted month starts, with months
+# being [month_start_epochs[i], month_start_epochs[i + 1]). Returns, per month, the
+# distinct logins with an epoch in it. `login_indices` index `logins`, one per epoch.
+def bucket_logins_by_month(logins: list, login_indices, epochs, month_start_epochs: list):
+    month_count = len(month_start_epochs) - 1
+    if not logins:
+        return [[] for _ in range(month_count)]
+    months = np.searchsorted(np.asarray(month_start_epochs), epochs, side='right') - 1
+    in_range = (months >= 0) & (months < month_count)
+    # One key per (month, login) pair, so duplicates collapse in a single unique()
+    keys = np.unique(months[in_range] * len(logins) + np.asarray(login_indices)[in_range])
+    contributors = [[] for _ in range(month_count)]
+    for (month, login_index) in zip(*np.divmod(keys, len(logins))):
+        contributors[month].append(logins[login_index])
+    return contributors
+
+
+async def get_commits(session, pat, org_then_slash_then_repo, page, since=None):
+    url = GITHUB_API_URL + '/repos/' + org_then_slash_then_repo + '/commits?page=' + str(page) + '&per_page=100'
+    if since:
+        url += '&since=' + since
+    sent_at = time.time()
+    r = await github_get_async(session, url, pat)
+    if r.status == 200:
+        data = r.json()
+        rate_limit_remaining = int(r.headers['X-RateLimit-Remaining'])
+        total_pages = None
+        if "link" in r.headers:
+            total_pages = get_last_page_from_link_header(r.headers['link'])
         return {
-            "error": "{0} {1}".format(r.reason, err_message),
-            "error_code": r.status
+            "error": None,
+            "error_code": None,
+            # Token that sent the request, the current one may have been switched since
+            "pat": pat,
+            "data": data,
+            "total_pages": total_pages,
+            "rate_limit_remaining": rate_limit_remaining,
+            "sent_at": sent_at,
+            "latency_secs": time.time() - sent_at
         }
+    return {
+        "error": "{0} {1}".format(r.reason, r.text),
+        "error_code": r.status,
+        "pat": pat,
+        "sent_at": sent_at,
+        "retry_after_secs": get_retry_after_secs(r.headers),
+        # The hourly limit of the token, as opposed to a secondary (abuse) limit
+        "rate_limit_exhausted": r.headers.get('X-RateLimit-Remaining') == '0',
+        "rate_limit_reset": int(r.headers.get('X-RateLimit-Reset', 0)) or None
+    }
 
 
 # Python client only allows the first 100 contributors to be returned, so use vanilla HTTP to get contributors
 class Contributors:
-    def __init__(self, save_path: str):
+    def __init__(self, save_path: str, incremental: bool = True, token_pool: GithubTokenPool = None,
+                 source: str = 'api'):
         self.save_path = save_path
-        # TODO: fix this to be an array
-        self.gh_pat_helper = GithubPersonalAccessTokenHelper(get_pats())
-        self.pat = self._get_access_token()
-
-    def _get_access_token(self):
-        res = self.gh_pat_helper.get_access_token()
-        if "token" in res and res["token"] is not None:
-            return res["token"]
-        print('Going to sleep since no token exists with usable rate limit')
-        time.sleep(res["sleep_time_secs"])
-        return self._get_access_token()
+        self.token_pool = token_pool or GithubTokenPool(get_pats())
+        self.pat = self.token_pool.acquire()
+        # Per-repo watermarks and activity aggregates, None to always crawl everything
+        self.sync_state = SyncStateStore(get_sync_state_dir(), get_sync_lookback_days()) if incremental else None
+        # Local clones are fetched incrementally by git itself, contributors are then author emails
+        self.git_engine = GitCloneEngine(get_git_cache_dir(), get_git_clone_url_template(), blobless=True) \
+            if source == 'git' else None
+        self.org_inventory = OrgInventory(self.token_pool)
+        # Commit pages in flight, shared by all repos: the secondary limits are per account.
+        # The orchestrator hands every worker's Contributors the same controller.
+        self.concurrency = AimdConcurrencyController()
+
+    # Hand back the current token and lease the one with the most budget left.
+    # Waits for the earliest reset when every token is exhausted, without blocking the event loop.
+    async def _switch_access_token(self):
+        self.token_pool.release(self.pat)
+        self.pat = await self.token_pool.acquire_async(avoid=self.pat)
+        return self.pat
 
     # list all the repos of a protocol from toml
     # Includes all the core github org/user repos and the repo urls listed in toml
     # Ensure protocol is same as name of toml file
+    @profile_stage
     async def get_repos_for_protocol_from_toml(self, protocol):
         repos = set()
         toml_file_path = path.join(dir_path, 'protocols', protocol + '.toml')
         if not path.exists(toml_file_path):
-            print(".toml file not found for %s in /protocols folder" % protocol)
+            LOGGER.error(".toml file not found for %s in /protocols folder", protocol)
             sys.exit(1)
         try:
             with open(toml_file_path, 'r') as f:
@@ -77,349 +132,278 @@ class Contributors:
             github_orgs = toml.loads(data)['github_organizations']
             repos_in_toml = toml.loads(data)['repo']
         except:
-            print('Could not open toml file - check formatting!!')
+            LOGGER.error('Could not open toml file - check formatting!!')
             sys.exit(1)
 
         for org in github_orgs:
             if not org.lower().startswith("https://github.com/"):
                 continue
             org_name = org.split('https://github.com/')[1]
-            try:
-                # Get all repos
-                all_org_repos = []
-                page = 1
-                url = f"https://api.github.com/orgs/{org_name}/repos?page={page}&per_page=100"
-                response = requests.get(
-                    url, headers={'Authorization': 'Token ' + self.pat})
-                while len(response.json()) > 0:
-                    for repo in response.json():
-                        all_org_repos.append(repo["full_name"])
-                    page += 1
-                    url = f"https://api.github.com/orgs/{org_name}/repos?page={page}&per_page=100"
-                    response = requests.get(
-                        url, headers={'Authorization': 'Token ' + self.pat})
-                # Get forked repos
-                forked_org_repos = []
-                page = 1
-                url = f"https://api.github.com/orgs/{org_name}/repos?type=forks&page={page}&per_page=100"
-                response = requests.get(
-                    url, headers={'Authorization': 'Token ' + self.pat})
-                while len(response.json()) > 0:
-                    for repo in response.json():
-                        forked_org_repos.append(repo["full_name"])
-                    page += 1
-                    url = f"https://api.github.com/orgs/{org_name}/repos?type=forks&page={page}&per_page=100"
-                    response = requests.get(
-                        url, headers={'Authorization': 'Token ' + self.pat})
-                # Find difference
-                unforked_repos = list(
-                    set(all_org_repos) - set(forked_org_repos))
-                for repo in unforked_repos:
-                    repos.add(repo.lower())
-            except:
-                # Core org is not org but a user
-                # Get repos of user
-                url = f"https://api.github.com/users/{org_name}/repos"
-                response = requests.get(
-                    url, headers={'Authorization': 'Token ' + self.pat})
-                for repo in response.json():
-                    repos.add(repo["full_name"].lower())
+            for repo in self.org_inventory.get_unforked_repos(org_name):
+                repos.add(repo.lower())
         return list(repos)
 
-    async def get_contributors_of_repo_in_last_n_years(self, org_then_slash_then_repo: str, n_years: int = 1):
+    # Retryable failure of a commit page request: switch tokens when the hourly limit of the
+    # token that sent it is used up, otherwise back off the concurrency (secondary limit, 5xx).
+    # Returns False for errors a retry won't fix.
+    async def _handle_failed_commits_request(self, response):
+        if response["error_code"] in (403, 429) and response["rate_limit_exhausted"]:
+            LOGGER.warning("Hourly rate limit exceeded for current token")
+            self.token_pool.mark_rate_limited(response["pat"], response["rate_limit_reset"])
+            # Other failed responses of the same batch don't switch away from the new token
+            if self.pat == response["pat"]:
+                await self._switch_access_token()
+            return True
+        if response["error_code"] in (403, 429):
+            LOGGER.warning("Secondary rate limit trigger detected")
+            self.concurrency.on_failure(response["sent_at"],
+                                        response["retry_after_secs"] or SECONDARY_LIMIT_WAIT_SECS)
+            return True
+        # Get 502 some times
+        if response["error_code"] // 100 == 5:
+            self.concurrency.on_failure(response["sent_at"],
+                                        response["retry_after_secs"] or SERVER_ERROR_WAIT_SECS)
+            return True
+        return False
+
+    # Stream the commit pages of a repo, all of them or only the ones since an ISO date.
+    # Pages are yielded as their batch arrives, so callers can reduce each page and drop it:
+    # at most one batch of pages is held at a time. Yields nothing if the repo doesn't exist.
+    # Batches are sized by the AIMD controller, failed pages are retried in a later batch.
+    async def _iter_commit_pages(self, org_then_slash_then_repo: str, since: str = None):
         # Commits are not chronological, so need to pull all and filter
-        commits = []
-
         async with ClientSession() as session:
-            initial_request = await get_commits(session, self.pat, org_then_slash_then_repo, page=1)
+            while True:
+                await self.concurrency.reserve_async(1)
+                try:
+                    initial_request = await get_commits(
+                        session, self.pat, org_then_slash_then_repo, page=1, since=since)
+                finally:
+                    self.concurrency.release(1)
+                if not (initial_request["error"] and (await self._handle_failed_commits_request(initial_request))):
+                    break
             # Repo doesn't exist
-            if initial_request["error"] or (type(initial_request["data"]) == dict and initial_request["data"].message == 'Not Found'):
-                return []
+            if initial_request["error"] or (type(initial_request["data"]) == dict and initial_request["data"].get('message') == 'Not Found'):
+                return
             if isinstance(initial_request["data"], list) and len(initial_request["data"]) == 0:
-                return []
-            commits.extend(initial_request["data"])
-
+                return
+            self.concurrency.on_success(initial_request["latency_secs"])
             rate_limit_remaining = initial_request["rate_limit_remaining"]
-            remaining_requests_to_be_made = 0
-            if initial_request["total_pages"]:
-                remaining_requests_to_be_made = initial_request["total_pages"] - 1
-
-            # starting page
-            batch_start = 2
-            while remaining_requests_to_be_made > 0:
-                if remaining_requests_to_be_made > min(rate_limit_remaining, 200):
-                    batch_end = batch_start + min(rate_limit_remaining, 200)
-                else:
-                    batch_end = batch_start + remaining_requests_to_be_made
-
-                print("Start", batch_start, "End", batch_end)
-
-                # get data for page from batch_start to batch_end
-                tasks = []
-                for page in range(batch_start, batch_end + 1):
-                    task = ensure_future(
-                        get_commits(
-                            session, self.pat, org_then_slash_then_repo, page)
-                    )
-                    tasks.append(task)
-
-                responses = await asyncio.gather(*tasks)
-                if len(responses) == 0:
-                    sys.exit(1)
-
-                successful_responses_count = 0
-                rate_limit_exceeded = False
-                for response in responses:
+            # Pages left to fetch, in order
+            pages = list(range(2, (initial_request["total_pages"] or 1) + 1))
+            first_page = initial_request["data"]
+            initial_request = None
+            yield first_page
+            first_page = None
+
+            while pages:
+                # Slots are shared with the other repos in flight, also on other threads
+                batch_size = await self.concurrency.reserve_async(max(1, min(rate_limit_remaining, len(pages))))
+                batch_pages = pages[:batch_size]
+                LOGGER.info("Pages %d to %d of %s", batch_pages[0], batch_pages[-1], org_then_slash_then_repo)
+
+                # get data for the pages of the batch
+                try:
+                    tasks = []
+                    for page in batch_pages:
+                        task = ensure_future(
+                            get_commits(
+                                session, self.pat, org_then_slash_then_repo, page, since=since)
+                        )
+                        tasks.append(task)
+
+                    responses = await asyncio.gather(*tasks)
+                finally:
+                    self.concurrency.release(batch_size)
+
+                failed_pages = []
+                batch_rate_limit_remaining = None
+                for (index, (page, response)) in enumerate(zip(batch_pages, responses)):
                     if response["error"]:
-                        # Get 502 some times
-                        if response["error_code"] == 403 or response["error_code"] // 100 == 5:
-                            print("Rate limit trigger detected")
-                            rate_limit_exceeded = True
-                            break
+                        if await self._handle_failed_commits_request(response):
+                            failed_pages.append(page)
+                            continue
                         # Printing unhandled error and exiting
-                        print(response)
+                        LOGGER.error(response)
                         sys.exit(1)
 
                     if not isinstance(response["data"], list):
-                        print(response["error"])
+                        LOGGER.error(response["error"])
                         sys.exit(1)
-                    successful_responses_count += 1
-                    commits.extend(response["data"])
-
-                if rate_limit_exceeded:
-                    print("Hourly rate limit exceeded for current token")
-                    self._get_access_token()
+                    self.concurrency.on_success(response["latency_secs"])
+                    # Responses of one batch arrive in any order, the lowest budget is the latest
+                    if batch_rate_limit_remaining is None or response["rate_limit_remaining"] < batch_rate_limit_remaining:
+                        batch_rate_limit_remaining = response["rate_limit_remaining"]
+                    # Let the page go once the caller has folded it
+                    responses[index] = None
+                    yield response["data"]
+
+                LOGGER.info("Successful reqs: %d", len(batch_pages) - len(failed_pages))
+                pages = failed_pages + pages[batch_size:]
+                if failed_pages:
+                    # Budget of the token now in use is unknown until its next response
+                    rate_limit_remaining = len(pages)
+                elif batch_rate_limit_remaining is not None:
+                    rate_limit_remaining = batch_rate_limit_remaining
+
+    # Fold commits into the per-repo activity aggregate:
+    # {login: {'YYYY-MM-DD': [first commit epoch, last commit epoch]}}
+    # Keeping the first and last commit of a day is enough to place a login in
+    # any bucket of a day or longer, and merging the same commit twice is a no-op.
+    @staticmethod
+    def _fold_commits_into_activity(activity: dict, commits: list):
+        # Can be null (user not logged in)
+        authored = [item for item in commits if item['author']]
+        date_strings = [item['commit']['author']['date'] for item in authored]
+        for (item, date_string, epoch) in zip(authored, date_strings, parse_github_dates(date_strings).tolist()):
+            days = activity.setdefault(item['author']['login'], {})
+            day = date_string[:10]
+            if day in days:
+                days[day] = [min(days[day][0], epoch), max(days[day][1], epoch)]
+            else:
+                days[day] = [epoch, epoch]
+        return activity
+
+    @staticmethod
+    def _prune_activity(activity: dict):
+        oldest_day = (dt.datetime.utcnow() - dt.timedelta(days=ACTIVITY_RETENTION_DAYS)).strftime('%Y-%m-%d')
+        for login in list(activity):
+            days = {day: epochs for (day, epochs) in activity[login].items() if day >= oldest_day}
+            if days:
+                activity[login] = days
+            else:
+                del activity[login]
+        return activity
+
+    # Activity aggregate of a repo. With incremental sync only the commits since the
+    # stored watermark are fetched and merged into the stored aggregate.
+    @profile_stage
+    async def _get_activity_of_repo(self, org_then_slash_then_repo: str):
+        if self.git_engine:
+            since_epoch = int(time.time()) - ACTIVITY_RETENTION_DAYS * SECONDS_PER_DAY
+            return await asyncio.get_event_loop().run_in_executor(
+                None, self.git_engine.get_activity, org_then_slash_then_repo, since_epoch)
+        if self.sync_state:
+            state = self.sync_state.load(org_then_slash_then_repo, 'activity')
+            since = self.sync_state.get_since(state)
+        else:
+            state = {'last_commit_date': None, 'last_commit_sha': None, 'aggregate': None}
+            since = None
+        if since:
+            LOGGER.info("Fetching commits of %s since %s", org_then_slash_then_repo, since)
+        activity = state['aggregate'] or {}
+        try:
+            page_count = await self._fold_commit_pages_into_activity(
+                activity, state, self._iter_commit_pages(org_then_slash_then_repo, since))
+        except Exception as e:
+            LOGGER.error('Failed to get contributors for %s: %s', org_then_slash_then_repo, e)
+            sys.exit(1)
+        if not page_count:
+            return activity
+        self._prune_activity(activity)
+        if self.sync_state:
+            state['aggregate'] = activity
+            self.sync_state.save(org_then_slash_then_repo, 'activity', state)
+        return activity
+
+    # Fold each commit page into the activity and the watermark as it arrives, so memory is
+    # bounded by the pages in flight rather than by the history of the repo. Returns the page count.
+    @staticmethod
+    async def _fold_commit_pages_into_activity(activity: dict, state: dict, pages):
+        page_count = 0
+        async for page in pages:
+            Contributors._fold_commits_into_activity(activity, page)
+            SyncStateStore.advance(state, page)
+            page_count += 1
+        return page_count
 
-                print("Successful reqs: ", successful_responses_count)
-                remaining_requests_to_be_made -= successful_responses_count
-                rate_limit_remaining -= successful_responses_count
-                batch_start += successful_responses_count
+    async def get_contributors_of_repo_in_last_n_years(self, org_then_slash_then_repo: str, n_years: int = 1):
+        activity = await self._get_activity_of_repo(org_then_slash_then_repo)
 
         days_count = 365 * n_years  # TODO: Adjust for leap years
         # Remove older commits
-        year_ago_date = dt.datetime.now() - dt.timedelta(days=days_count)
+        year_ago_epoch = time.time() - days_count * SECONDS_PER_DAY
         contributors = []
-        for item in commits:
-            try:
-                date_string = item['commit']['author']['date']
-                date = dt.datetime.strptime(date_string, '%Y-%m-%dT%H:%M:%SZ')
-                if date > year_ago_date:
-                    if item['author']:  # Can be null (user not logged in)
-                        # GitHub username
-                        contributors.append(item['author']['login'])
-            except Exception as e:
-                print(e)
-                sys.exit(1)
-        # De-duplicate commiters
-        deduplicated_contributors = list(set(contributors))
-        return deduplicated_contributors
+        for (login, days) in activity.items():
+            if any(last_epoch > year_ago_epoch for (_, last_epoch) in days.values()):
+                # GitHub username
+                contributors.append(login)
+        return contributors
 
     async def get_monthly_contributors_of_repo_in_last_n_years(self, org_then_slash_then_repo: str, n_years: int = 1):
-        # Commits are not chronological, so need to pull all and filter
-        commits = []
-
-        month_count_plus_one = 12 * n_years + 1
-        # create empty 2D list of (12 * n_years) empty list elements)
-        # explicity append rather than []*12 as this uses same memory ref, thus append to one element means append to all
-        contributors = []
-        for i in range(1, month_count_plus_one):
-            contributors.append([])
+        activity = await self._get_activity_of_repo(org_then_slash_then_repo)
+        return self._get_monthly_contributors_from_activity(activity, 12 * n_years)
 
-        async with ClientSession() as session:
-            initial_request = await get_commits(session, self.pat, org_then_slash_then_repo, page=1)
-            # Repo doesn't exist
-            if initial_request["error"] or (type(initial_request["data"]) == dict and initial_request["data"].message == 'Not Found'):
-                return contributors
-            if isinstance(initial_request["data"], list) and len(initial_request["data"]) == 0:
-                return contributors
-            commits.extend(initial_request["data"])
-
-            rate_limit_remaining = initial_request["rate_limit_remaining"]
-            remaining_requests_to_be_made = 0
-            if initial_request["total_pages"]:
-                remaining_requests_to_be_made = initial_request["total_pages"] - 1
-
-            # starting page
-            batch_start = 2
-            while remaining_requests_to_be_made > 0:
-                if remaining_requests_to_be_made > min(rate_limit_remaining, 200):
-                    batch_end = batch_start + min(rate_limit_remaining, 200)
-                else:
-                    batch_end = batch_start + remaining_requests_to_be_made
-
-                print("Start", batch_start, "End", batch_end)
-
-                # get data for page from batch_start to batch_end
-                tasks = []
-                for page in range(batch_start, batch_end + 1):
-                    task = ensure_future(
-                        get_commits(
-                            session, self.pat, org_then_slash_then_repo, page)
-                    )
-                    tasks.append(task)
-
-                responses = await asyncio.gather(*tasks)
-                if len(responses) == 0:
-                    sys.exit(1)
-
-                successful_responses_count = 0
-                rate_limit_exceeded = False
-                for response in responses:
-                    if response["error"]:
-                        # Get 502 some times
-                        if response["error_code"] == 403 or response["error_code"] // 100 == 5:
-                            print("Rate limit trigger detected")
-                            rate_limit_exceeded = True
-                            break
-                        # Printing unhandled error and exiting
-                        print(response)
-                        sys.exit(1)
-
-                    if not isinstance(response["data"], list):
-                        print(response["error"])
-                        sys.exit(1)
-                    successful_responses_count += 1
-                    commits.extend(response["data"])
-
-                if rate_limit_exceeded:
-                    print("Hourly rate limit exceeded for current token")
-                    self._get_access_token()
-
-                print("Successful reqs: ", successful_responses_count)
-                remaining_requests_to_be_made -= successful_responses_count
-                rate_limit_remaining -= successful_responses_count
-                batch_start += successful_responses_count
-
-        # If wanting to create a record of every repo's commits, uncomment this
-        # with open(org_then_slash_then_repo + '_commits.json', 'w+') as outfile:
-        #    json.dump(commits, outfile)
-        # Remove older commits
+    # (12 * n_years) 'months' of 30 days ending now, 12 'months' is 360 days
+    @staticmethod
+    def _get_month_start_epochs(month_count: int, now: float = None):
+        now = time.time() if now is None else now
         # Include final end date for later use
-        month_start_dates = [dt.datetime.now()]
-        # Generate (12 * n_years) months of start dates
-        for month in range(1, month_count_plus_one):
-            # 12 'months' is 360 days
-            month_start_dates.append(
-                month_start_dates[-1] - dt.timedelta(days=30))
-        month_start_dates.reverse()
-        for item in commits:
-            try:
-                date_string = item['commit']['author']['date']
-                date = dt.datetime.strptime(date_string, '%Y-%m-%dT%H:%M:%SZ')
-                # FIXME find a more efficient way to do this
-                for index, (start, end) in enumerate(zip(month_start_dates, month_start_dates[1:])):
-                    # Can be null (user not logged in)
-                    if date >= start and date < end and item['author']:
-                        contributors[index].append(item['author']['login'])
-            except Exception as e:
-                print('Failed to get monthly contributors for ' +
-                      org_then_slash_then_repo)
-                print(e)
-                sys.exit(1)
-        # De-duplicate commiters
-        for index, month_of_contributors in enumerate(contributors):
-            deduplicated_contributors = list(set(month_of_contributors))
-            contributors[index] = deduplicated_contributors
-        return contributors
-
+        return [now - (month_count - month) * MONTH_DAYS * SECONDS_PER_DAY for month in range(month_count + 1)]
+
+    @staticmethod
+    @profile_stage
+    def _get_monthly_contributors_from_activity(activity: dict, month_count: int, now: float = None):
+        logins = list(activity)
+        login_indices = []
+        epochs = []
+        for (login_index, days) in enumerate(activity.values()):
+            for day_epochs in days.values():
+                epochs.extend(day_epochs)
+                login_indices.extend((login_index, login_index))
+        return bucket_logins_by_month(logins, np.array(login_indices, dtype=np.int64),
+                                      np.array(epochs, dtype=np.int64),
+                                      Contributors._get_month_start_epochs(month_count, now))
+
+    @profile_stage
     async def get_contr_from_toml(self, toml_file: str, monthly: bool = True, years_count: int = 1):
         toml_file_without_protocols = toml_file.split('protocols/')[1]
         protocol_name = toml_file_without_protocols.split('.toml')[0]
-        out_file_name = toml_file_without_protocols.replace(
-            '.toml', '_contributors.json')
-        out_file_name_with_path = self.save_path + '/' + out_file_name
-        # Useful if left running e.g. over weekend - if failed, re-run INCLUDING last repo listed
-        progress_file_name = toml_file.replace('.toml', '_repos_seen.txt')
-
-        month_count_plus_one = 12 * years_count + 1
-        # create empty 2D list of (12 * years_count) empty list elements)
-        # explicity append rather than []*12 as this uses same memory ref, thus append to one element means append to all
-        list_2d = []
-        for i in range(1, month_count_plus_one):
-            list_2d.append([])
-
-        stats = None
-        seen_repos = []
-        if path.exists(out_file_name_with_path):
-            with open(out_file_name_with_path, 'r') as stats_json:
-                stats = json.load(stats_json)
-            if not stats == list_2d:
-                if path.exists(progress_file_name):
-                    progress_file = open(progress_file_name, 'r')
-                    progress_repos_list = progress_file.readlines()
-                    for (_, repo_name_with_line_term) in enumerate(progress_repos_list):
-                        repo_name = repo_name_with_line_term.split("\n")[0]
-                        seen_repos.append(repo_name)
-            elif path.exists(progress_file_name):
-                remove(progress_file_name)
-
-        if stats:
-            core_array = stats
-        elif monthly:
-            # Explicity def, see above
-            # TODO: change this length to make it configurable
-            core_array = list_2d
-        else:
-            # yearly
-            core_array = []
-
-        with open(out_file_name_with_path, 'w') as outfile:
-            json.dump(core_array, outfile)
+        set_request_chain(protocol_name)
+        journal = self._get_contributors_journal(protocol_name, monthly, years_count)
 
         repos = await self.get_repos_for_protocol_from_toml(protocol_name)
         unseen_repo = []
         for repo in repos:
-            if repo in seen_repos:
-                print("Ignoring seen repo: ", repo)
+            if repo in journal.seen_repos:
+                LOGGER.info("Ignoring seen repo: %s", repo)
                 continue
             unseen_repo.append(repo)
 
         # Don't thread this - API limit
         for repo in unseen_repo:
-            print("Analysing repo: ", repo)
+            LOGGER.info("Analysing repo: %s", repo)
             if monthly:
                 contributors = await self.get_monthly_contributors_of_repo_in_last_n_years(repo, n_years=years_count)
             else:
                 contributors = await self.get_contributors_of_repo_in_last_n_years(repo, n_years=years_count)
             # Save progress in case of failure
             try:
-                with open(out_file_name_with_path) as json_file:
-                    data = json.load(json_file)
-                if monthly:
-                    # FIXME efficiency, note np.concatenate on axis 1 doesn't play well with our core array
-                    for index, item in enumerate(data):
-                        item.extend(contributors[index])
-                else:
-                    data.extend(contributors)
-                with open(progress_file_name, 'a') as progress_file:
-                    progress_file.write(repo + '\n')
-                with open(out_file_name_with_path, 'w') as outfile:
-                    json.dump(data, outfile)
+                journal.record(repo, contributors)
             except Exception as e:
-                print(
-                    'Failed to collate monthly contributors for all repos in toml file')
-                print(e)
+                LOGGER.error('Failed to collate monthly contributors for all repos in toml file: %s', e)
                 sys.exit(1)
-        try:
-            with open(out_file_name_with_path) as json_file:
-                data = json.load(json_file)
-        except Exception as e:
-            print(e)
-            sys.exit(1)
+        return self._save_contributors_from_journal(protocol_name, journal)
+
+    # Useful if left running e.g. over weekend - if failed, re-run to continue after the last journaled repo
+    def _get_contributors_journal(self, protocol_name: str, monthly: bool = True, years_count: int = 1):
+        # TODO: change the month count to make it configurable
+        return ContributorsJournal(self.save_path + '/' + protocol_name + '_contributors.journal',
+                                   12 * years_count if monthly else None)
+
+    # Compact the journal and write the deduplicated contributors to `<protocol>_contributors.json`
+    @profile_stage
+    def _save_contributors_from_journal(self, protocol_name: str, journal: ContributorsJournal):
+        monthly = journal.month_count is not None
+        journal.compact()
+        deduplicated_contributors = journal.get_contributors()
         if monthly:
-            print('Monthly active developers in the past year:')
-            for index, month_of_contributors in enumerate(data):
-                deduplicated_monthly_contributors = list(
-                    set(month_of_contributors))
-                data[index] = deduplicated_monthly_contributors
-                print('Month ' + str(index + 1) + ': ' +
-                      str(len(deduplicated_monthly_contributors)))
-            deduplicated_contributors = data
+            LOGGER.info('Monthly active developers in the past year:')
+            for index, month_of_contributors in enumerate(deduplicated_contributors):
+                LOGGER.info('Month %d: %d', index + 1, len(month_of_contributors))
         else:
-            deduplicated_contributors = list(set(data))
-            print('Total active developers in the past year: ' +
-                  str(len(deduplicated_contributors)))
-        with open(out_file_name_with_path, 'w') as outfile:
+            LOGGER.info('Total active developers in the past year: %d', len(deduplicated_contributors))
+        with open(self.save_path + '/' + protocol_name + '_contributors.json', 'w') as outfile:
             json.dump(deduplicated_contributors, outfile)
         return deduplicated_contributors
 
@@ -428,20 +412,31 @@ class Contributors:
 # Write to file every n repos + repos viewed to not lose progress
 
 if __name__ == '__main__':
-    if not (len(sys.argv) == 2 or len(sys.argv) == 3):
+    p = optparse.OptionParser(usage='python3 contr.py [INPUTFILE.TOML] [YEARS_COUNT]')
+    p.add_option('--source', type='choice', dest='source', choices=['api', 'git'], default='api',
+                 help='git: read commit authors from local clones instead of the API')
+    p.add_option('--profile', action='store_true', dest='profile', default=False,
+                 help='Print the wall time, CPU time and memory of each stage on exit')
+    p.add_option('--profile-dir', dest='profile_dir',
+                 help='With --profile, also write a cProfile and the top allocation sites of each stage here')
+    options, arguments = p.parse_args()
+    if not (len(arguments) == 1 or len(arguments) == 2):
         print('Usage: python3 contr.py [INPUTFILE.TOML] [YEARS_COUNT]')
         sys.exit(1)
+    install_request_metrics('contr')
+    if options.profile:
+        enable_stage_profiling(options.profile_dir)
     loop = get_event_loop()
     try:
-        if len(sys.argv) == 3 and sys.argv[2] and int(sys.argv[2]) > 0 and int(sys.argv[2]) < 5:
-            years_count = int(sys.argv[2])
-        elif len(sys.argv) == 2:
+        if len(arguments) == 2 and arguments[1] and int(arguments[1]) > 0 and int(arguments[1]) < 5:
+            years_count = int(arguments[1])
+        else:
             years_count = 1
     except:
         years_count = 1
     try:
-        c = Contributors('./output')
+        c = Contributors('./output', source=options.source)
         loop.run_until_complete(c.get_contr_from_toml(
-            sys.argv[1], years_count=years_count))
+            arguments[0], years_count=years_count))
     finally:
         loop.close()
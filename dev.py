@@ -1,11 +1,10 @@
 import json
+import logging
 import multiprocessing
-import os
-import re
 from typing import List, Dict
 
 from logger import sys
-import time
+from bisect import bisect_right
 from collections import Counter
 from itertools import zip_longest
 from os import path
@@ -13,42 +12,51 @@ import optparse
 import toml
 from github import Github
 from joblib import Parallel, delayed
-from gitTokenHelper import GithubPersonalAccessTokenHelper
-from config import get_pats, remove_chain_from_config
-import requests
+from gitTokenHelper import GithubTokenPool
+from config import get_pats, remove_chain_from_config, get_git_cache_dir, get_git_clone_url_template
+from git_engine import GitCloneEngine
+from github_http import github_get, get_last_page_from_link_header, GITHUB_API_URL
+from github_graphql import fetch_repo_metadata
+from hll import HyperLogLog
+from org_inventory import OrgInventory
+from repo_stats_cache import get_repo_stats_cache
+from request_metrics import install_request_metrics, set_request_chain
+from stats_queue import DeferredStatsQueue
+from stage_profiler import enable_stage_profiling, profile_stage
 import datetime
 
+LOGGER = logging.getLogger(__name__)
+
 dir_path = path.dirname(path.realpath(__file__))
 
+WEEKS_PER_YEAR = 52
+GITHUB_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S%zZ'
+# `weekly` pages every week window separately, `single-pass` pages the whole range once
+COMMIT_CRAWL_MODES = ('single-pass', 'weekly')
+# `graphql` fetches stars, forks, releases and weekly commits of many repos per query
+REPO_METADATA_BACKENDS = ('rest', 'graphql')
+# `git` derives churn, commits and contributors from local clones instead of the API
+REPO_DATA_SOURCES = ('api', 'git')
+
 
 def element_wise_addition_lists(list1, list2):
     return [sum(x) for x in zip_longest(list1, list2, fillvalue=0)]
 
 
-def get_single_repo_stats_json_file_path(org_then_slash_then_repo):
-    return os.path.abspath("./output/" + org_then_slash_then_repo.split("/")[1] + "_single_repo_stats.json")
-
-
 def get_commits(pat, org_then_slash_then_repo, page=1, year_count=1, date_since=None, date_until=None):
-    url = 'https://api.github.com/repos/' + org_then_slash_then_repo + \
+    url = GITHUB_API_URL + '/repos/' + org_then_slash_then_repo + \
         '/commits?page=' + str(page) + '&per_page=100'
     if date_since:
         url += '&since=' + date_since
     if date_until:
         url += '&until=' + date_until
-    r = requests.get(url=url,
-                     headers={'Authorization': 'Token ' + pat})
+    r = github_get(url, pat)
     if r.status_code == 200:
         data = r.json()
         rate_limit_remaining = int(r.headers['X-RateLimit-Remaining'])
         total_pages = None
         if "link" in r.headers:
-            pages_link = r.headers['link']
-            last_page_link = pages_link.split(",")[1]
-            re_match = re.search(
-                'page=(.*)&per_page=100>; rel="last"', last_page_link)
-            if re_match:
-                total_pages = int(re_match.group(1))
+            total_pages = get_last_page_from_link_header(r.headers['link'])
         return {
             "error": None,
             "error_code": None,
@@ -65,8 +73,9 @@ def get_commits(pat, org_then_slash_then_repo, page=1, year_count=1, date_since=
 '''
 FLOW
 __main__ -> get_and_save_full_stats -> _read_orgs_for_chain_from_toml -> for each org:
-    _get_repo_data_for_org -> _make_org_repo_list and for each repo of org:
+    _get_repo_data_for_org -> _get_unforked_repos_for_org and for each repo of org:
         _get_single_repo_data
+_save_chain_stats -> for each org:
     _get_stats_for_org_from_repo_data -> for repo data of each repo of org:
         _analyse_repo_data_for_churn_and_commits_4w
     _get_historical_progress -> for repo data of each repo of org:
@@ -76,52 +85,97 @@ __main__ -> get_and_save_full_stats -> _read_orgs_for_chain_from_toml -> for eac
 
 
 class DevOracle:
-    def __init__(self, save_path: str, frequency):
+    def __init__(self, save_path: str, frequency, commit_crawl: str = 'single-pass', backend: str = 'rest',
+                 token_pool: GithubTokenPool = None, source: str = 'api'):
+        if commit_crawl not in COMMIT_CRAWL_MODES:
+            raise Exception("commit_crawl must be one of " + ", ".join(COMMIT_CRAWL_MODES))
+        if backend not in REPO_METADATA_BACKENDS:
+            raise Exception("backend must be one of " + ", ".join(REPO_METADATA_BACKENDS))
+        if source not in REPO_DATA_SOURCES:
+            raise Exception("source must be one of " + ", ".join(REPO_DATA_SOURCES))
         self.save_path = save_path
-        self.gh_pat_helper = GithubPersonalAccessTokenHelper(get_pats())
-        self.PAT = self._get_access_token()
-        self.gh = Github(self.PAT)
+        self.token_pool = token_pool or GithubTokenPool(get_pats())
+        self.PAT = self.token_pool.acquire()
+        self.gh = Github(self.PAT, base_url=GITHUB_API_URL)
         # churn, commit frequency
         self.frequency = frequency
-
-    def _get_access_token(self):
-        res = self.gh_pat_helper.get_access_token()
-        if "token" in res and res["token"] is not None:
-            return res["token"]
-        print('Going to sleep since no token exists with usable rate limit')
-        time.sleep(res["sleep_time_secs"])
-        return self._get_access_token()
-
+        self.commit_crawl = commit_crawl
+        self.backend = backend
+        # org/repo -> repo_data fields prefetched in GraphQL batches
+        self.prefetched_repo_metadata = {}
+        self.source = source
+        self.git_engine = GitCloneEngine(get_git_cache_dir(), get_git_clone_url_template()) \
+            if source == 'git' else None
+        self.repo_stats_cache = get_repo_stats_cache()
+        self.org_inventory = OrgInventory(self.token_pool)
+        # Code frequency and contributor statistics, requested for a whole org up front
+        self.stats_queue = DeferredStatsQueue(self.token_pool)
+        # Fetches the background refreshes of stale cache entries, with its own token
+        self.revalidation_oracle = None
+
+    # Hand back the current token and lease the one with the most budget left.
+    # Blocks until the earliest reset when every token is exhausted.
+    def _switch_access_token(self):
+        self.token_pool.release(self.PAT)
+        self.PAT = self.token_pool.acquire(avoid=self.PAT)
+        self.gh = Github(self.PAT, base_url=GITHUB_API_URL)
+        return self.PAT
+
+    @profile_stage
     def get_and_save_full_stats(self, chain_name: str, year_count):
+        set_request_chain(chain_name)
         github_orgs = self._read_orgs_for_chain_from_toml(chain_name)
 
-        stats_counter = Counter()
-        hist_data = None
-
+        orgs = []
+        org_repo_data_lists = []
         for org_url in github_orgs:
             if not org_url.startswith("https://github.com/"):
                 # TODO: If Gitlab repo then use Gitlab APIs
-                print("%s is not a github repo...Skipping" % org_url)
+                LOGGER.warning("%s is not a github repo...Skipping", org_url)
                 continue
             org = org_url.split("https://github.com/")[1]
-            print("Fetching repo data for", org)
-            org_repo_data_list = self._get_repo_data_for_org(org, year_count)
-            print("Fetching stats(stargazers, forks, releases, churn_4w) for", org_url)
+            LOGGER.info("Fetching repo data for %s", org)
+            orgs.append(org)
+            org_repo_data_lists.append(self._get_repo_data_for_org(org, year_count))
+
+        self._save_chain_stats(chain_name, orgs, org_repo_data_lists)
+
+    # Stats, history and contributor sketches of a chain from the repo data of each of its orgs
+    @profile_stage
+    def _save_chain_stats(self, chain_name: str, orgs: List[str], org_repo_data_lists: List[List[Dict]]):
+        stats_counter = Counter()
+        hist_data = None
+        contributor_sketches = {}
+        for (org, org_repo_data_list) in zip(orgs, org_repo_data_lists):
+            LOGGER.info("Fetching stats(stargazers, forks, releases, churn_4w) for %s", org)
             stats_counter += self._get_stats_for_org_from_repo_data(
                 org_repo_data_list)
             hist_data_for_org = self._get_historical_progress(
                 org_repo_data_list)
-            print("Combining hist data ...")
+            LOGGER.info("Combining hist data ...")
             hist_data = self._combine_hist_data(hist_data, hist_data_for_org)
+            self._merge_contributor_sketches(contributor_sketches, org_repo_data_list)
 
+        self._save_full_stats(chain_name, stats_counter, hist_data, contributor_sketches)
+        self.repo_stats_cache.wait()
+
+    # `contributor_sketches` are the merged sketches of all repos of the chain, see _merge_contributor_sketches
+    @profile_stage
+    def _save_full_stats(self, chain_name: str, stats_counter: Counter, hist_data, contributor_sketches: Dict = None):
         if hist_data == None or stats_counter == {}:
             remove_chain_from_config(chain_name)
-            print('No data found for organisation in toml file')
+            LOGGER.error('No data found for organisation in toml file')
             sys.exit(1)
 
         path_prefix = self.save_path + '/' + chain_name
+        stats = dict(stats_counter)
+        if contributor_sketches:
+            # Distinct across all repos and orgs of the chain, not a sum over orgs
+            stats['contributors'] = contributor_sketches['all'].count()
+            with open(path_prefix + '_contributor_sketches.json', 'w') as outfile:
+                outfile.write(json.dumps({key: sketch.to_string() for (key, sketch) in contributor_sketches.items()}))
         with open(path_prefix + '_stats.json', 'w') as outfile:
-            outfile.write(json.dumps(dict(stats_counter)))
+            outfile.write(json.dumps(stats))
         with open(path_prefix + '_history.json', 'w') as outfile:
             outfile.write(json.dumps(dict(hist_data)))
 
@@ -130,121 +184,233 @@ class DevOracle:
     def _read_orgs_for_chain_from_toml(self, chain_name):
         toml_file_path = path.join(dir_path, 'protocols', chain_name + '.toml')
         if not path.exists(toml_file_path):
-            print(".toml file not found for %s in /protocols folder" % chain_name)
+            LOGGER.error(".toml file not found for %s in /protocols folder", chain_name)
             sys.exit(1)
         try:
             with open(toml_file_path, 'r') as f:
                 data = f.read()
-            print("Fetching organizations for %s from toml file ..." % chain_name)
+            LOGGER.info("Fetching organizations for %s from toml file ...", chain_name)
             github_orgs = toml.loads(data)['github_organizations']
             return github_orgs
         except:
-            print('Could not open toml file - check formatting.')
+            LOGGER.error('Could not open toml file - check formatting.')
             sys.exit(1)
 
     # get the data for all the repos of a github organization
+    @profile_stage
     def _get_repo_data_for_org(self, org_name: str, year_count=1):
-        org_repos = self._make_org_repo_list(org_name)
-        forked_repos = []
-        page = 1
-        url = f"https://api.github.com/orgs/{org_name}/repos?type=forks&page={page}&per_page=100"
-        response = requests.get(
-            url, headers={'Authorization': 'Token ' + self.PAT})
-        while len(response.json()) > 0:
-            for repo in response.json():
-                forked_repos.append(repo["full_name"])
-            page += 1
-            url = f"https://api.github.com/orgs/{org_name}/repos?type=forks&page={page}&per_page=100"
-            response = requests.get(
-                url, headers={'Authorization': 'Token ' + self.PAT})
-        unforked_repos = list(set(org_repos) - set(forked_repos))
+        unforked_repos = self._get_unforked_repos_for_org(org_name)
+        if self.backend == 'graphql':
+            self._prefetch_repo_metadata(unforked_repos, year_count)
         # GitHub API can hit spam limit
         # number_of_hyperthreads = multiprocessing.cpu_count()
         number_of_hyperthreads = 1
         n_jobs = 2 if number_of_hyperthreads > 2 else number_of_hyperthreads
-        print("Fetching single repo data ...")
-        repo_data_list = Parallel(n_jobs=n_jobs)(delayed(
-            self._get_single_repo_data)(repo, year_count) for repo in unforked_repos)
-        return repo_data_list
-
-    # given the org_name, return list of organisation repos
-    def _make_org_repo_list(self, org_name: str):
-        org_repos = []
-        try:
-            entity = self.gh.get_organization(org_name)
-        except:
-            entity = self.gh.get_user(org_name)
-        for repo in entity.get_repos():
-            org_repos.append(repo.name)
-        org_repos = [org_name + '/{0}'.format(repo) for repo in org_repos]
-        return org_repos
-
+        LOGGER.info("Fetching single repo data ...")
+        # Each repo is fetched as soon as it is ready, the queue polls the cold ones in between
+        repos_by_readiness = []
+
+        def _iter_repo_fetches():
+            for repo in self._iter_repos_by_stats_readiness(unforked_repos, year_count):
+                repos_by_readiness.append(repo)
+                yield delayed(self._get_single_repo_data)(repo, year_count)
+        repo_data_list = Parallel(n_jobs=n_jobs)(_iter_repo_fetches())
+        # Back in listing order
+        repo_data_by_repo = dict(zip(repos_by_readiness, repo_data_list))
+        return [repo_data_by_repo[repo] for repo in unforked_repos]
+
+    # Cached repos first, then the others as GitHub gets done computing their statistics
+    def _iter_repos_by_stats_readiness(self, org_then_slash_then_repos: List[str], year_count: int = 1):
+        if self.git_engine:
+            yield from org_then_slash_then_repos
+            return
+        uncached_repos = [repo for repo in org_then_slash_then_repos if not self.repo_stats_cache.has(repo, year_count)]
+        yield from [repo for repo in org_then_slash_then_repos if repo not in uncached_repos]
+        yield from self.stats_queue.iter_ready(uncached_repos)
+
+    # org/repo names of the repos of an org that are not forks
+    def _get_unforked_repos_for_org(self, org_name: str):
+        return self.org_inventory.get_unforked_repos(org_name)
+
+    # Batch fetch stars, forks, releases and weekly commits of the repos not cached on disk yet
+    def _prefetch_repo_metadata(self, org_then_slash_then_repos: List[str], year_count: int = 1):
+        repos_to_fetch = [repo for repo in org_then_slash_then_repos
+                          if not self.repo_stats_cache.has(repo, year_count)]
+        if not repos_to_fetch:
+            return
+        LOGGER.info("Fetching metadata of %d repos with GraphQL ...", len(repos_to_fetch))
+        # Oldest week first, the layout of _get_weekly_commits
+        week_windows = self._get_week_windows(year_count)[::-1]
+        self.prefetched_repo_metadata.update(
+            fetch_repo_metadata(self.PAT, repos_to_fetch, week_windows))
+
+    @profile_stage
     def _get_single_repo_data(self, org_then_slash_then_repo: str, year_count: int = 1):
         try:
-            out_file_name_with_path = get_single_repo_stats_json_file_path(
-                org_then_slash_then_repo)
-            if path.exists(out_file_name_with_path):
-                with open(out_file_name_with_path, 'r') as single_repo_data_json:
-                    return json.load(single_repo_data_json)
-
-            repo_data = self._get_single_repo_data_from_api(
-                org_then_slash_then_repo, year_count)
-            with open(out_file_name_with_path, 'w') as single_repo_data_json:
-                single_repo_data_json.write(json.dumps(dict(repo_data)))
+            (repo_data, fresh) = self.repo_stats_cache.get(org_then_slash_then_repo, year_count)
+            if repo_data is not None:
+                if not fresh:
+                    self.repo_stats_cache.revalidate(
+                        org_then_slash_then_repo, year_count, self._get_revalidation_oracle()._fetch_single_repo_data)
+                return repo_data
+
+            repo_data = self._fetch_single_repo_data(org_then_slash_then_repo, year_count)
+            self.repo_stats_cache.put(org_then_slash_then_repo, year_count, dict(repo_data))
             return repo_data
         except Exception as e:
-            print(f"Exception occured while fetching single repo data {e}")
+            LOGGER.error("Exception occured while fetching single repo data %s", e)
             sys.exit(1)
 
+    def _fetch_single_repo_data(self, org_then_slash_then_repo: str, year_count: int = 1):
+        if self.git_engine:
+            return self._get_single_repo_data_from_git(org_then_slash_then_repo, year_count)
+        return self._get_single_repo_data_from_api(org_then_slash_then_repo, year_count)
+
+    def _get_revalidation_oracle(self):
+        if self.revalidation_oracle is None:
+            self.revalidation_oracle = DevOracle(self.save_path, self.frequency, self.commit_crawl,
+                                                 token_pool=self.token_pool, source=self.source)
+        return self.revalidation_oracle
+
     # get repo data using a repo URL in the form of `org/repo`
     def _get_single_repo_data_from_api(self, org_then_slash_then_repo: str, year_count: int = 1):
-        print('Fetching repo data for ', org_then_slash_then_repo)
+        LOGGER.info('Fetching repo data for %s', org_then_slash_then_repo)
+        prefetched = self.prefetched_repo_metadata.pop(org_then_slash_then_repo, None)
+        # 'YYYY-MM' -> authors of the commits crawled for the weekly counts, none when prefetched
+        monthly_sketches = {}
         try:
-            repo = self.gh.get_repo(org_then_slash_then_repo)
-            weekly_add_del = repo.get_stats_code_frequency()
-            weekly_commits = self._get_weekly_commits(
-                self.PAT, org_then_slash_then_repo, year_count)
+            # Prefetched metadata only leaves the statistics endpoints, which need no repo lookup
+            repo = None if prefetched else self.gh.get_repo(org_then_slash_then_repo)
+            if prefetched:
+                weekly_commits = prefetched['weekly_commits']
+            elif self.commit_crawl == 'single-pass':
+                weekly_commits = self._get_weekly_commits_single_pass(
+                    self.PAT, org_then_slash_then_repo, year_count, monthly_sketches)
+            else:
+                weekly_commits = self._get_weekly_commits(
+                    self.PAT, org_then_slash_then_repo, year_count, monthly_sketches)
+            # Ready unless the repo skipped the queue, e.g. a background revalidation
+            weekly_add_del = self._format_weekly_add_del(
+                self.stats_queue.get(org_then_slash_then_repo, 'code_frequency'))
             # TODO: Remove contributor specific code
-            weekly_add_del = [{
-                'start_date': datetime.datetime.fromtimestamp(code_freq_obj._rawData[0]).strftime(
-                    '%Y-%m-%dT%H:%M:%S%zZ'),
-                "additions": code_freq_obj._rawData[1],
-                "deletions": code_freq_obj._rawData[2]} for code_freq_obj in weekly_add_del]
-            contributors = [
-                contributor.author.login for contributor in repo.get_stats_contributors()]
+            contributors = [contributor['author']['login'] for contributor
+                            in self.stats_queue.get(org_then_slash_then_repo, 'contributors')
+                            if contributor.get('author')]
             return {
                 "name": org_then_slash_then_repo,
-                "repo": {
+                "repo": prefetched["repo"] if prefetched else {
                     "stargazers_count": repo.stargazers_count,
                     "forks_count": repo.forks_count
                 },
                 "weekly_add_del": weekly_add_del,
                 "weekly_commits": weekly_commits,
                 "contributors": contributors,
-                "releases": repo.get_releases().totalCount
+                "contributor_sketches": self._encode_contributor_sketches(contributors, monthly_sketches),
+                "releases": prefetched["releases"] if prefetched else repo.get_releases().totalCount
             }
         except Exception as e:
-            if e.status == 403:
-                print("Token rate limit reached, switching tokens")
-                PAT = self._get_access_token()
-                self.gh = Github(PAT)
-                return self._get_single_repo_data(org_then_slash_then_repo, year_count)
+            if getattr(e, 'status', None) == 403:
+                LOGGER.warning("Token rate limit reached, switching tokens")
+                self._switch_access_token()
+                if prefetched:
+                    self.prefetched_repo_metadata[org_then_slash_then_repo] = prefetched
+                return self._get_single_repo_data_from_api(org_then_slash_then_repo, year_count)
             raise e
 
-    def _get_weekly_commits(self, pat, org_then_slash_then_repo, year_count) -> List[Dict]:
-        weekly_commits = []
-        date_until = datetime.datetime.now()
-        WEEKS_PER_YEAR = 52
+    # repo_data from a local clone. Contributors are author emails, and git knows
+    # nothing of stars and forks; tags stand in for releases.
+    def _get_single_repo_data_from_git(self, org_then_slash_then_repo: str, year_count: int = 1):
+        LOGGER.info('Reading git history of %s', org_then_slash_then_repo)
+        week_windows = self._get_week_windows(year_count, datetime.datetime.utcnow())[::-1]
+        repo_stats = self.git_engine.get_repo_stats(org_then_slash_then_repo, week_windows)
+        if repo_stats is None:
+            raise Exception(f"Could not clone {org_then_slash_then_repo}")
+        return {
+            "name": org_then_slash_then_repo,
+            "repo": {
+                "stargazers_count": 0,
+                "forks_count": 0
+            },
+            "weekly_add_del": self._format_weekly_add_del(repo_stats["code_frequency"]),
+            "weekly_commits": self._format_weekly_commits(week_windows, repo_stats["weekly_commit_counts"]),
+            "contributors": repo_stats["authors"],
+            "contributor_sketches": self._encode_contributor_sketches(
+                repo_stats["authors"], repo_stats["monthly_author_sketches"]),
+            "releases": repo_stats["tags"]
+        }
 
+    # Sketches stored with the repo data: 'YYYY-MM' the authors of a month, 'all' those of every
+    # month together with the contributors, which the statistics endpoint caps at the top 100
+    @staticmethod
+    def _encode_contributor_sketches(contributors: List[str], monthly_sketches: Dict[str, HyperLogLog]) -> Dict[str, str]:
+        all_sketch = HyperLogLog().update(contributors or [])
+        sketches = {}
+        for (month, sketch) in monthly_sketches.items():
+            all_sketch.merge(sketch)
+            sketches[month] = sketch.to_string()
+        sketches['all'] = all_sketch.to_string()
+        return sketches
+
+    # Add the authors of a page of commits to the sketches of the months they were authored in.
+    # Authors are logins, or emails for commits not linked to a GitHub user.
+    @staticmethod
+    def _add_commits_to_monthly_sketches(monthly_sketches: Dict[str, HyperLogLog], commits: List[Dict]):
+        for commit in commits:
+            git_author = commit['commit']['author']
+            if not git_author:
+                continue
+            identity = commit['author']['login'] if commit['author'] else (git_author.get('email') or '').lower()
+            if not identity:
+                continue
+            month = git_author['date'][:7]
+            monthly_sketches.setdefault(month, HyperLogLog()).add(identity)
+
+    # Merge the sketches of an org's repos into the chain's. Repo data cached before
+    # sketches were stored only gets an 'all' sketch of its contributors.
+    @staticmethod
+    def _merge_contributor_sketches(contributor_sketches: Dict[str, HyperLogLog], org_repo_data_list: List[Dict]):
+        for repo_data in org_repo_data_list:
+            repo_sketches = repo_data.get("contributor_sketches") or \
+                DevOracle._encode_contributor_sketches(repo_data["contributors"], {})
+            for (key, encoded) in repo_sketches.items():
+                sketch = HyperLogLog.from_string(encoded)
+                if key in contributor_sketches:
+                    contributor_sketches[key].merge(sketch)
+                else:
+                    contributor_sketches[key] = sketch
+        return contributor_sketches
+
+    # [<Week In UNIX Timestamp>, <additions>, <deletions with neg symbol>] weeks of the code frequency stats
+    @staticmethod
+    def _format_weekly_add_del(code_frequency: List[list]) -> List[Dict]:
+        return [{
+            'start_date': datetime.datetime.fromtimestamp(week[0]).strftime(GITHUB_DATE_FORMAT),
+            "additions": week[1],
+            "deletions": week[2]} for week in code_frequency]
+
+    # (date_since, date_until) of every week window, latest week first
+    @staticmethod
+    def _get_week_windows(year_count, date_until=None) -> List[tuple]:
+        windows = []
+        date_until = date_until or datetime.datetime.now()
         for week in range(1, WEEKS_PER_YEAR * year_count):
-            curr_week_commits_count = 0
-            page = 1
-
             # Set date since to one week from date until
             date_since = date_until - datetime.timedelta(days=6)
+            windows.append((date_since, date_until))
+            # Set date_until to a day before the last computed week date
+            date_until = date_until - datetime.timedelta(days=7)
+        return windows
 
-            date_since_formatted = date_since.strftime('%Y-%m-%dT%H:%M:%S%zZ')
-            date_until_formatted = date_until.strftime('%Y-%m-%dT%H:%M:%S%zZ')
+    # Authors of the crawled commits are added to `monthly_sketches` when given
+    def _get_weekly_commits(self, pat, org_then_slash_then_repo, year_count, monthly_sketches=None) -> List[Dict]:
+        weekly_commits = []
+
+        for (date_since, date_until) in self._get_week_windows(year_count):
+            curr_week_commits_count = 0
+            page = 1
+
+            date_since_formatted = date_since.strftime(GITHUB_DATE_FORMAT)
+            date_until_formatted = date_until.strftime(GITHUB_DATE_FORMAT)
             while True:
                 resp = get_commits(
                     pat,
@@ -255,14 +421,16 @@ class DevOracle:
                     date_until_formatted
                 )
                 if resp["error_code"] == 403:
-                    print("Token rate limit reached, switching tokens")
-                    pat = self._get_access_token()
+                    LOGGER.warning("Token rate limit reached, switching tokens")
+                    pat = self._switch_access_token()
                     continue
                 if resp["error_code"]:
-                    print("Error code: ", resp["error_code"])
+                    LOGGER.error("Error code: %s", resp["error_code"])
                     raise Exception(
                         f"Error occured while fetching weekly commits for {org_then_slash_then_repo}")
                 count = len(resp["data"])
+                if monthly_sketches is not None:
+                    self._add_commits_to_monthly_sketches(monthly_sketches, resp["data"])
 
                 # No more commits for the curr. week range
                 if count == 0:
@@ -277,12 +445,71 @@ class DevOracle:
                 'commits': curr_week_commits_count
             })
 
-            # Set date_until to a day before the last computed week date
-            date_until = date_until - datetime.timedelta(days=7)
-
         return weekly_commits
 
+    # Same output as _get_weekly_commits, but pages through the whole
+    # [oldest week start, now] range once and buckets the commits locally
+    def _get_weekly_commits_single_pass(self, pat, org_then_slash_then_repo, year_count,
+                                        monthly_sketches=None) -> List[Dict]:
+        # Oldest week first, so the windows can be binary searched by start date
+        windows = self._get_week_windows(year_count)[::-1]
+        if not windows:
+            return []
+        window_starts = [date_since for (date_since, _) in windows]
+        commit_counts = [0] * len(windows)
+
+        page = 1
+        while True:
+            resp = get_commits(
+                pat,
+                org_then_slash_then_repo,
+                page,
+                year_count,
+                windows[0][0].strftime(GITHUB_DATE_FORMAT),
+                windows[-1][1].strftime(GITHUB_DATE_FORMAT)
+            )
+            if resp["error_code"] == 403:
+                LOGGER.warning("Token rate limit reached, switching tokens")
+                pat = self._switch_access_token()
+                continue
+            if resp["error_code"]:
+                LOGGER.error("Error code: %s", resp["error_code"])
+                raise Exception(
+                    f"Error occured while fetching weekly commits for {org_then_slash_then_repo}")
+
+            self._count_commits_per_week(windows, window_starts, commit_counts, resp["data"])
+            if monthly_sketches is not None:
+                self._add_commits_to_monthly_sketches(monthly_sketches, resp["data"])
+
+            if not resp["total_pages"] or page >= resp["total_pages"] or len(resp["data"]) == 0:
+                break
+            page += 1
+
+        return self._format_weekly_commits(windows, commit_counts)
+
+    # Add the commits of a page to the counts of the (oldest first) week windows they fall in
+    @staticmethod
+    def _count_commits_per_week(windows: List[tuple], window_starts: list, commit_counts: List[int], commits: List[Dict]):
+        for commit in commits:
+            # since/until filter on the committer date
+            commit_date = datetime.datetime.strptime(
+                (commit['commit']['committer'] or commit['commit']['author'])['date'],
+                '%Y-%m-%dT%H:%M:%SZ')
+            index = bisect_right(window_starts, commit_date) - 1
+            # Commits falling in the day between two windows are not counted by the weekly crawl either
+            if index >= 0 and commit_date <= windows[index][1]:
+                commit_counts[index] += 1
+
+    @staticmethod
+    def _format_weekly_commits(windows: List[tuple], commit_counts: List[int]) -> List[Dict]:
+        return [{
+            'start_date': date_since.strftime(GITHUB_DATE_FORMAT),
+            'end_date': date_until.strftime(GITHUB_DATE_FORMAT),
+            'commits': commit_count
+        } for ((date_since, date_until), commit_count) in zip(windows, commit_counts)]
+
     # given a list of repo_data of org, analyze for churn_4w, commits_4w, stars, releases
+    @profile_stage
     def _get_stats_for_org_from_repo_data(self, org_repo_data_list):
         number_of_hyperthreads = multiprocessing.cpu_count()
         n_jobs = 2 if number_of_hyperthreads > 2 else number_of_hyperthreads
@@ -292,19 +519,12 @@ class DevOracle:
         for repo_stats in repo_stats_list:
             stats_counter += Counter(repo_stats)
         sc_dict = dict(stats_counter)
-        max_contributors = 0
 
-        sc_dict['num_releases'] = 0 if 'num_releases' not in sc_dict else sc_dict['num_releases']
         # TODO: remove contributor specific data
-        # FIXME find an efficient way to count distinct devs. This is a good lower bound number.
-        for dictionary in repo_stats_list:
-            try:
-                this_contributors = dictionary['contributors']
-            except:
-                this_contributors = 0
-            max_contributors = this_contributors if this_contributors > max_contributors else max_contributors
-        # GitHub API only returns up to 100 contributors FIXME FIX THIS ====================================================================================================
-        sc_dict['contributors'] = max_contributors
+        # Distinct contributors of the org's repos, estimated from their merged sketches.
+        # GitHub API only returns up to 100 contributors per repo FIXME FIX THIS
+        contributor_sketches = self._merge_contributor_sketches({}, org_repo_data_list)
+        sc_dict['contributors'] = contributor_sketches['all'].count() if contributor_sketches else 0
         sc_dict['num_releases'] = 0 if 'num_releases' not in sc_dict else sc_dict['num_releases']
         return sc_dict
 
@@ -328,7 +548,7 @@ class DevOracle:
                     # Deletions is negative, so churn is being calculated as #additions - #deletions
                     churn_4w += (weekly_add_del[-i]["additions"] -
                                  weekly_add_del[-i]["deletions"])
-                    commits_4w += weekly_commits[-i]
+                    commits_4w += weekly_commits[-i]["commits"]
                 except:
                     break
         # TODO: remove contributor specific data
@@ -346,6 +566,7 @@ class DevOracle:
     # given a list of repo_data for org, analyze for
     # weekly_commits and weekly_churn for all weeks till now;
     # Weekly commit, churn serve as indicators for historical progress
+    @profile_stage
     def _get_historical_progress(self, org_repo_data_list: list):
         # GitHub API can hit spam limit
         number_of_hyperthreads = multiprocessing.cpu_count()
@@ -391,12 +612,13 @@ class DevOracle:
                         weekly_add_del[i]["additions"] - weekly_add_del[i]["deletions"])
             stats = {
                 'weekly_churn': weekly_churn,
-                'weekly_commits': weekly_commits,
+                # Counts only, the weeks of all repos are summed element wise
+                'weekly_commits': [week["commits"] for week in weekly_commits],
                 'repo': org_then_slash_then_repo
             }
             return stats
         except Exception as e:
-            print(e)
+            LOGGER.error(e)
             stats = {
                 'weekly_churn': [],
                 'weekly_commits': weekly_commits,
@@ -406,6 +628,7 @@ class DevOracle:
 
     # Do element wise addition for `weekly_churn`, `weekly_commits`, `weeks_ago` lists
     # to get the cumulative historical data for a given chain
+    @profile_stage
     def _combine_hist_data(self, cumulative_hist_data, hist_data_for_org):
         if cumulative_hist_data is None:
             cumulative_hist_data = hist_data_for_org
@@ -432,12 +655,39 @@ if __name__ == '__main__':
     p = optparse.OptionParser()
     p.add_option('--frequency', type='int', dest='frequency',
                  help='Enter churn, commit frequency')
+    p.add_option('--commit-crawl', type='choice', dest='commit_crawl',
+                 choices=list(COMMIT_CRAWL_MODES), default='single-pass',
+                 help='single-pass: one paginated crawl bucketed locally, weekly: one crawl per week')
+    p.add_option('--backend', type='choice', dest='backend',
+                 choices=list(REPO_METADATA_BACKENDS), default='rest',
+                 help='graphql: fetch stars, forks, releases and weekly commits of many repos per request')
+    p.add_option('--source', type='choice', dest='source',
+                 choices=list(REPO_DATA_SOURCES), default='api',
+                 help='git: compute churn, commits and contributors from local clones')
+    p.add_option('--async', action='store_true', dest='run_async', default=False,
+                 help='Fetch all orgs and repos of the chain concurrently')
+    p.add_option('--concurrency', type='int', dest='concurrency', default=16,
+                 help='With --async, max. requests in flight')
+    p.add_option('--per-token-concurrency', type='int', dest='per_token_concurrency', default=4,
+                 help='With --async, max. requests in flight per personal access token')
+    p.add_option('--profile', action='store_true', dest='profile', default=False,
+                 help='Print the wall time, CPU time and memory of each stage on exit')
+    p.add_option('--profile-dir', dest='profile_dir',
+                 help='With --profile, also write a cProfile and the top allocation sites of each stage here')
 
     options, arguments = p.parse_args()
     if not options.frequency:
         options.frequency = 4
 
-    years_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1
-
-    do = DevOracle('./output', options.frequency)
-    do.get_and_save_full_stats(sys.argv[1], years_count)
+    years_count = int(arguments[1]) if len(arguments) > 1 else 1
+    install_request_metrics('dev_async' if options.run_async else 'dev')
+    if options.profile:
+        enable_stage_profiling(options.profile_dir)
+
+    if options.run_async:
+        from dev_async import AsyncDevOracle
+        do = AsyncDevOracle('./output', options.frequency, options.concurrency, options.per_token_concurrency)
+    else:
+        do = DevOracle('./output', options.frequency, options.commit_crawl, options.backend,
+                       source=options.source)
+    do.get_and_save_full_stats(arguments[0], years_count)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from typing import List, Dict
+
+from aiohttp import ClientSession
+
+from config import get_pats
+from dev import DevOracle, GITHUB_DATE_FORMAT
+from gitTokenHelper import GithubTokenPool
+from github_http import github_get_async, get_last_page_from_link_header, GITHUB_API_URL
+from request_metrics import set_request_chain
+from stage_profiler import profile_stage
+from stats_queue import STATS_ENDPOINTS, STATS_POLL_ATTEMPTS, get_stats_poll_delay
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_PER_TOKEN_CONCURRENCY = 4
+
+
+'''
+FLOW
+get_and_save_full_stats -> _read_orgs_for_chain_from_toml -> for all orgs concurrently:
+    _get_repo_data_for_org_async -> _get_org_repo_listing and for all repos of org concurrently:
+        _get_single_repo_data_async
+then, like DevOracle, _save_chain_stats
+'''
+
+
+# DevOracle with all repos and orgs of a chain fetched concurrently over aiohttp.
+# `concurrency` bounds the requests in flight overall, `per_token_concurrency`
+# the requests in flight per personal access token.
+class AsyncDevOracle(DevOracle):
+    def __init__(self, save_path: str, frequency, concurrency: int = DEFAULT_CONCURRENCY,
+                 per_token_concurrency: int = DEFAULT_PER_TOKEN_CONCURRENCY, token_pool: GithubTokenPool = None):
+        token_pool = token_pool or GithubTokenPool(get_pats(), max_leases_per_token=per_token_concurrency)
+        super().__init__(save_path, frequency, 'single-pass', 'rest', token_pool)
+        # The requests lease their own tokens
+        self.token_pool.release(self.PAT)
+        self.concurrency = concurrency
+        self.semaphore = None
+        # Background refreshes of stale cache entries, awaited before the session closes
+        self.revalidations = {}
+        # (org/repo, endpoint) -> task polling the statistics endpoint
+        self.stats_tasks = {}
+
+    # _save_chain_stats runs DevOracle's joblib stages, which pickle the oracle.
+    # The tasks and the semaphore belong to the event loop of the run.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['semaphore']
+        del state['revalidations']
+        del state['stats_tasks']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.semaphore = None
+        self.revalidations = {}
+        self.stats_tasks = {}
+
+    def get_and_save_full_stats(self, chain_name: str, year_count):
+        asyncio.run(self.get_and_save_full_stats_async(chain_name, year_count))
+
+    @profile_stage
+    async def get_and_save_full_stats_async(self, chain_name: str, year_count):
+        # Tasks created below inherit it
+        set_request_chain(chain_name)
+        github_orgs = self._read_orgs_for_chain_from_toml(chain_name)
+        orgs = []
+        for org_url in github_orgs:
+            if not org_url.startswith("https://github.com/"):
+                # TODO: If Gitlab repo then use Gitlab APIs
+                LOGGER.warning("%s is not a github repo...Skipping", org_url)
+                continue
+            orgs.append(org_url.split("https://github.com/")[1])
+
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            async with ClientSession() as session:
+                org_repo_data_lists = await asyncio.gather(*[
+                    self._get_repo_data_for_org_async(session, org, year_count) for org in orgs])
+                if self.revalidations:
+                    LOGGER.info("Waiting for %d background revalidations ...", len(self.revalidations))
+                    await asyncio.gather(*self.revalidations.values())
+        finally:
+            # Done tasks keep their results, which are in the repo data by now
+            self.revalidations = {}
+            self.stats_tasks = {}
+
+        self._save_chain_stats(chain_name, orgs, list(org_repo_data_lists))
+
+    # GET under the global concurrency limit, with a leased token
+    async def _get(self, session, url: str):
+        while True:
+            async with self.semaphore:
+                async with self.token_pool.lease_async() as pat:
+                    r = await github_get_async(session, url, pat)
+            if r.status == 403 and r.headers.get('X-RateLimit-Remaining') == '0':
+                LOGGER.warning("Token rate limit reached, switching tokens")
+                self.token_pool.mark_rate_limited(pat, int(r.headers.get('X-RateLimit-Reset', 0)) or None)
+                continue
+            if r.status in (403, 429) and 'Retry-After' in r.headers:
+                # Secondary rate limit
+                await asyncio.sleep(int(r.headers['Retry-After']))
+                continue
+            return r
+
+    # GET all pages of a listing: page 1 first for the last page number, then the rest concurrently.
+    # None on a 404.
+    async def _get_all_pages(self, session, url: str) -> List:
+        separator = '&' if '?' in url else '?'
+        first_page = await self._get(session, url + separator + 'page=1&per_page=100')
+        if first_page.status == 404:
+            return None
+        if first_page.status == 409:
+            # Empty repository
+            return []
+        if first_page.status != 200:
+            raise Exception(f"Error {first_page.status} while fetching {url}")
+        items = first_page.json()
+        last_page = get_last_page_from_link_header(first_page.headers['link']) if 'link' in first_page.headers else None
+        if last_page and last_page > 1:
+            pages = await asyncio.gather(*[
+                self._get(session, url + separator + 'page=' + str(page) + '&per_page=100')
+                for page in range(2, last_page + 1)])
+            for page in pages:
+                if page.status != 200:
+                    raise Exception(f"Error {page.status} while fetching {url}")
+                items.extend(page.json())
+        return items
+
+    # All repos of an org (or user) in one listing, with the fork flag of each.
+    # Shares the inventory cache of the sync scripts, see org_inventory.
+    async def _get_org_repo_listing(self, session, org_name: str) -> List[Dict]:
+        repos = self.org_inventory.get_cached(org_name)
+        if repos is not None:
+            return repos
+        # Errors raise, only complete listings are cached
+        repos = await self._get_all_pages(session, f"{GITHUB_API_URL}/orgs/{org_name}/repos")
+        if repos is None:
+            # Not an org but a user
+            repos = await self._get_all_pages(session, f"{GITHUB_API_URL}/users/{org_name}/repos")
+        if repos is None:
+            LOGGER.warning("Organization or user not found: %s", org_name)
+            repos = []
+        return self.org_inventory.put(org_name, repos)
+
+    @profile_stage
+    async def _get_repo_data_for_org_async(self, session, org_name: str, year_count=1):
+        LOGGER.info("Fetching repo data for %s", org_name)
+        listing = await self._get_org_repo_listing(session, org_name)
+        unforked_repos = [repo for repo in listing if not repo["fork"]]
+        # Ask for the statistics of every repo to crawl first, GitHub computes them
+        # while the commits are fetched instead of after
+        for repo in unforked_repos:
+            if not self.repo_stats_cache.has(repo["full_name"], year_count):
+                for endpoint in STATS_ENDPOINTS:
+                    self._get_stats_task(session, repo["full_name"], endpoint)
+        return await asyncio.gather(*[
+            self._get_single_repo_data_async(session, repo, year_count) for repo in unforked_repos])
+
+    @profile_stage
+    async def _get_single_repo_data_async(self, session, listed_repo: Dict, year_count: int = 1):
+        org_then_slash_then_repo = listed_repo["full_name"]
+        (repo_data, fresh) = self.repo_stats_cache.get(org_then_slash_then_repo, year_count)
+        if repo_data is not None:
+            key = org_then_slash_then_repo.lower()
+            if not fresh and key not in self.revalidations:
+                LOGGER.info("Revalidating stale repo data of %s in the background", org_then_slash_then_repo)
+                self.revalidations[key] = asyncio.ensure_future(
+                    self._revalidate_async(session, listed_repo, year_count))
+            return repo_data
+        repo_data = await self._fetch_single_repo_data_async(session, listed_repo, year_count)
+        self.repo_stats_cache.put(org_then_slash_then_repo, year_count, repo_data)
+        return repo_data
+
+    async def _revalidate_async(self, session, listed_repo: Dict, year_count: int):
+        try:
+            repo_data = await self._fetch_single_repo_data_async(session, listed_repo, year_count)
+            self.repo_stats_cache.put(listed_repo["full_name"], year_count, repo_data)
+        # A failed refresh leaves the stale entry, it is retried on the next read
+        except Exception as e:
+            LOGGER.warning("Failed to revalidate repo data of %s %s", listed_repo["full_name"], e)
+
+    async def _fetch_single_repo_data_async(self, session, listed_repo: Dict, year_count: int = 1):
+        org_then_slash_then_repo = listed_repo["full_name"]
+        LOGGER.info('Fetching repo data for %s', org_then_slash_then_repo)
+        repo_url = f"{GITHUB_API_URL}/repos/{org_then_slash_then_repo}"
+        monthly_sketches = {}
+        (code_frequency, contributor_stats, weekly_commits, releases) = await asyncio.gather(
+            self._get_stats_task(session, org_then_slash_then_repo, 'code_frequency'),
+            self._get_stats_task(session, org_then_slash_then_repo, 'contributors'),
+            self._get_weekly_commits_async(session, org_then_slash_then_repo, year_count, monthly_sketches),
+            self._get_release_count(session, repo_url))
+        contributors = [contributor["author"]["login"] for contributor in contributor_stats
+                        if contributor.get("author")]
+        repo_data = {
+            "name": org_then_slash_then_repo,
+            # Taken from the org listing, saves a request per repo
+            "repo": {
+                "stargazers_count": listed_repo["stargazers_count"],
+                "forks_count": listed_repo["forks_count"]
+            },
+            "weekly_add_del": self._format_weekly_add_del(code_frequency),
+            "weekly_commits": weekly_commits,
+            # TODO: Remove contributor specific code
+            "contributors": contributors,
+            "contributor_sketches": self._encode_contributor_sketches(contributors, monthly_sketches),
+            "releases": releases
+        }
+        return repo_data
+
+    # The task polling a statistics endpoint of a repo, started on first use
+    def _get_stats_task(self, session, org_then_slash_then_repo: str, endpoint: str):
+        key = (org_then_slash_then_repo, endpoint)
+        if key not in self.stats_tasks:
+            self.stats_tasks[key] = asyncio.ensure_future(self._get_stats(
+                session, f"{GITHUB_API_URL}/repos/{org_then_slash_then_repo}/stats/{endpoint}"))
+        return self.stats_tasks[key]
+
+    # Statistics endpoint, polled with backoff while GitHub answers 202. The wait holds
+    # no request slot, so other repos keep going meanwhile.
+    async def _get_stats(self, session, url: str) -> List:
+        for attempt in range(STATS_POLL_ATTEMPTS):
+            r = await self._get(session, url)
+            if r.status == 200:
+                return r.json()
+            if r.status == 204:
+                # Empty repo
+                return []
+            if r.status != 202:
+                raise Exception(f"Error {r.status} while fetching {url}")
+            await asyncio.sleep(get_stats_poll_delay(attempt))
+        LOGGER.warning("Statistics not ready in time for %s", url)
+        return []
+
+    # The release listing's last page number is the release count when one release is listed per page
+    async def _get_release_count(self, session, repo_url: str) -> int:
+        r = await self._get(session, repo_url + '/releases?per_page=1')
+        if r.status != 200:
+            return 0
+        if 'link' in r.headers:
+            return get_last_page_from_link_header(r.headers['link']) or len(r.json())
+        return len(r.json())
+
+    # _get_weekly_commits_single_pass with the pages after the first fetched concurrently
+    async def _get_weekly_commits_async(self, session, org_then_slash_then_repo: str, year_count: int,
+                                        monthly_sketches: Dict = None) -> List[Dict]:
+        windows = self._get_week_windows(year_count)[::-1]
+        if not windows:
+            return []
+        window_starts = [date_since for (date_since, _) in windows]
+        commit_counts = [0] * len(windows)
+        url = (f"{GITHUB_API_URL}/repos/{org_then_slash_then_repo}/commits"
+               f"?since={windows[0][0].strftime(GITHUB_DATE_FORMAT)}"
+               f"&until={windows[-1][1].strftime(GITHUB_DATE_FORMAT)}")
+        commits = await self._get_all_pages(session, url)
+        if commits is None:
+            raise Exception(f"Error occured while fetching weekly commits for {org_then_slash_then_repo}")
+        self._count_commits_per_week(windows, window_starts, commit_counts, commits)
+        if monthly_sketches is not None:
+            self._add_commits_to_monthly_sketches(monthly_sketches, commits)
+        return self._format_weekly_commits(windows, commit_counts)
@@ -1,5 +1,4 @@
 #!/bin/bash
-names=$(awk -F "=" '/names/ {print $2}' config.ini)
 
 rm logfile.log
 
@@ -7,19 +6,8 @@ rm logfile.log
 
 # python3 updateProtocols.py
 
-#echo "Running dev.py ..."
-#for name in $names; do
-#    python dev.py $name
-#done
-
-#echo "Running contr.py ..."
-#for name in $names; do
-#    python contr.py protocols/$name.toml 1
-#done
-
-for name in $names; do
-    python get_repo_stats.py $name 1
-done
+# dev.py, contr.py and get_contributors.py for every chain of config.ini, sharing one work queue and token pool
+python3 orchestrator.py --years 1
 
 #echo "Running visualizer ..."
-#python vis.py
\ No newline at end of file
+#python vis.py
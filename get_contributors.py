@@ -1,40 +1,82 @@
-import csv
-import json
+import datetime
+import itertools
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from os import path
 import optparse
-from typing import List, Dict, Optional
+from typing import List, Dict, Tuple
 
+import requests
 import toml
-from github import Github, StatsContributor
+from github import Github
 from joblib import Parallel, delayed
-import requests
-
-from config import get_pats
-from gitTokenHelper import GithubPersonalAccessTokenHelper
+from requests.adapters import HTTPAdapter
+
+from aimd import get_retry_after_secs, SECONDARY_LIMIT_WAIT_SECS
+from commit_store import CommitStore, compact_commit
+from config import get_pats, get_sync_state_dir, get_sync_lookback_days
+from github_http import github_get, get_last_page_from_link_header, GITHUB_API_URL
+from gitTokenHelper import GithubTokenPool
+from org_inventory import OrgInventory
+from request_metrics import bind_request_context, install_request_metrics, set_request_chain
+from stage_profiler import enable_stage_profiling, profile_stage
+from stats_queue import DeferredStatsQueue
+from sync_state import SyncStateStore
 from logger import sys
 
 
-LOGGER = logging.getLogger(__file__)
+LOGGER = logging.getLogger(__name__)
 dir_path = path.dirname(path.realpath(__file__))
 
+# GitHub caps per_page at 100
+COMMITS_PER_PAGE = 100
+# Commit pages of a repo fetched at once, one pooled connection each
+COMMIT_PAGE_WORKERS = 8
+
 
 class RepoStats:
-    def __init__(self, pat: str, save_path: str):
+    def __init__(self, pat: str, save_path: str, token_pool: GithubTokenPool = None):
         self.save_path = save_path
-        self.gh_pat_helper = GithubPersonalAccessTokenHelper(get_pats())
-        self.PAT = self._get_access_token()
-        self.gh = Github(self.PAT)
-
-    def _get_access_token(self):
-        res = self.gh_pat_helper.get_access_token()
-        if "token" in res and res["token"] is not None:
-            return res["token"]
-        print('Going to sleep since no token exists with usable rate limit')
-        time.sleep(res["sleep_time_secs"])
-        return self._get_access_token()
+        self.token_pool = token_pool or GithubTokenPool(get_pats())
+        self.PAT = self.token_pool.acquire()
+        self.gh = Github(self.PAT, base_url=GITHUB_API_URL)
+        # Per-repo commit watermarks, reruns only fetch the commits since the last run
+        self.sync_state = SyncStateStore(get_sync_state_dir(), get_sync_lookback_days())
+        self.stats_queue = DeferredStatsQueue(self.token_pool, endpoints=('contributors',))
+        self.org_inventory = OrgInventory(self.token_pool)
+        # Keep-alive connections reused by the concurrent page requests
+        self.session = requests.Session()
+        self.session.mount(GITHUB_API_URL, HTTPAdapter(pool_connections=1, pool_maxsize=COMMIT_PAGE_WORKERS))
+
+    # Hand back the current token and lease the one with the most budget left.
+    # Blocks until the earliest reset when every token is exhausted.
+    def _switch_access_token(self):
+        self.token_pool.release(self.PAT)
+        self.PAT = self.token_pool.acquire(avoid=self.PAT)
+        self.gh = Github(self.PAT, base_url=GITHUB_API_URL)
+        return self.PAT
+
+    # GET with a token leased for the request, so concurrent page requests don't switch a
+    # shared token. A token out of budget is marked and another one used, secondary limits
+    # are waited out.
+    def _get(self, url: str):
+        while True:
+            with self.token_pool.lease() as pat:
+                r = github_get(url, pat, session=self.session)
+            if r.status_code in (403, 429) and r.headers.get('X-RateLimit-Remaining') == '0':
+                LOGGER.warning("Token rate limit reached, switching tokens")
+                self.token_pool.mark_rate_limited(pat, int(r.headers.get('X-RateLimit-Reset', 0)) or None)
+                continue
+            if r.status_code in (403, 429):
+                wait_secs = get_retry_after_secs(r.headers)
+                if wait_secs is None:
+                    wait_secs = SECONDARY_LIMIT_WAIT_SECS
+                LOGGER.warning("Secondary rate limit trigger detected, waiting %ds", wait_secs)
+                time.sleep(wait_secs)
+                continue
+            return r
 
     def _get_with_retry(self, func, retry_num, **params):
         from github.GithubException import UnknownObjectException
@@ -44,8 +86,7 @@ class RepoStats:
             if response.status_code == 403:
                 if retry_num == 0:
                     LOGGER.info('retrying')
-                    self.PAT = self._get_access_token()
-                    self.gh = Github(self.PAT)
+                    self._switch_access_token()
                     return self._get_with_retry(func, retry_num + 1, **params)
                 else:
                     raise Exception('Rate limited')
@@ -58,11 +99,13 @@ class RepoStats:
             LOGGER.exception(ex)
             raise ex
 
+    @profile_stage
     def get_and_save_full_stats(self, chain_name: str):
+        set_request_chain(chain_name)
         repos = self._read_repos_for_chain_from_toml(chain_name)
-        print(f'Found {len(repos)} repos')
-        repo_data_lists = Parallel(n_jobs=1)(delayed(
-            self._get_commits)(chain, org_and_repo) for org_and_repo in repos)
+        LOGGER.info('Found %d repos', len(repos))
+        repo_commits_and_users = Parallel(n_jobs=1)(delayed(
+            self._get_commits)(chain_name, org_and_repo) for org_and_repo in repos)
 
         # org_repo_data_list = []
         # for org_url in repos:
@@ -76,87 +119,49 @@ class RepoStats:
         #     if len(org_repo_data) > 0:
         #         org_repo_data_list.append(org_repo_data)
 
-        path = os.path.abspath("./output/" + chain + "_contributors.csv")
-
-        with open(path, 'w+') as fileobj:
-            writer = csv.DictWriter(fileobj, fieldnames=[
-                'chain',
-                'org',
-                'repo',
-                'commit_committer',
-                'commit_author',
-                'author',
-                'committer'
-            ])
-            writer.writeheader()
-            for repo_data in repo_data_lists:
-                if len(repo_data) > 0:
-                    writer.writerows(repo_data)
+        self._save_commits(chain_name, repos, repo_commits_and_users)
+
+    # Write the (commits, users) of each repo of a chain to the commit store
+    @profile_stage
+    def _save_commits(self, chain_name: str, repos: List[str], repo_commits_and_users: List[Tuple[List[Dict], Dict]]):
+        commits_by_repo = {}
+        users = {}
+        for (org_and_repo, (commits, repo_users)) in zip(repos, repo_commits_and_users):
+            commits_by_repo[org_and_repo] = commits
+            users.update(repo_users)
+        CommitStore(self.save_path).write_chain(chain_name, commits_by_repo, users)
 
     # list all the repos of a github org/user
     # Ensure chain_name is same as name of toml file
+    @profile_stage
     def _read_repos_for_chain_from_toml(self, chain: str):
         toml_file_path = path.join(dir_path, 'crypto-ecosystems/data/ecosystems', chain[0],
                                    chain + '.toml')
         if not path.exists(toml_file_path):
-            print(".toml file not found for %s" % chain)
+            LOGGER.error(".toml file not found for %s", chain)
             sys.exit(1)
         try:
             with open(toml_file_path, 'r') as f:
                 data = f.read()
-            print("Fetching organizations for %s from toml file ..." % chain)
+            LOGGER.info("Fetching organizations for %s from toml file ...", chain)
             repos = toml.loads(data)['repo']
             return [repo['url'].replace('https://github.com/', '') for repo in repos]
             # github_orgs = toml.loads(data)['github_organizations']
         except:
-            print('Could not open toml file - check formatting.')
+            LOGGER.error('Could not open toml file - check formatting.')
             sys.exit(1)
 
-    # given the org_name, return list of organisation repos
-    def _make_org_repo_list(self, org: str):
-        org_repos = []
-        entity = self._get_with_retry(self.gh.get_organization, 0, **{'login': org})
-        if entity is None:
-            print('organization not found, fetching user instead')
-            entity = self._get_with_retry(self.gh.get_user, 0, **{'login': org})
-            if entity is None:
-                print('user not found, skipping repos')
-                return org_repos
-
-        for repo in entity.get_repos():
-            org_repos.append(repo.name)
-        org_repos = [org + '/{0}'.format(repo) for repo in org_repos]
-        return org_repos
-
-    def _get_repos_for_org(self, org):
-        repos = []
-        page = 1
-        url = f"https://api.github.com/orgs/{org}/repos?type=forks&page={page}&per_page=1000"
-        response = requests.get(
-            url, headers={'Authorization': 'Token ' + self.PAT})
-        while len(response.json()) > 0:
-            for repo in response.json():
-                repos.append(repo["full_name"])
-            page += 1
-            url = f"https://api.github.com/orgs/{org}/repos?type=forks&page={page}&per_page=1000"
-            response = requests.get(
-                url, headers={'Authorization': 'Token ' + self.PAT})
-
-        return repos
-
     # get the data for all the repos of a github organization
     def _get_repo_data_for_org(self, chain: str, org: str):
-        org_repos = self._make_org_repo_list(org)
-        if len(org_repos) == 0:
+        unforked_repos = self.org_inventory.get_unforked_repos(org)
+        if len(unforked_repos) == 0:
             return []
 
-        forked_repos = self._get_with_retry(self._get_repos_for_org, 0, **{'org': org})
-        unforked_repos = list(set(org_repos) - set(forked_repos))
         # GitHub API can hit spam limit
         # number_of_hyperthreads = multiprocessing.cpu_count()
         number_of_hyperthreads = 1
         n_jobs = 2 if number_of_hyperthreads > 2 else number_of_hyperthreads
-        print("Fetching single repo data ...")
+        LOGGER.info("Fetching single repo data ...")
         repo_data_lists = Parallel(n_jobs=n_jobs)(delayed(
             self._get_commits_with_retry)(chain, org_and_repo) for org_and_repo in unforked_repos)
         return repo_data_lists
@@ -166,81 +171,106 @@ class RepoStats:
         return self._get_with_retry(self._get_commits, 0, **{'chain': chain,
                                                              'org_and_repo': org_and_repo})
 
-    def _get_commits(self, chain, org_and_repo) -> List[Dict]:
-        page = 1
-        commits = []
+    # Compact commit rows of a repo and the users they refer to, see commit_store
+    # Page 1 gives the rel="last" page count, the other pages are fetched concurrently
+    # and folded in page order
+    @profile_stage
+    def _get_commits(self, chain, org_and_repo) -> Tuple[List[Dict], Dict[int, dict]]:
+        # Rows by commit sha, so commits fetched again in the lookback window are not duplicated
+        state = self.sync_state.load(org_and_repo, 'commits')
+        aggregate = state['aggregate'] or {'commits': {}, 'users': {}}
+        commits_by_sha = aggregate['commits']
+        # JSON object keys are strings
+        users = {int(user_id): user for (user_id, user) in aggregate['users'].items()}
+        since = self.sync_state.get_since(state)
+        fetched_commits = 0
 
         def _get_commit_page(page):
-            url = f"https://api.github.com/repos/{org_and_repo}/commits?page={page}&per_page=1000"
-            return requests.get(url, headers={'Authorization': 'Token ' + self.PAT})
-
-        response = self._get_with_retry(_get_commit_page, 0, **{'page': page})
-
-        while response.status_code == 200 and len(response.json()) > 0:
-            for commit in response.json():
-                commits.append({
-                    'chain': chain,
-                    'org': org_and_repo.split('/')[0],
-                    'repo': org_and_repo.split('/')[1],
-                    'commit_committer': json.dumps(commit['commit']['committer']),
-                    'commit_author': json.dumps(commit['commit']['author']),
-                    'author': json.dumps(commit['author']),
-                    'committer': json.dumps(commit['committer'])
-                })
-            page += 1
-
-            response = self._get_with_retry(_get_commit_page, 0, **{'page': page})
-
-        print(f'Fetched {len(commits)} commits for {org_and_repo}')
-        return commits
+            url = f"{GITHUB_API_URL}/repos/{org_and_repo}/commits?page={page}&per_page={COMMITS_PER_PAGE}"
+            if since:
+                url += '&since=' + since
+            return self._get(url)
+
+        first_response = _get_commit_page(1)
+        if first_response.status_code in (404, 409):
+            # Repository gone or empty, nothing to fetch and the watermark stays
+            LOGGER.warning('No commits for %s (%d)', org_and_repo, first_response.status_code)
+            return list(commits_by_sha.values()), users
+        last_page = 1
+        if first_response.status_code == 200 and 'link' in first_response.headers:
+            last_page = get_last_page_from_link_header(first_response.headers['link']) or 1
+
+        # Moved into the state only once every page is in, a crawl that fails part way
+        # must not skip the commits it didn't get on the next incremental run
+        watermark = {'last_commit_date': state['last_commit_date'], 'last_commit_sha': state['last_commit_sha']}
+        executor = ThreadPoolExecutor(max_workers=COMMIT_PAGE_WORKERS)
+        try:
+            # map() hands the responses back in page order
+            responses = executor.map(bind_request_context(_get_commit_page), range(2, last_page + 1))
+            for response in itertools.chain([first_response], responses):
+                if response.status_code != 200:
+                    raise Exception(f"Error {response.status_code} while fetching commits of {org_and_repo}")
+                page_commits = response.json()
+                if len(page_commits) == 0:
+                    # End of history
+                    break
+                for commit in page_commits:
+                    commits_by_sha[commit['sha']] = compact_commit(commit, users)
+                SyncStateStore.advance(watermark, page_commits)
+                fetched_commits += len(page_commits)
+        finally:
+            # Pages still queued after an error or the end of history are not fetched
+            executor.shutdown(cancel_futures=True)
+
+        state.update(watermark)
+        state['aggregate'] = {'commits': commits_by_sha, 'users': users}
+        self.sync_state.save(org_and_repo, 'commits', state)
+        LOGGER.info('Fetched %d new commits for %s, %d in total', fetched_commits, org_and_repo, len(commits_by_sha))
+        return list(commits_by_sha.values()), users
 
     # get repo data using a repo URL in the form of `org/repo`
     def _get_single_repo_data_from_api(self, chain: str, org: str, org_then_slash_then_repo: str,
                                        year_count: int = 1):
-        print('Fetching repo data for ', org_then_slash_then_repo)
+        LOGGER.info('Fetching repo data for %s', org_then_slash_then_repo)
         data = []
-        try:
-            repo = self.gh.get_repo(org_then_slash_then_repo)
-            contributors: Optional[List[StatsContributor]] = repo.get_stats_contributors()
-            if contributors is None:
-                return data
-
-            for contributor in contributors:
-                for week in contributor.weeks:
-                    if week.c > 0:
-                        data.append({
-                            'chain': chain,
-                            'org': org,
-                            'repo': org_then_slash_then_repo.split("/")[1],
-                            'contributor_login': contributor.author.login,
-                            'contributor_id': contributor.author.id,
-                            'start_date': week.w.strftime('%Y-%m-%dT%H:%M:%S%zZ'),
-                            'additions': week.a,
-                            'deletions': week.d,
-                            'commits': week.c
-                        })
-            return data
-
-        except Exception as e:
-            LOGGER.exception(e)
-            self.PAT = self._get_access_token()
-            self.gh = Github(self.PAT)
-            return self._get_single_repo_data_from_api(chain, org, org_then_slash_then_repo,
-                                                       year_count)
+        # Polled with backoff while GitHub computes them, call stats_queue.request() for many repos up front
+        contributors = self.stats_queue.get(org_then_slash_then_repo, 'contributors')
+        for contributor in contributors:
+            if not contributor.get('author'):
+                continue
+            for week in contributor['weeks']:
+                if week['c'] > 0:
+                    data.append({
+                        'chain': chain,
+                        'org': org,
+                        'repo': org_then_slash_then_repo.split("/")[1],
+                        'contributor_login': contributor['author']['login'],
+                        'contributor_id': contributor['author']['id'],
+                        'start_date': datetime.datetime.utcfromtimestamp(week['w']).strftime('%Y-%m-%dT%H:%M:%S%zZ'),
+                        'additions': week['a'],
+                        'deletions': week['d'],
+                        'commits': week['c']
+                    })
+        return data
 
 
 if __name__ == '__main__':
     p = optparse.OptionParser()
     p.add_option('--frequency', type='int', dest='frequency',
                  help='Enter churn, commit frequency')
+    p.add_option('--profile', action='store_true', dest='profile', default=False,
+                 help='Print the wall time, CPU time and memory of each stage on exit')
+    p.add_option('--profile-dir', dest='profile_dir',
+                 help='With --profile, also write a cProfile and the top allocation sites of each stage here')
 
     options, arguments = p.parse_args()
 
-    years_count = int(sys.argv[2]) if len(sys.argv) > 2 else 3
-
+    install_request_metrics('get_contributors')
+    if options.profile:
+        enable_stage_profiling(options.profile_dir)
     pat: str = os.getenv('GITHUB_PAT')
     do = RepoStats(pat=pat, save_path='./output')
     chains = os.getenv('CHAINS').split(" ")
     for chain in chains:
-        print('getting stats for chain', chain)
+        LOGGER.info('getting stats for chain %s', chain)
         do.get_and_save_full_stats(chain)
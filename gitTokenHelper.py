@@ -1,55 +1,195 @@
 # -*- coding: utf-8 -*-
-import datetime
-import os
+import asyncio
+import calendar
+import logging
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
 
 from github import Github, GithubException
 
+from github_http import add_response_observer, observe_pygithub_requests, GITHUB_API_URL
 
-class GithubPersonalAccessTokenHelper():
-    def __init__(self, pats):
+LOGGER = logging.getLogger(__name__)
+
+# Hourly core rate limit of an authenticated user
+DEFAULT_RATE_LIMIT = 5000
+# Keep some requests of every token in reserve, like the old helper did
+MIN_REMAINING = 100
+
+
+class _TokenState:
+    def __init__(self, pat, remaining, limit, reset_epoch):
+        self.pat = pat
+        self.remaining = remaining
+        self.limit = limit
+        self.reset_epoch = reset_epoch
+        self.leases = 0
+
+
+# Pool of GitHub personal access tokens. Budgets are tracked from the
+# X-RateLimit-Remaining/Reset headers of the responses the fetchers already
+# receive, so the rate limit endpoint is only queried once per token at start up.
+# Tokens are leased to workers; when every token is exhausted, acquire() waits
+# for the earliest reset.
+class GithubTokenPool:
+    def __init__(self, pats, min_remaining: int = MIN_REMAINING, max_leases_per_token: int = None):
         if not isinstance(pats, list):
             raise Exception("PATs must be an array")
-        self.pats = []
+        self.min_remaining = min_remaining
+        self.max_leases_per_token = max_leases_per_token
+        self._tokens = {}
+        self._condition = threading.Condition()
         self._initialize_pats(pats)
-        self.last_sent_token = 'fff'
+        add_response_observer(self._observe_response)
+        # PyGithub's responses carry the headers too
+        observe_pygithub_requests()
+
+    # joblib ships DevOracle to worker processes for the analysis steps; the copy
+    # there never makes requests, so the lock is simply recreated
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_condition']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._condition = threading.Condition()
+
+    @property
+    def pats(self):
+        return list(self._tokens)
 
     def _initialize_pats(self, pats):
         for (_, pat) in enumerate(pats):
             try:
-                gh = Github(pat)
+                gh = Github(pat, base_url=GITHUB_API_URL)
                 rate_limit = gh.get_rate_limit()
-
-                self.pats.append(pat)
+                self._tokens[pat] = _TokenState(
+                    pat,
+                    rate_limit.core.remaining,
+                    rate_limit.core.limit,
+                    calendar.timegm(rate_limit.core.reset.timetuple()))
             except GithubException as e:
                 # Probably a bad access token
-                print("Error while querying for personal access token")
-                print(e)
+                LOGGER.warning("Error while querying for personal access token: %s", e)
                 continue
         # Need atleast one valid personal access token
-        assert len(self.pats) > 0
-
-    def get_access_token(self):
-        min_sleep_time_secs = None
-        for (_, token) in enumerate(self.pats):
-            gh = Github(token)
-            rate_limit = gh.get_rate_limit()
-            if rate_limit.core.remaining > 100 and self.last_sent_token != token:
-                self.last_sent_token = token
-                return {
-                    'token': token
-                }
-            rate_limit_reset_time = rate_limit.core.reset
-            time_delta = abs(rate_limit_reset_time -
-                             datetime.datetime.utcnow())
-            if min_sleep_time_secs is None:
-                min_sleep_time_secs = time_delta.total_seconds()
+        assert len(self._tokens) > 0
+
+    def _observe_response(self, pat, url, status_code, headers, elapsed_secs):
+        if pat in self._tokens:
+            self.update_from_headers(pat, headers)
+
+    def update_from_headers(self, pat, headers):
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        # The search and GraphQL budgets are separate from the core one
+        resource = headers.get('X-RateLimit-Resource')
+        if resource and resource != 'core':
+            return
+        self._update(pat, int(headers['X-RateLimit-Remaining']),
+                     int(headers.get('X-RateLimit-Limit', DEFAULT_RATE_LIMIT)),
+                     int(headers.get('X-RateLimit-Reset', 0)) or None)
+
+    def _update(self, pat, remaining, limit, reset_epoch):
+        with self._condition:
+            token = self._tokens.get(pat)
+            if token is None:
+                return
+            if reset_epoch and reset_epoch > token.reset_epoch:
+                # New rate limit window, the header is authoritative
+                token.remaining = remaining
+            else:
+                # Responses of concurrent workers can arrive out of order
+                token.remaining = min(token.remaining, remaining)
+            token.limit = limit
+            if reset_epoch:
+                token.reset_epoch = reset_epoch
+            self._condition.notify_all()
+
+    # A 403 rate limit response without usable headers
+    def mark_rate_limited(self, pat, reset_epoch: int = None):
+        with self._condition:
+            token = self._tokens.get(pat)
+            if token is None:
+                return
+            token.remaining = 0
+            if reset_epoch:
+                token.reset_epoch = reset_epoch
+            elif token.reset_epoch < time.time():
+                token.reset_epoch = time.time() + 60
+
+    # Returns (pat, None) when a token is leased, (None, seconds to wait) otherwise.
+    # `avoid` is only leased again if no other token has budget left.
+    def _try_acquire(self, avoid=None):
+        now = time.time()
+        best = None
+        earliest_reset = None
+        tokens = sorted(self._tokens.values(), key=lambda token: token.pat == avoid)
+        for token in tokens:
+            if token.reset_epoch <= now and token.remaining < token.limit:
+                # The window has reset since the last response seen
+                token.remaining = token.limit
+            if self.max_leases_per_token and token.leases >= self.max_leases_per_token:
                 continue
-            if min_sleep_time_secs < time_delta.total_seconds():
-                min_sleep_time_secs = time_delta.total_seconds()
-
-        print("All access tokens have been rate limited")
-        print("Min sleep time: ", min_sleep_time_secs / 60)
-        return {
-            'token': None,
-            'sleep_time_secs': min_sleep_time_secs
-        }
+            if token.remaining > self.min_remaining:
+                # Spread the load: most budget left per active lease first
+                if best is None or (token.pat != avoid and
+                                    (best.pat == avoid or
+                                     token.remaining / (token.leases + 1) > best.remaining / (best.leases + 1))):
+                    best = token
+            elif earliest_reset is None or token.reset_epoch < earliest_reset:
+                earliest_reset = token.reset_epoch
+        if best is not None:
+            best.leases += 1
+            # Reserve one request until the headers of the next response come in
+            best.remaining -= 1
+            return (best.pat, None)
+        if earliest_reset is None:
+            # Every token is leased out to the limit, wait for a release
+            return (None, 1)
+        return (None, max(earliest_reset - now, 0) + 1)
+
+    # Lease a token, blocking until one has budget left
+    def acquire(self, avoid=None):
+        with self._condition:
+            while True:
+                (pat, wait_secs) = self._try_acquire(avoid)
+                if pat:
+                    return pat
+                if wait_secs > 1:
+                    LOGGER.warning("All access tokens have been rate limited, min sleep time: %.1f minutes", wait_secs / 60)
+                self._condition.wait(wait_secs)
+
+    async def acquire_async(self, avoid=None):
+        while True:
+            with self._condition:
+                (pat, wait_secs) = self._try_acquire(avoid)
+            if pat:
+                return pat
+            # Wake up regularly to pick up releases and header updates of other workers
+            await asyncio.sleep(min(wait_secs, 5))
+
+    def release(self, pat):
+        with self._condition:
+            token = self._tokens.get(pat)
+            if token is not None and token.leases > 0:
+                token.leases -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def lease(self):
+        pat = self.acquire()
+        try:
+            yield pat
+        finally:
+            self.release(pat)
+
+    @asynccontextmanager
+    async def lease_async(self):
+        pat = await self.acquire_async()
+        try:
+            yield pat
+        finally:
+            self.release(pat)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+import logging
+import os
+import subprocess
+from bisect import bisect_right
+from collections import namedtuple
+from os import path
+from typing import List
+
+from hll import HyperLogLog
+
+LOGGER = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+SECONDS_PER_WEEK = 7 * SECONDS_PER_DAY
+# GitHub's code frequency weeks start on Sunday, the first one after the epoch is 1970-01-04
+FIRST_SUNDAY_EPOCH = 3 * SECONDS_PER_DAY
+# Separators that can't appear in names/emails
+COMMIT_MARKER = '\x00'
+FIELD_SEPARATOR = '\x1f'
+# Written as git placeholders, arguments can't contain NUL
+LOG_FORMAT = '--format=%x00' + '%x1f'.join(['%H', '%at', '%ct', '%aN', '%aE'])
+
+GitCommit = namedtuple('GitCommit', [
+    'sha', 'author_epoch', 'committer_epoch', 'author_name', 'author_email', 'additions', 'deletions'])
+
+
+def get_code_frequency_week(epoch: int):
+    return epoch - ((epoch - FIRST_SUNDAY_EPOCH) % SECONDS_PER_WEEK)
+
+
+# Commit history from local bare clones instead of the GitHub API.
+# Clones live under `cache_dir` and are fetched incrementally. `clone_url_template`
+# is formatted with the `org/repo` name, so local fixture repos can stand in for GitHub.
+# Blobless clones are much smaller, but `git log --numstat` then fetches every blob
+# lazily, so they are only worth it when no churn is needed.
+class GitCloneEngine:
+    def __init__(self, cache_dir: str, clone_url_template: str = 'https://github.com/{repo}.git',
+                 blobless: bool = False):
+        self.cache_dir = cache_dir
+        self.clone_url_template = clone_url_template
+        self.blobless = blobless
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _clone_path(self, org_then_slash_then_repo: str):
+        # Kept apart from full clones, which `git log --numstat` can read without fetching blobs
+        suffix = '.blobless.git' if self.blobless else '.git'
+        return path.join(self.cache_dir, org_then_slash_then_repo.lower().replace('/', '__') + suffix)
+
+    @staticmethod
+    def _git(*args):
+        return subprocess.run(['git'] + list(args), check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True).stdout
+
+    # Clone the repo, or fetch what is new since the last sync. Returns the clone path,
+    # None if the repo can't be cloned.
+    def sync(self, org_then_slash_then_repo: str):
+        clone_path = self._clone_path(org_then_slash_then_repo)
+        try:
+            if path.exists(clone_path):
+                self._git('--git-dir', clone_path, 'fetch', '--prune', '--tags', 'origin',
+                          '+refs/heads/*:refs/heads/*')
+            else:
+                clone_args = ['clone', '--bare', '--quiet']
+                if self.blobless:
+                    clone_args.append('--filter=blob:none')
+                url = self.clone_url_template.format(repo=org_then_slash_then_repo)
+                self._git(*(clone_args + [url, clone_path]))
+        except subprocess.CalledProcessError as e:
+            LOGGER.error("Failed to sync clone of %s: %s", org_then_slash_then_repo, e.stderr)
+            return None
+        return clone_path
+
+    # Stream the commits of the default branch, newest first, parsed as `git log` writes them
+    def iter_commits(self, clone_path: str, since_epoch: int = None, numstat: bool = True):
+        args = ['git', '--git-dir', clone_path, 'log', 'HEAD', '--no-renames', LOG_FORMAT]
+        if numstat:
+            args.append('--numstat')
+        if since_epoch:
+            args.append('--since=@' + str(since_epoch))
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   universal_newlines=True, errors='replace')
+        header = None
+        additions = deletions = 0
+        try:
+            for line in process.stdout:
+                if line.startswith(COMMIT_MARKER):
+                    if header:
+                        yield GitCommit(*header, additions, deletions)
+                    (sha, author_epoch, committer_epoch, author_name, author_email) = \
+                        line[1:].rstrip('\n').split(FIELD_SEPARATOR)
+                    header = (sha, int(author_epoch), int(committer_epoch), author_name, author_email)
+                    additions = deletions = 0
+                elif line.strip():
+                    # <added>\t<deleted>\t<path>, binary files show "-"
+                    (added, deleted, _) = line.split('\t', 2)
+                    if added != '-':
+                        additions += int(added)
+                        deletions += int(deleted)
+            if header:
+                yield GitCommit(*header, additions, deletions)
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    def count_tags(self, clone_path: str):
+        return len(self._git('--git-dir', clone_path, 'tag', '--list').split())
+
+    # Weekly churn, weekly commits and authors of a repo in one pass over its log.
+    # `week_windows` are DevOracle's naive UTC (date_since, date_until) pairs, oldest first.
+    def get_repo_stats(self, org_then_slash_then_repo: str, week_windows: List[tuple]):
+        clone_path = self.sync(org_then_slash_then_repo)
+        if clone_path is None:
+            return None
+        window_starts = [date_since for (date_since, _) in week_windows]
+        commit_counts = [0] * len(week_windows)
+        # week start epoch -> [additions, deletions]
+        code_frequency = {}
+        authors = set()
+        # 'YYYY-MM' -> authors of the commits in the week windows, like the API crawl
+        monthly_author_sketches = {}
+        for commit in self.iter_commits(clone_path, numstat=not self.blobless):
+            week = code_frequency.setdefault(get_code_frequency_week(commit.author_epoch), [0, 0])
+            week[0] += commit.additions
+            week[1] += commit.deletions
+            # All time, like the contributor statistics
+            authors.add(get_author_identity(commit))
+            # The commits API filters since/until on the committer date
+            committed_at = dt.datetime.utcfromtimestamp(commit.committer_epoch)
+            index = bisect_right(window_starts, committed_at) - 1
+            if index >= 0 and committed_at <= week_windows[index][1]:
+                commit_counts[index] += 1
+            if index >= 0:
+                month = dt.datetime.utcfromtimestamp(commit.author_epoch).strftime('%Y-%m')
+                monthly_author_sketches.setdefault(month, HyperLogLog()).add(get_author_identity(commit))
+        return {
+            # [<Week In UNIX Timestamp>, <additions>, <deletions with neg symbol>], every week since the first commit
+            'code_frequency': [[week, code_frequency.get(week, [0, 0])[0], -code_frequency.get(week, [0, 0])[1]]
+                               for week in range(min(code_frequency), max(code_frequency) + 1, SECONDS_PER_WEEK)]
+            if code_frequency else [],
+            'weekly_commit_counts': commit_counts,
+            'authors': sorted(authors),
+            'monthly_author_sketches': monthly_author_sketches,
+            'tags': self.count_tags(clone_path)
+        }
+
+    # contr.py's per-repo activity aggregate, {author: {'YYYY-MM-DD': [first epoch, last epoch]}},
+    # with authors identified by email since logins are unknown to git
+    def get_activity(self, org_then_slash_then_repo: str, since_epoch: int = None):
+        clone_path = self.sync(org_then_slash_then_repo)
+        if clone_path is None:
+            return {}
+        activity = {}
+        for commit in self.iter_commits(clone_path, since_epoch, numstat=False):
+            days = activity.setdefault(get_author_identity(commit), {})
+            day = dt.datetime.utcfromtimestamp(commit.author_epoch).strftime('%Y-%m-%d')
+            if day in days:
+                days[day] = [min(days[day][0], commit.author_epoch), max(days[day][1], commit.author_epoch)]
+            else:
+                days[day] = [commit.author_epoch, commit.author_epoch]
+        return activity
+
+
+def get_author_identity(commit: GitCommit):
+    return (commit.author_email or commit.author_name).lower()
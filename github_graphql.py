@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+from typing import List, Dict
+
+from github_http import github_post, GITHUB_API_URL
+
+LOGGER = logging.getLogger(__name__)
+
+GRAPHQL_URL = GITHUB_API_URL + '/graphql'
+GRAPHQL_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# Each repo asks for one history total per week, keep batches small enough to not time out
+DEFAULT_BATCH_SIZE = 10
+
+
+# One aliased `repository` field per repo. The week windows become aliased
+# default branch `history(since, until) { totalCount }` fields.
+def build_repo_metadata_query(repo_names: List[str], week_windows: List[tuple]) -> str:
+    history_fields = ' '.join(
+        'w{0}: history(since: {1}, until: {2}) {{ totalCount }}'.format(
+            index,
+            json.dumps(date_since.strftime(GRAPHQL_DATE_FORMAT)),
+            json.dumps(date_until.strftime(GRAPHQL_DATE_FORMAT)))
+        for (index, (date_since, date_until)) in enumerate(week_windows))
+    repo_fields = []
+    for (index, org_then_slash_then_repo) in enumerate(repo_names):
+        (owner, name) = org_then_slash_then_repo.split('/')
+        repo_fields.append(
+            'r{0}: repository(owner: {1}, name: {2}) {{ '
+            'stargazerCount forkCount releases {{ totalCount }} '
+            'defaultBranchRef {{ target {{ ... on Commit {{ {3} }} }} }} }}'.format(
+                index, json.dumps(owner), json.dumps(name), history_fields))
+    return 'query { ' + ' '.join(repo_fields) + ' }'
+
+
+# Metadata of many repos in one aliased GraphQL query per batch, in the shape of
+# DevOracle's repo_data: `repo` (stargazers/forks), `releases` and `weekly_commits`.
+# `week_windows` are (date_since, date_until) pairs, oldest week first.
+# Repos missing from the result (not found, errors) are fetched over REST by the caller.
+def fetch_repo_metadata(pat: str, repo_names: List[str], week_windows: List[tuple],
+                        batch_size: int = DEFAULT_BATCH_SIZE) -> Dict[str, dict]:
+    metadata = {}
+    batches = [repo_names[i:i + batch_size] for i in range(0, len(repo_names), batch_size)]
+    while batches:
+        batch = batches.pop(0)
+        r = github_post(GRAPHQL_URL, pat, {'query': build_repo_metadata_query(batch, week_windows)})
+        if r.status_code != 200:
+            # Big histories can time out server side, retry as two smaller batches
+            if len(batch) > 1 and r.status_code // 100 == 5:
+                middle = len(batch) // 2
+                batches[0:0] = [batch[:middle], batch[middle:]]
+                continue
+            LOGGER.error("GraphQL error code: %d %s", r.status_code, r.text)
+            continue
+        data = r.json().get('data') or {}
+        for (index, org_then_slash_then_repo) in enumerate(batch):
+            repo = data.get('r' + str(index))
+            if not repo:
+                continue
+            history = (repo['defaultBranchRef'] or {}).get('target') or {}
+            metadata[org_then_slash_then_repo] = {
+                'repo': {
+                    'stargazers_count': repo['stargazerCount'],
+                    'forks_count': repo['forkCount']
+                },
+                'releases': repo['releases']['totalCount'],
+                'weekly_commits': [{
+                    'start_date': date_since.strftime(GRAPHQL_DATE_FORMAT),
+                    'end_date': date_until.strftime(GRAPHQL_DATE_FORMAT),
+                    'commits': (history.get('w' + str(week_index)) or {}).get('totalCount', 0)
+                } for (week_index, (date_since, date_until)) in enumerate(week_windows)]
+            }
+    return metadata
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from os import path
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from github import Requester
+from requests.structures import CaseInsensitiveDict
+
+from config import get_http_cache_dir, get_http_cache_max_bytes, get_http_cache_max_age_secs, is_http_cache_enabled, \
+    get_github_api_url
+
+GITHUB_API_URL = get_github_api_url()
+
+# Response headers worth keeping next to a cached body, the rest are request specific
+CACHED_HEADERS = ('content-type', 'link', 'etag', 'last-modified')
+# Run a full eviction pass every n writes instead of on every write
+EVICTION_INTERVAL_WRITES = 200
+
+
+# Subset of requests.Response used by the fetchers, shared by the sync and async code paths
+class CachedResponse:
+    def __init__(self, status_code: int, headers, content: bytes, reason: str = '', from_cache: bool = False):
+        self.status_code = status_code
+        self.status = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.reason = reason
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+# Persistent on-disk cache of GitHub GET responses keyed by URL and token scope.
+# Entries are revalidated with If-None-Match/If-Modified-Since, and GitHub does not
+# count a 304 against the rate limit. File mtimes double as the LRU clock.
+class ResponseCache:
+    def __init__(self, cache_dir: str, max_bytes: int, max_age_secs: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_secs = max_age_secs
+        self._lock = threading.Lock()
+        self._writes_since_eviction = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.evict()
+
+    # Tokens can see different data (private repos), so the token is part of the key.
+    # Only a hash of it ever reaches the disk.
+    @staticmethod
+    def _key(url: str, pat: str):
+        token_scope = hashlib.sha256((pat or '').encode('utf-8')).hexdigest()
+        return hashlib.sha256((token_scope + '\n' + url).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, url: str, pat: str):
+        key = self._key(url, pat)
+        return path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get_entry(self, url: str, pat: str):
+        entry_path = self._entry_path(url, pat)
+        try:
+            with open(entry_path, 'r') as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['stored_at'] > self.max_age_secs:
+            self._remove(entry_path)
+            return None
+        return entry
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url: str, pat: str, status_code: int, headers, content: bytes):
+        headers = CaseInsensitiveDict(headers)
+        etag = headers.get('etag')
+        last_modified = headers.get('last-modified')
+        # Nothing to revalidate with
+        if status_code != 200 or not (etag or last_modified):
+            return
+        entry = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'headers': {name: headers[name] for name in CACHED_HEADERS if name in headers},
+            'body': content.decode('utf-8', errors='replace'),
+            'stored_at': time.time()
+        }
+        entry_path = self._entry_path(url, pat)
+        os.makedirs(path.dirname(entry_path), exist_ok=True)
+        tmp_path = entry_path + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_path, 'w') as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(tmp_path, entry_path)
+
+        with self._lock:
+            self._writes_since_eviction += 1
+            run_eviction = self._writes_since_eviction >= EVICTION_INTERVAL_WRITES
+            if run_eviction:
+                self._writes_since_eviction = 0
+        if run_eviction:
+            self.evict()
+
+    # A 304 means the cached body is still current: refresh the entry age and LRU position
+    def revalidated(self, url: str, pat: str, entry, headers):
+        entry['stored_at'] = time.time()
+        entry_path = self._entry_path(url, pat)
+        tmp_path = entry_path + '.' + str(threading.get_ident()) + '.tmp'
+        try:
+            with open(tmp_path, 'w') as entry_file:
+                json.dump(entry, entry_file)
+            os.replace(tmp_path, entry_path)
+        except OSError:
+            pass
+        # Rate limit headers of the 304 are the current ones
+        merged_headers = CaseInsensitiveDict(entry['headers'])
+        for name, value in headers.items():
+            if name.lower().startswith('x-ratelimit') or name.lower() == 'etag':
+                merged_headers[name] = value
+        return CachedResponse(200, merged_headers, entry['body'].encode('utf-8'), reason='OK', from_cache=True)
+
+    @staticmethod
+    def _remove(entry_path):
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+
+    # Drop entries older than max_age, then least recently used ones until under max_bytes
+    def evict(self):
+        now = time.time()
+        entries = []
+        total_bytes = 0
+        for (dir_name, _, file_names) in os.walk(self.cache_dir):
+            for file_name in file_names:
+                entry_path = path.join(dir_name, file_name)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > self.max_age_secs:
+                    self._remove(entry_path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total_bytes += stat.st_size
+        if total_bytes <= self.max_bytes:
+            return
+        entries.sort()
+        for (_, size, entry_path) in entries:
+            self._remove(entry_path)
+            total_bytes -= size
+            if total_bytes <= self.max_bytes:
+                break
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+# Callables of (pat, url, status_code, headers, elapsed_secs), called for every response from GitHub
+_response_observers = []
+
+
+def add_response_observer(observer):
+    _response_observers.append(observer)
+
+
+def _notify_response_observers(pat, url, status_code, headers, elapsed_secs):
+    for observer in _response_observers:
+        observer(pat, url, status_code, headers, elapsed_secs)
+
+
+# PyGithub sends its requests itself (including the lazy attribute completions), wrap its
+# connection classes so they reach the observers too
+def observe_pygithub_requests():
+    if getattr(Requester.Requester, '_observed_by_github_http', False):
+        return
+    Requester.Requester.injectConnectionClasses(ObservedHTTPConnection, ObservedHTTPSConnection)
+    Requester.Requester._observed_by_github_http = True
+
+
+class _ObservedConnection:
+    def getresponse(self):
+        started_at = time.time()
+        response = super().getresponse()
+        authorization = (self.headers or {}).get('Authorization') or ''
+        pat = authorization.split(' ', 1)[1] if ' ' in authorization else None
+        _notify_response_observers(pat, '%s://%s:%s%s' % (self.protocol, self.host, self.port, self.url),
+                                   response.status, CaseInsensitiveDict(response.getheaders()),
+                                   time.time() - started_at)
+        return response
+
+
+# Module level, so the Github objects holding them can be pickled for joblib workers
+class ObservedHTTPConnection(_ObservedConnection, Requester.HTTPRequestsConnectionClass):
+    pass
+
+
+class ObservedHTTPSConnection(_ObservedConnection, Requester.HTTPSRequestsConnectionClass):
+    pass
+
+
+def get_response_cache():
+    global _response_cache
+    if not is_http_cache_enabled():
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                get_http_cache_dir(), get_http_cache_max_bytes(), get_http_cache_max_age_secs())
+    return _response_cache
+
+
+# Parse the page number of the rel="last" link, regardless of the query param order
+def get_last_page_from_link_header(pages_link):
+    for link in pages_link.split(","):
+        re_match = re.search('<(.*)>; rel="last"', link)
+        if re_match:
+            page = parse_qs(urlparse(re_match.group(1)).query).get('page')
+            if page:
+                return int(page[0])
+    return None
+
+
+def _auth_headers(pat):
+    return {'Authorization': 'Token ' + pat} if pat else {}
+
+
+# GET a GitHub API URL through the response cache
+def github_get(url: str, pat: str, session=None) -> CachedResponse:
+    cache = get_response_cache()
+    entry = cache.get_entry(url, pat) if cache else None
+    headers = _auth_headers(pat)
+    headers.update(ResponseCache.conditional_headers(entry))
+
+    started_at = time.time()
+    r = (session or requests).get(url, headers=headers)
+    _notify_response_observers(pat, url, r.status_code, r.headers, time.time() - started_at)
+    if r.status_code == 304 and entry is not None:
+        # Touch the entry so it stays at the young end of the LRU order
+        return cache.revalidated(url, pat, entry, r.headers)
+    if cache:
+        cache.store(url, pat, r.status_code, r.headers, r.content)
+    return CachedResponse(r.status_code, r.headers, r.content, reason=r.reason)
+
+
+# aiohttp counterpart of github_get
+async def github_get_async(session, url: str, pat: str) -> CachedResponse:
+    cache = get_response_cache()
+    entry = cache.get_entry(url, pat) if cache else None
+    headers = _auth_headers(pat)
+    headers.update(ResponseCache.conditional_headers(entry))
+
+    started_at = time.time()
+    async with session.get(url=url, headers=headers) as r:
+        content = await r.read()
+        response_headers = CaseInsensitiveDict(r.headers)
+        _notify_response_observers(pat, url, r.status, response_headers, time.time() - started_at)
+        if r.status == 304 and entry is not None:
+            return cache.revalidated(url, pat, entry, response_headers)
+        if cache:
+            cache.store(url, pat, r.status, response_headers, content)
+        return CachedResponse(r.status, response_headers, content, reason=r.reason or '')
+
+
+# POST a JSON payload (GraphQL queries), never cached
+def github_post(url: str, pat: str, payload: dict, session=None) -> CachedResponse:
+    started_at = time.time()
+    r = (session or requests).post(url, headers=_auth_headers(pat), json=payload)
+    _notify_response_observers(pat, url, r.status_code, r.headers, time.time() - started_at)
+    return CachedResponse(r.status_code, r.headers, r.content, reason=r.reason)
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+import json
+import optparse
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+GITHUB_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+SECONDS_PER_WEEK = 7 * 24 * 60 * 60
+# Unauthenticated requests get the anonymous hourly budget, like on GitHub
+ANONYMOUS_RATE_LIMIT = 60
+MAX_PER_PAGE = 100
+DEFAULT_PER_PAGE = 30
+
+'''
+Offline stand-in for the GitHub REST API, for benchmarks and dry runs without tokens.
+Set `api_url` in the [github] section of config.ini to the URL it prints.
+
+Serves synthetic orgs `sim-org-<n>` with repos `repo-<n>` (the first `forks_per_org` of
+each org are forks) and commit histories spread over `history_days`, with:
+  - Link rel="next"/"last" pagination, per_page capped at 100
+  - X-RateLimit-* headers and 403s once a token's hourly budget is used up
+  - 202 on the statistics endpoints for the first `stats_pending_polls` requests per repo
+  - 403 with Retry-After when a token has more than `secondary_limit_concurrency` requests in flight
+  - `latency_secs` of latency per request
+GET /_simulator/stats returns the request counters, POST /_simulator/reset clears them.
+'''
+
+
+class SimulatorConfig:
+    def __init__(self, orgs: int = 2, repos_per_org: int = 5, forks_per_org: int = 1,
+                 commits_per_repo: int = 2000, authors: int = 200, authors_per_repo: int = 25,
+                 releases_per_repo: int = 3, history_days: int = 2 * 365, stats_pending_polls: int = 1,
+                 rate_limit: int = 5000, secondary_limit_concurrency: int = 40,
+                 secondary_retry_after_secs: int = 1, latency_secs: float = 0.02, seed: int = 0):
+        self.orgs = orgs
+        self.repos_per_org = repos_per_org
+        self.forks_per_org = forks_per_org
+        self.commits_per_repo = commits_per_repo
+        self.authors = authors
+        self.authors_per_repo = authors_per_repo
+        self.releases_per_repo = releases_per_repo
+        self.history_days = history_days
+        self.stats_pending_polls = stats_pending_polls
+        self.rate_limit = rate_limit
+        self.secondary_limit_concurrency = secondary_limit_concurrency
+        self.secondary_retry_after_secs = secondary_retry_after_secs
+        self.latency_secs = latency_secs
+        self.seed = seed
+
+
+def get_org_names(config: SimulatorConfig):
+    return ['sim-org-%d' % index for index in range(config.orgs)]
+
+
+# Synthetic orgs, repos and commits. Commit histories are generated on first use and kept.
+class SimulatedGithub:
+    def __init__(self, config: SimulatorConfig, base_url: str):
+        self.config = config
+        self.base_url = base_url
+        self.now = int(time.time())
+        self._lock = threading.Lock()
+        # org/repo -> commits, newest first
+        self._commits = {}
+
+    def has_org(self, org: str):
+        return org in get_org_names(self.config)
+
+    def get_repo_names(self, org: str):
+        return ['%s/repo-%d' % (org, index) for index in range(self.config.repos_per_org)]
+
+    def has_repo(self, org_then_slash_then_repo: str):
+        parts = org_then_slash_then_repo.split('/')
+        return len(parts) == 2 and self.has_org(parts[0]) and org_then_slash_then_repo in self.get_repo_names(parts[0])
+
+    def get_repo(self, org_then_slash_then_repo: str):
+        (org, name) = org_then_slash_then_repo.split('/')
+        index = int(name.split('-')[1])
+        rng = random.Random('%d:%s' % (self.config.seed, org_then_slash_then_repo))
+        return {
+            'id': zlib.crc32(org_then_slash_then_repo.encode('utf-8')),
+            'name': name,
+            'full_name': org_then_slash_then_repo,
+            'owner': {'login': org, 'type': 'Organization'},
+            'url': self.base_url + '/repos/' + org_then_slash_then_repo,
+            'fork': index < self.config.forks_per_org,
+            'archived': False,
+            'pushed_at': time.strftime(GITHUB_DATE_FORMAT, time.gmtime(self.now - rng.randint(0, 30 * 86400))),
+            'size': rng.randint(100, 100000),
+            'stargazers_count': rng.randint(0, 5000),
+            'forks_count': rng.randint(0, 1000),
+            'default_branch': 'main'
+        }
+
+    def get_commits(self, org_then_slash_then_repo: str):
+        with self._lock:
+            commits = self._commits.get(org_then_slash_then_repo)
+            if commits is not None:
+                return commits
+            rng = random.Random('%d:%s:commits' % (self.config.seed, org_then_slash_then_repo))
+            author_ids = rng.sample(range(self.config.authors), min(self.config.authors_per_repo, self.config.authors))
+            history_secs = self.config.history_days * 86400
+            epochs = sorted((self.now - rng.randint(0, history_secs) for _ in range(self.config.commits_per_repo)),
+                            reverse=True)
+            commits = []
+            for (index, epoch) in enumerate(epochs):
+                author_id = rng.choice(author_ids)
+                date = time.strftime(GITHUB_DATE_FORMAT, time.gmtime(epoch))
+                # Some commits have no GitHub account behind them
+                user = None if rng.random() < 0.1 else {'login': 'dev-%d' % author_id, 'id': 1000 + author_id}
+                git_author = {'name': 'Dev %d' % author_id, 'email': 'dev-%d@example.com' % author_id, 'date': date}
+                commits.append({
+                    'sha': '%040x' % rng.getrandbits(160),
+                    'epoch': epoch,
+                    'commit': {'author': git_author, 'committer': dict(git_author), 'message': 'Commit %d' % index},
+                    'author': user,
+                    'committer': user,
+                    'stats': {'additions': rng.randint(0, 200), 'deletions': rng.randint(0, 100)}
+                })
+            self._commits[org_then_slash_then_repo] = commits
+            return commits
+
+    def _week_start(self, epoch: int):
+        return epoch - (epoch - 3 * 86400) % SECONDS_PER_WEEK
+
+    def get_code_frequency(self, org_then_slash_then_repo: str):
+        weeks = {}
+        for commit in self.get_commits(org_then_slash_then_repo):
+            week = weeks.setdefault(self._week_start(commit['epoch']), [0, 0])
+            week[0] += commit['stats']['additions']
+            week[1] += commit['stats']['deletions']
+        return [[week, additions, -deletions] for (week, (additions, deletions)) in sorted(weeks.items())]
+
+    def get_contributor_stats(self, org_then_slash_then_repo: str):
+        contributors = {}
+        for commit in self.get_commits(org_then_slash_then_repo):
+            if not commit['author']:
+                continue
+            contributor = contributors.setdefault(commit['author']['login'], {
+                'author': commit['author'], 'total': 0, 'weeks': {}})
+            contributor['total'] += 1
+            week = contributor['weeks'].setdefault(self._week_start(commit['epoch']), {'a': 0, 'd': 0, 'c': 0})
+            week['a'] += commit['stats']['additions']
+            week['d'] += commit['stats']['deletions']
+            week['c'] += 1
+        return [{'author': contributor['author'], 'total': contributor['total'],
+                 'weeks': [dict(w=week, **counts) for (week, counts) in sorted(contributor['weeks'].items())]}
+                for contributor in contributors.values()]
+
+    def get_releases(self, org_then_slash_then_repo: str):
+        return [{'id': index, 'tag_name': 'v0.%d.0' % index, 'name': 'Release %d' % index}
+                for index in range(self.config.releases_per_repo)]
+
+
+class SimulatorStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.requests_by_endpoint = {}
+            self.responses_by_status = {}
+            self.secondary_limited = 0
+            self.rate_limited = 0
+            self.peak_in_flight = 0
+            self.in_flight_by_token = {}
+            self.in_flight = 0
+            self.remaining_by_token = {}
+            self.reset_epoch = int(time.time()) + 3600
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'requests_by_endpoint': dict(self.requests_by_endpoint),
+                'responses_by_status': {str(status): count for (status, count) in self.responses_by_status.items()},
+                'secondary_limited': self.secondary_limited,
+                'rate_limited': self.rate_limited,
+                'peak_in_flight': self.peak_in_flight
+            }
+
+
+# (pattern, endpoint name), the name labels the request counters
+ROUTES = [
+    (re.compile(r'^/rate_limit$'), 'rate_limit'),
+    (re.compile(r'^/orgs/([^/]+)$'), 'org'),
+    (re.compile(r'^/(?:orgs|users)/([^/]+)/repos$'), 'listing'),
+    (re.compile(r'^/users/([^/]+)$'), 'user'),
+    (re.compile(r'^/repos/([^/]+/[^/]+)$'), 'repo'),
+    (re.compile(r'^/repos/([^/]+/[^/]+)/commits$'), 'commits'),
+    (re.compile(r'^/repos/([^/]+/[^/]+)/stats/(code_frequency|contributors)$'), 'stats'),
+    (re.compile(r'^/repos/([^/]+/[^/]+)/releases$'), 'releases'),
+]
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    # Set on the subclass made by make_server
+    github = None
+    stats = None
+    # (org/repo, endpoint) -> statistics requests so far
+    stats_polls = None
+    stats_polls_lock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body, headers: dict = None):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        if self.path == '/_simulator/reset':
+            self.stats.reset()
+            with self.stats_polls_lock:
+                self.stats_polls.clear()
+            return self._send(200, {})
+        self._send(404, {'message': 'Not Found'})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/_simulator/stats':
+            return self._send(200, self.stats.to_dict())
+        authorization = self.headers.get('Authorization') or ''
+        token = authorization.split(' ', 1)[1] if ' ' in authorization else None
+        (route, match) = next(((name, pattern.match(url.path)) for (pattern, name) in ROUTES
+                               if pattern.match(url.path)), ('other', None))
+
+        stats = self.stats
+        with stats._lock:
+            stats.requests += 1
+            stats.requests_by_endpoint[route] = stats.requests_by_endpoint.get(route, 0) + 1
+            stats.in_flight += 1
+            stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+            in_flight = stats.in_flight_by_token[token] = stats.in_flight_by_token.get(token, 0) + 1
+            limit = self.github.config.rate_limit if token else ANONYMOUS_RATE_LIMIT
+            # The rate limit endpoint itself is free
+            remaining = stats.remaining_by_token.get(token, limit)
+            if route != 'rate_limit' and remaining > 0:
+                remaining -= 1
+                stats.remaining_by_token[token] = remaining
+            rate_headers = {
+                'X-RateLimit-Limit': str(limit),
+                'X-RateLimit-Remaining': str(remaining),
+                'X-RateLimit-Reset': str(stats.reset_epoch),
+                'X-RateLimit-Used': str(limit - remaining),
+                'X-RateLimit-Resource': 'core'
+            }
+        try:
+            time.sleep(self.github.config.latency_secs)
+            (status, body, headers) = self._respond(route, match, url, token, remaining, in_flight, rate_headers)
+        finally:
+            with stats._lock:
+                stats.in_flight -= 1
+                stats.in_flight_by_token[token] -= 1
+        with stats._lock:
+            stats.responses_by_status[status] = stats.responses_by_status.get(status, 0) + 1
+            if status == 403 and 'Retry-After' in headers:
+                stats.secondary_limited += 1
+            elif status == 403:
+                stats.rate_limited += 1
+        self._send(status, body, headers)
+
+    def _respond(self, route, match, url, token, remaining, in_flight, rate_headers):
+        config = self.github.config
+        if route == 'rate_limit':
+            core = {'limit': int(rate_headers['X-RateLimit-Limit']), 'remaining': remaining,
+                    'reset': int(rate_headers['X-RateLimit-Reset']), 'used': int(rate_headers['X-RateLimit-Used'])}
+            return 200, {'resources': {'core': core, 'search': core, 'graphql': core}, 'rate': core}, rate_headers
+        if remaining <= 0:
+            return 403, {'message': 'API rate limit exceeded'}, rate_headers
+        if config.secondary_limit_concurrency and in_flight > config.secondary_limit_concurrency:
+            headers = dict(rate_headers, **{'Retry-After': str(config.secondary_retry_after_secs)})
+            return 403, {'message': 'You have exceeded a secondary rate limit'}, headers
+
+        query = parse_qs(url.query)
+        github = self.github
+        if route in ('org', 'user') and github.has_org(match.group(1)):
+            return 200, {'login': match.group(1), 'type': 'Organization'}, rate_headers
+        if route == 'listing' and github.has_org(match.group(1)):
+            repos = [github.get_repo(name) for name in github.get_repo_names(match.group(1))]
+            if query.get('type') == ['forks']:
+                repos = [repo for repo in repos if repo['fork']]
+            return self._paginate(url, query, repos, rate_headers)
+        if route in ('repo', 'commits', 'stats', 'releases') and github.has_repo(match.group(1)):
+            org_then_slash_then_repo = match.group(1)
+            if route == 'repo':
+                return 200, github.get_repo(org_then_slash_then_repo), rate_headers
+            if route == 'releases':
+                return self._paginate(url, query, github.get_releases(org_then_slash_then_repo), rate_headers)
+            if route == 'stats':
+                return self._respond_stats(org_then_slash_then_repo, match.group(2), rate_headers)
+            commits = github.get_commits(org_then_slash_then_repo)
+            if 'since' in query:
+                commits = [commit for commit in commits if commit['commit']['committer']['date'] >= query['since'][0]]
+            if 'until' in query:
+                commits = [commit for commit in commits if commit['commit']['committer']['date'] <= query['until'][0]]
+            commits = [{key: value for (key, value) in commit.items() if key not in ('epoch', 'stats')}
+                       for commit in commits]
+            return self._paginate(url, query, commits, rate_headers)
+        return 404, {'message': 'Not Found'}, rate_headers
+
+    def _respond_stats(self, org_then_slash_then_repo: str, endpoint: str, rate_headers):
+        key = (org_then_slash_then_repo, endpoint)
+        with self.stats_polls_lock:
+            polls = self.stats_polls[key] = self.stats_polls.get(key, 0) + 1
+        if polls <= self.github.config.stats_pending_polls:
+            return 202, {}, rate_headers
+        if endpoint == 'code_frequency':
+            return 200, self.github.get_code_frequency(org_then_slash_then_repo), rate_headers
+        return 200, self.github.get_contributor_stats(org_then_slash_then_repo), rate_headers
+
+    def _paginate(self, url, query, items, rate_headers):
+        per_page = min(int(query.get('per_page', [DEFAULT_PER_PAGE])[0]), MAX_PER_PAGE)
+        page = int(query.get('page', ['1'])[0])
+        last_page = max(1, -(-len(items) // per_page))
+        headers = dict(rate_headers)
+        if last_page > 1:
+            links = []
+
+            def page_url(number):
+                page_query = dict(query, page=[str(number)], per_page=[str(per_page)])
+                return self.github.base_url + url.path + '?' + '&'.join(
+                    '%s=%s' % (name, values[0]) for (name, values) in page_query.items())
+            if page < last_page:
+                links.append('<%s>; rel="next"' % page_url(page + 1))
+            links.append('<%s>; rel="last"' % page_url(last_page))
+            headers['Link'] = ', '.join(links)
+        return 200, items[(page - 1) * per_page:page * per_page], headers
+
+
+def make_server(config: SimulatorConfig, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    handler = type('BoundSimulatorHandler', (SimulatorHandler,), {
+        'stats': SimulatorStats(),
+        'stats_polls': {},
+        'stats_polls_lock': threading.Lock()
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    handler.github = SimulatedGithub(config, 'http://%s:%d' % (host, server.server_address[1]))
+    return server
+
+
+if __name__ == '__main__':
+    p = optparse.OptionParser(usage='python3 github_simulator.py [options]')
+    p.add_option('--port', type='int', dest='port', default=8000)
+    p.add_option('--orgs', type='int', dest='orgs', default=2)
+    p.add_option('--repos-per-org', type='int', dest='repos_per_org', default=5)
+    p.add_option('--forks-per-org', type='int', dest='forks_per_org', default=1)
+    p.add_option('--commits-per-repo', type='int', dest='commits_per_repo', default=2000)
+    p.add_option('--authors', type='int', dest='authors', default=200)
+    p.add_option('--authors-per-repo', type='int', dest='authors_per_repo', default=25)
+    p.add_option('--stats-pending-polls', type='int', dest='stats_pending_polls', default=1,
+                 help='Statistics requests per repo answered with 202')
+    p.add_option('--rate-limit', type='int', dest='rate_limit', default=5000,
+                 help='Hourly requests per token')
+    p.add_option('--secondary-limit-concurrency', type='int', dest='secondary_limit_concurrency', default=40,
+                 help='Requests in flight per token before 403 with Retry-After, 0 for no limit')
+    p.add_option('--latency-ms', type='int', dest='latency_ms', default=20)
+    p.add_option('--seed', type='int', dest='seed', default=0)
+    options, arguments = p.parse_args()
+
+    simulator_config = SimulatorConfig(
+        orgs=options.orgs, repos_per_org=options.repos_per_org, forks_per_org=options.forks_per_org,
+        commits_per_repo=options.commits_per_repo, authors=options.authors,
+        authors_per_repo=options.authors_per_repo, stats_pending_polls=options.stats_pending_polls,
+        rate_limit=options.rate_limit, secondary_limit_concurrency=options.secondary_limit_concurrency,
+        latency_secs=options.latency_ms / 1000.0, seed=options.seed)
+    simulator = make_server(simulator_config, port=options.port)
+    # Printed for the benchmark, which starts the simulator in its own process
+    print(simulator.RequestHandlerClass.github.base_url, flush=True)
+    print('Orgs:', ' '.join(get_org_names(simulator_config)), flush=True)
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
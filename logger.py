@@ -1,20 +1,38 @@
+import atexit
+import logging
+import logging.handlers
+import queue
 import sys
 
+from config import get_log_file, get_log_level, get_log_max_bytes, get_log_backup_count
 
-class Logger(object):
-    def __init__(self):
-        self.terminal = sys.stdout
-        self.log = open("logfile.log", "a")
+# The terminal shows messages as they were printed, the log file adds when and where
+TERMINAL_FORMAT = '%(message)s'
+FILE_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
 
-    def write(self, message):
-        self.terminal.write(message)
-        self.log.write(message)
+_listener = None
 
-    def flush(self):
-        # this flush method is needed for python 3 compatibility.
-        # this handles the flush command by doing nothing.
-        # you might want to specify some extra behavior here.
-        pass
 
+# Log records go to an unbounded queue, a put that never blocks the caller (or the event loop).
+# A background thread writes them to the terminal and to the rotating log file.
+def setup_logging():
+    global _listener
+    if _listener is not None:
+        return
+    terminal_handler = logging.StreamHandler(sys.stdout)
+    terminal_handler.setFormatter(logging.Formatter(TERMINAL_FORMAT))
+    # Opened on the first record, processes that log nothing (joblib workers) don't touch it
+    file_handler = logging.handlers.RotatingFileHandler(
+        get_log_file(), maxBytes=get_log_max_bytes(), backupCount=get_log_backup_count(), delay=True)
+    file_handler.setFormatter(logging.Formatter(FILE_FORMAT))
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, terminal_handler, file_handler)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(get_log_level())
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener.start()
+    # Registered before the scripts' own exit hooks, so it runs after them and writes their last records
+    atexit.register(_listener.stop)
 
-sys.stdout = Logger()
+
+setup_logging()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import optparse
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from typing import List
+
+from aimd import AimdConcurrencyController
+from config import get_chain_names, get_pats
+from contr import Contributors
+from dev import DevOracle
+from get_contributors import RepoStats
+from gitTokenHelper import GithubTokenPool
+from logger import sys
+from org_inventory import OrgInventory
+from repo_stats_cache import get_repo_stats_cache
+from request_metrics import install_request_metrics, set_request_chain
+from stage_profiler import enable_stage_profiling, profile_stage
+
+LOGGER = logging.getLogger(__name__)
+
+# dev: dev.py stats and history, contr: contr.py monthly contributors, commits: get_contributors.py commit records
+TASKS = ('dev', 'contr', 'commits')
+DEFAULT_CONCURRENCY = 8
+
+# `repo` is None for the item listing the repos of the chain
+WorkItem = namedtuple('WorkItem', ['chain', 'repo', 'task'])
+
+'''
+FLOW
+run -> one listing WorkItem per (chain, task) -> _list_repos queues one WorkItem per repo
+    -> _run_repo_item (once per repo across chains) -> _complete for every chain listing it
+    -> once all repos of a (chain, task) are done: _save_job
+All items of all chains share one queue, one token pool and `concurrency` worker threads.
+A repo's result is dropped once every chain listing it has consumed it, and a chain's
+results once its output is saved, so memory doesn't grow with the whole ecosystem.
+'''
+
+
+# State of one (chain, task): its repos and their results so far
+class ChainTaskJob:
+    def __init__(self, chain: str, task: str):
+        self.chain = chain
+        self.task = task
+        # dev: [(org, [org/repo, ...]), ...], the stats are combined per org
+        self.orgs = []
+        self.repos = []
+        self.pending = set()
+        self.results = {}
+        # contr: progress journal, repos analysed by an earlier run are not queued again
+        self.journal = None
+        self.failed = False
+        self.saved = False
+
+
+# Runs dev.py, contr.py and get_contributors.py for many chains at once. The repos of all
+# chains go through one work queue, so tokens are validated once and the chains share the
+# token budget and `concurrency`. The output of a chain is written as soon as its repos are done.
+class Orchestrator:
+    def __init__(self, save_path: str, tasks: List[str] = TASKS, years_count: int = 1, frequency: int = 4,
+                 concurrency: int = DEFAULT_CONCURRENCY, source: str = 'api', token_pool: GithubTokenPool = None):
+        for task in tasks:
+            if task not in TASKS:
+                raise Exception("tasks must be some of " + ", ".join(TASKS))
+        self.save_path = save_path
+        self.tasks = tasks
+        self.years_count = years_count
+        self.frequency = frequency
+        self.concurrency = concurrency
+        self.source = source
+        self.token_pool = token_pool or GithubTokenPool(get_pats())
+        self.work_queue = queue.Queue()
+        self.jobs = {}
+        # (task, org/repo, years) -> Future of the repo's result, shared by all chains listing the repo
+        self.repo_results = {}
+        # (task, org/repo, years) -> chains that queued the repo and didn't consume its result yet
+        self.repo_result_users = {}
+        # Chains still being listed may queue a repo whose result has no users left
+        self.unlisted_job_count = 0
+        self.shared_repo_count = 0
+        self.lock = threading.Lock()
+        # Each worker thread has its own DevOracle, Contributors and RepoStats, they hold a leased token
+        self.local = threading.local()
+        # Orgs listed by several tasks or chains are listed once
+        self.org_inventory = OrgInventory(self.token_pool)
+        # Commit pages in flight of all the workers' Contributors together
+        self.commit_page_concurrency = AimdConcurrencyController()
+
+    # Returns the (chain, task) pairs that failed
+    @profile_stage
+    def run(self, chains: List[str]):
+        for chain in chains:
+            for task in self.tasks:
+                self.jobs[(chain, task)] = ChainTaskJob(chain, task)
+        self.unlisted_job_count = len(self.jobs)
+        for job in self.jobs.values():
+            self.work_queue.put(WorkItem(job.chain, None, job.task))
+        workers = [threading.Thread(target=self._work, daemon=True) for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        self.work_queue.join()
+        for _ in workers:
+            self.work_queue.put(None)
+        for worker in workers:
+            worker.join()
+        get_repo_stats_cache().wait()
+        LOGGER.info('%d repo results were shared between chains instead of fetched again', self.shared_repo_count)
+        return [(job.chain, job.task) for job in self.jobs.values() if job.failed]
+
+    def _work(self):
+        while True:
+            item = self.work_queue.get()
+            if item is None:
+                self.work_queue.task_done()
+                return
+            job = self.jobs[(item.chain, item.task)]
+            set_request_chain(item.chain)
+            try:
+                if job.failed:
+                    if item.repo is None:
+                        self._finish_listing()
+                    else:
+                        self._release_repo_result(job, item.repo)
+                    continue
+                if item.repo is None:
+                    self._list_repos(job)
+                else:
+                    self._run_shared_repo_item(job, item.repo)
+            # The scripts sys.exit() on errors they can't recover from
+            except (Exception, SystemExit) as e:
+                LOGGER.error("Failed %s for %s %s %s", item.task, item.chain, item.repo or '', e)
+                job.failed = True
+            finally:
+                self.work_queue.task_done()
+
+    def _get_dev_oracle(self) -> DevOracle:
+        if not hasattr(self.local, 'dev_oracle'):
+            self.local.dev_oracle = DevOracle(self.save_path, self.frequency, token_pool=self.token_pool,
+                                              source=self.source)
+            self.local.dev_oracle.org_inventory = self.org_inventory
+        return self.local.dev_oracle
+
+    def _get_contributors(self) -> Contributors:
+        if not hasattr(self.local, 'contributors'):
+            self.local.contributors = Contributors(self.save_path, token_pool=self.token_pool, source=self.source)
+            self.local.contributors.org_inventory = self.org_inventory
+            self.local.contributors.concurrency = self.commit_page_concurrency
+        return self.local.contributors
+
+    def _get_repo_stats(self) -> RepoStats:
+        if not hasattr(self.local, 'repo_stats'):
+            self.local.repo_stats = RepoStats(None, self.save_path, token_pool=self.token_pool)
+            self.local.repo_stats.org_inventory = self.org_inventory
+        return self.local.repo_stats
+
+    @profile_stage
+    def _list_repos(self, job: ChainTaskJob):
+        try:
+            self._queue_repos(job)
+        finally:
+            self._finish_listing()
+
+    def _queue_repos(self, job: ChainTaskJob):
+        LOGGER.info("Listing repos for %s of %s", job.task, job.chain)
+        if job.task == 'dev':
+            dev_oracle = self._get_dev_oracle()
+            for org_url in dev_oracle._read_orgs_for_chain_from_toml(job.chain):
+                if not org_url.startswith("https://github.com/"):
+                    LOGGER.warning("%s is not a github repo...Skipping", org_url)
+                    continue
+                org = org_url.split("https://github.com/")[1]
+                job.orgs.append((org, dev_oracle._get_unforked_repos_for_org(org)))
+            repos = [repo for (_, org_repos) in job.orgs for repo in org_repos]
+        elif job.task == 'contr':
+            contributors = self._get_contributors()
+            job.journal = contributors._get_contributors_journal(job.chain, years_count=self.years_count)
+            repos = [repo for repo in asyncio.run(contributors.get_repos_for_protocol_from_toml(job.chain))
+                     if repo not in job.journal.seen_repos]
+        else:
+            repos = self._get_repo_stats()._read_repos_for_chain_from_toml(job.chain)
+
+        with self.lock:
+            job.repos = list(dict.fromkeys(repos))
+            job.pending = set(job.repos)
+            job.saved = not job.repos
+            for repo in job.repos:
+                key = self._get_repo_result_key(job, repo)
+                self.repo_result_users[key] = self.repo_result_users.get(key, 0) + 1
+        LOGGER.info('Queueing %d repos for %s of %s', len(job.repos), job.task, job.chain)
+        if not job.repos:
+            self._save_job(job)
+        for repo in job.repos:
+            self.work_queue.put(WorkItem(job.chain, repo, job.task))
+
+    # Same task and time window, the results don't depend on the chain
+    def _get_repo_result_key(self, job: ChainTaskJob, repo: str):
+        return job.task, repo.lower(), self.years_count
+
+    def _finish_listing(self):
+        with self.lock:
+            self.unlisted_job_count -= 1
+            if self.unlisted_job_count:
+                return
+            for (key, users) in list(self.repo_result_users.items()):
+                if not users:
+                    del self.repo_result_users[key]
+                    self.repo_results.pop(key, None)
+
+    # A chain is done with a repo's result, it is dropped when no other chain needs it
+    def _release_repo_result(self, job: ChainTaskJob, repo: str):
+        key = self._get_repo_result_key(job, repo)
+        with self.lock:
+            self.repo_result_users[key] -= 1
+            if self.repo_result_users[key] or self.unlisted_job_count:
+                return
+            del self.repo_result_users[key]
+            self.repo_results.pop(key, None)
+
+    # Ecosystems share repos (libraries, tooling). The first chain to reach a repo fetches
+    # it, the other chains get the same result when it is ready, without holding a worker.
+    def _run_shared_repo_item(self, job: ChainTaskJob, repo: str):
+        key = self._get_repo_result_key(job, repo)
+        with self.lock:
+            future = self.repo_results.get(key)
+            shared = future is not None
+            if shared:
+                self.shared_repo_count += 1
+            else:
+                future = self.repo_results[key] = Future()
+        future.add_done_callback(lambda done: self._complete_from_future(job, repo, done))
+        if shared:
+            return
+        try:
+            future.set_result(self._run_repo_item(job, repo))
+        except (Exception, SystemExit) as e:
+            future.set_exception(e)
+
+    @profile_stage
+    def _run_repo_item(self, job: ChainTaskJob, repo: str):
+        if job.task == 'dev':
+            return self._get_dev_oracle()._get_single_repo_data(repo, self.years_count)
+        if job.task == 'contr':
+            return asyncio.run(self._get_contributors().get_monthly_contributors_of_repo_in_last_n_years(
+                repo, n_years=self.years_count))
+        return self._get_repo_stats()._get_commits(job.chain, repo)
+
+    def _complete_from_future(self, job: ChainTaskJob, repo: str, future: Future):
+        try:
+            self._complete(job, repo, future.result())
+        except (Exception, SystemExit) as e:
+            LOGGER.error("Failed %s for %s %s %s", job.task, job.chain, repo, e)
+            job.failed = True
+        finally:
+            self._release_repo_result(job, repo)
+
+    def _complete(self, job: ChainTaskJob, repo: str, result):
+        with self.lock:
+            # contr results are kept by the journal
+            if job.task == 'contr':
+                job.journal.record(repo, result)
+            elif not job.failed:
+                job.results[repo] = result
+            job.pending.discard(repo)
+            if job.pending or job.saved or job.failed:
+                return
+            # Only the worker completing the last repo saves
+            job.saved = True
+        self._save_job(job)
+
+    @profile_stage
+    def _save_job(self, job: ChainTaskJob):
+        if job.task == 'dev':
+            self._get_dev_oracle()._save_chain_stats(
+                job.chain, [org for (org, _) in job.orgs],
+                [[job.results[repo] for repo in org_repos] for (_, org_repos) in job.orgs])
+        elif job.task == 'contr':
+            self._get_contributors()._save_contributors_from_journal(job.chain, job.journal)
+        else:
+            self._get_repo_stats()._save_commits(job.chain, job.repos, [job.results[repo] for repo in job.repos])
+        job.results = {}
+        LOGGER.info("Saved %s output for %s", job.task, job.chain)
+
+
+if __name__ == '__main__':
+    p = optparse.OptionParser(usage='python3 orchestrator.py [options] [CHAIN ...]')
+    p.add_option('--tasks', dest='tasks', default=','.join(TASKS),
+                 help='Comma separated tasks to run for every chain: ' + ', '.join(TASKS))
+    p.add_option('--years', type='int', dest='years_count', default=1,
+                 help='Years of history')
+    p.add_option('--frequency', type='int', dest='frequency', default=4,
+                 help='Enter churn, commit frequency')
+    p.add_option('--concurrency', type='int', dest='concurrency', default=DEFAULT_CONCURRENCY,
+                 help='Worker threads shared by all chains')
+    p.add_option('--source', type='choice', dest='source', choices=['api', 'git'], default='api',
+                 help='git: read dev and contr commit history from local clones')
+    p.add_option('--profile', action='store_true', dest='profile', default=False,
+                 help='Print the wall time, CPU time and memory of each stage on exit')
+    p.add_option('--profile-dir', dest='profile_dir',
+                 help='With --profile, also write a cProfile and the top allocation sites of each stage here')
+    options, arguments = p.parse_args()
+
+    chains = arguments or get_chain_names().split()
+    install_request_metrics('orchestrator')
+    if options.profile:
+        enable_stage_profiling(options.profile_dir)
+    orchestrator = Orchestrator('./output', options.tasks.split(','), options.years_count, options.frequency,
+                                options.concurrency, options.source)
+    failed = orchestrator.run(chains)
+    for (chain, task) in failed:
+        LOGGER.error("Failed: %s for %s", task, chain)
+    if failed:
+        sys.exit(1)
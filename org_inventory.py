@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from typing import List, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import get_org_inventory_cache_dir, get_org_inventory_ttl_secs
+from gitTokenHelper import GithubTokenPool
+from github_http import github_get, get_last_page_from_link_header, GITHUB_API_URL
+from request_metrics import bind_request_context
+
+LOGGER = logging.getLogger(__name__)
+
+# Fields of the listing payload kept per repo, enough to pick repos without a request per repo
+INVENTORY_FIELDS = ('full_name', 'fork', 'archived', 'pushed_at', 'size', 'stargazers_count', 'forks_count')
+# Listing pages of an org fetched at once
+INVENTORY_PAGE_WORKERS = 8
+
+
+# The repos of a GitHub org (or user), listed once with the fork flag of each rather than
+# listing all repos and then the forks. Pages after the first are fetched concurrently, and
+# inventories are cached on disk for `ttl_secs` and in memory for the life of the object.
+class OrgInventory:
+    def __init__(self, token_pool: GithubTokenPool, cache_dir: str = None, ttl_secs: int = None):
+        self.token_pool = token_pool
+        self.cache_dir = cache_dir or get_org_inventory_cache_dir()
+        self.ttl_secs = get_org_inventory_ttl_secs() if ttl_secs is None else ttl_secs
+        self.session = requests.Session()
+        self.session.mount(GITHUB_API_URL, HTTPAdapter(pool_connections=1, pool_maxsize=INVENTORY_PAGE_WORKERS))
+        self._lock = threading.Lock()
+        # org (lowercase) -> repos
+        self._inventories = {}
+        # org (lowercase) -> lock held while listing it, threads asking for the same org wait for one listing
+        self._listing_locks = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    # joblib ships the components holding an inventory to worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        del state['_listing_locks']
+        del state['session']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._listing_locks = {}
+        self.session = requests.Session()
+
+    def _entry_path(self, org_name: str):
+        return path.join(self.cache_dir, org_name.lower() + '.json')
+
+    @staticmethod
+    def compact_repo(repo: Dict) -> Dict:
+        return {field: repo.get(field) for field in INVENTORY_FIELDS}
+
+    # Repos of the org from memory or the disk cache, None when absent or expired
+    def get_cached(self, org_name: str):
+        with self._lock:
+            repos = self._inventories.get(org_name.lower())
+        if repos is not None:
+            return repos
+        try:
+            with open(self._entry_path(org_name), 'r') as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['listed_at'] > self.ttl_secs:
+            return None
+        with self._lock:
+            self._inventories[org_name.lower()] = entry['repos']
+        return entry['repos']
+
+    # `repos` are listing payload items, compacted to INVENTORY_FIELDS
+    def put(self, org_name: str, repos: List[Dict]):
+        repos = [self.compact_repo(repo) for repo in repos]
+        entry_path = self._entry_path(org_name)
+        tmp_path = entry_path + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_path, 'w') as entry_file:
+            json.dump({'org': org_name, 'listed_at': time.time(), 'repos': repos}, entry_file)
+        os.replace(tmp_path, entry_path)
+        with self._lock:
+            self._inventories[org_name.lower()] = repos
+        return repos
+
+    def get_repos(self, org_name: str) -> List[Dict]:
+        with self._lock:
+            listing_lock = self._listing_locks.setdefault(org_name.lower(), threading.Lock())
+        with listing_lock:
+            repos = self.get_cached(org_name)
+            if repos is None:
+                LOGGER.info("Listing repos of %s", org_name)
+                repos = self.put(org_name, self._list_repos(org_name))
+        return repos
+
+    # org/repo names of the repos of the org that are not forks
+    def get_unforked_repos(self, org_name: str) -> List[str]:
+        return [repo['full_name'] for repo in self.get_repos(org_name) if not repo['fork']]
+
+    def _get(self, url: str):
+        while True:
+            with self.token_pool.lease() as pat:
+                r = github_get(url, pat, session=self.session)
+            if r.status_code == 403 and r.headers.get('X-RateLimit-Remaining') == '0':
+                LOGGER.warning("Token rate limit reached, switching tokens")
+                self.token_pool.mark_rate_limited(pat, int(r.headers.get('X-RateLimit-Reset', 0)) or None)
+                continue
+            return r
+
+    def _list_repos(self, org_name: str) -> List[Dict]:
+        repos = self._get_all_pages(f"{GITHUB_API_URL}/orgs/{org_name}/repos")
+        if repos is None:
+            # Not an org but a user
+            repos = self._get_all_pages(f"{GITHUB_API_URL}/users/{org_name}/repos")
+        if repos is None:
+            LOGGER.warning("Organization or user not found: %s", org_name)
+            return []
+        return repos
+
+    # Page 1 first for the last page number, then the rest concurrently. None on a 404.
+    def _get_all_pages(self, url: str):
+        first_page = self._get(url + '?page=1&per_page=100')
+        if first_page.status_code == 404:
+            return None
+        if first_page.status_code != 200:
+            raise Exception(f"Error {first_page.status_code} while listing {url}")
+        items = first_page.json()
+        last_page = get_last_page_from_link_header(first_page.headers['link']) \
+            if 'link' in first_page.headers else None
+        if last_page and last_page > 1:
+            with ThreadPoolExecutor(max_workers=INVENTORY_PAGE_WORKERS) as executor:
+                pages = executor.map(bind_request_context(self._get), [url + '?page=' + str(page) + '&per_page=100'
+                                                 for page in range(2, last_page + 1)])
+                for page in pages:
+                    if page.status_code != 200:
+                        raise Exception(f"Error {page.status_code} while listing {url}")
+                    items.extend(page.json())
+        return items
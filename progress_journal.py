@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+from os import path
+
+LOGGER = logging.getLogger(__name__)
+
+# Repo entries replayed at load before the journal is rewritten as a snapshot
+COMPACT_AFTER_ENTRIES = 1000
+
+
+# Append-only checkpoint of Contributors.get_contr_from_toml. One JSON line per
+# analysed repo holds only the logins that repo adds to each month (or to the
+# year), so a checkpoint costs O(new data) and a rerun replays the lines instead
+# of rescanning every repo. compact() rewrites the journal as one deduplicated
+# snapshot line. A line cut short by a crash is ignored, that repo is redone.
+class ContributorsJournal:
+    def __init__(self, journal_path: str, month_count: int = None):
+        self.journal_path = journal_path
+        # None for the yearly (flat) contributor list
+        self.month_count = month_count
+        self.seen_repos = set()
+        self.contributors = [set() for _ in range(month_count)] if month_count else set()
+        self.entry_count = 0
+        self._load()
+
+    def _shape(self):
+        return {'month_count': self.month_count}
+
+    def _load(self):
+        if not path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'r') as journal_file:
+            lines = journal_file.readlines()
+        truncated = False
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                LOGGER.warning('Ignoring truncated progress journal line in %s', self.journal_path)
+                truncated = True
+                continue
+            if entry['shape'] != self._shape():
+                # Written for another number of years or for yearly output, start over
+                LOGGER.warning('Discarding progress journal of another run mode %s', self.journal_path)
+                self.reset()
+                return
+            self._apply(entry)
+        # A truncated tail would swallow the next appended line
+        if truncated or self.entry_count > COMPACT_AFTER_ENTRIES:
+            self.compact()
+
+    def _apply(self, entry: dict):
+        self.seen_repos.update(entry['repos'])
+        if self.month_count:
+            for (index, logins) in enumerate(entry['contributors']):
+                self.contributors[index].update(logins)
+        else:
+            self.contributors.update(entry['contributors'])
+        self.entry_count += 1
+
+    def _entry(self, repos: list, contributors):
+        return {'shape': self._shape(), 'repos': repos, 'contributors': contributors}
+
+    def _write(self, journal_file, entry: dict):
+        journal_file.write(json.dumps(entry) + '\n')
+
+    # Log the contributors of one repo, only the logins new to their month are written
+    def record(self, repo: str, contributors: list):
+        if self.month_count:
+            new_contributors = [sorted(set(logins) - self.contributors[index])
+                                for (index, logins) in enumerate(contributors)]
+        else:
+            new_contributors = sorted(set(contributors) - self.contributors)
+        entry = self._entry([repo], new_contributors)
+        with open(self.journal_path, 'a') as journal_file:
+            self._write(journal_file, entry)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        self._apply(entry)
+
+    def compact(self):
+        contributors = [sorted(logins) for logins in self.contributors] if self.month_count \
+            else sorted(self.contributors)
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as journal_file:
+            self._write(journal_file, self._entry(sorted(self.seen_repos), contributors))
+        os.replace(tmp_path, self.journal_path)
+        self.entry_count = 1
+
+    def reset(self):
+        self.seen_repos = set()
+        self.contributors = [set() for _ in range(self.month_count)] if self.month_count else set()
+        self.entry_count = 0
+        if path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    # Deduplicated contributors, per month or for the year
+    def get_contributors(self):
+        if self.month_count:
+            return [list(logins) for logins in self.contributors]
+        return list(self.contributors)
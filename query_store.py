@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+import json
+import os
+import sqlite3
+from os import path
+from typing import List, Dict, Tuple
+
+import pandas as pd
+
+from commit_store import CommitStore
+from hll import merge_sketches
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chain_stats (
+    chain TEXT PRIMARY KEY,
+    stars INTEGER, forks INTEGER, num_releases INTEGER,
+    churn_4w INTEGER, commits_4w INTEGER, contributors INTEGER
+);
+CREATE TABLE IF NOT EXISTS chain_weekly (
+    chain TEXT NOT NULL, week_start TEXT NOT NULL, weeks_ago INTEGER NOT NULL,
+    commits INTEGER, churn INTEGER
+);
+CREATE INDEX IF NOT EXISTS chain_weekly_chain_week ON chain_weekly (chain, week_start);
+CREATE TABLE IF NOT EXISTS monthly_contributors (
+    chain TEXT NOT NULL, month_index INTEGER NOT NULL, month_start TEXT NOT NULL, author TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS monthly_contributors_chain_month ON monthly_contributors (chain, month_start);
+CREATE TABLE IF NOT EXISTS contributor_sketches (
+    chain TEXT NOT NULL, sketch_key TEXT NOT NULL, sketch TEXT NOT NULL,
+    PRIMARY KEY (chain, sketch_key)
+);
+CREATE TABLE IF NOT EXISTS author_activity (
+    source TEXT NOT NULL, chain TEXT NOT NULL, repo TEXT NOT NULL, author TEXT NOT NULL,
+    day TEXT NOT NULL, commits INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS author_activity_chain_day ON author_activity (chain, day);
+CREATE INDEX IF NOT EXISTS author_activity_chain_repo_day ON author_activity (chain, repo, day);
+CREATE INDEX IF NOT EXISTS author_activity_author ON author_activity (author);
+CREATE INDEX IF NOT EXISTS author_activity_source ON author_activity (source);
+'''
+
+# Output file suffix -> kind of source
+CHAIN_FILE_SUFFIXES = {
+    '_stats.json': 'stats',
+    '_history.json': 'history',
+    '_contributors.json': 'contributors',
+    '_contributor_sketches.json': 'sketches'
+}
+# contr.py months are 30 day windows ending at the time of the run
+CONTR_MONTH_DAYS = 30
+# Period start of a YYYY-MM-DD day in SQL
+PERIOD_START_SQL = {
+    'day': 'day',
+    'week': "date(day, '-' || ((CAST(strftime('%w', day) AS INTEGER) + 6) % 7) || ' days')",
+    'month': "strftime('%Y-%m-01', day)",
+    'year': "strftime('%Y-01-01', day)"
+}
+
+
+# Embedded index over the crawl outputs in `output_dir`, so report scripts can ask
+# for active developers, churn and commits without re-parsing the raw files.
+# build() only re-ingests the files that changed since the last build.
+class DevQueryStore:
+    def __init__(self, output_dir: str = './output', db_path: str = None):
+        # Sources are keyed on their path, the same whichever way the directory is given
+        self.output_dir = path.realpath(output_dir)
+        self.db_path = db_path or path.join(output_dir, 'dev_query_store.sqlite')
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def build(self):
+        current_sources = {}
+        for file_name in os.listdir(self.output_dir):
+            for (suffix, kind) in CHAIN_FILE_SUFFIXES.items():
+                # `_single_repo_stats.json` also ends with `_stats.json`
+                if file_name.endswith(suffix) and not file_name.endswith('_single_repo_stats.json'):
+                    current_sources[path.join(self.output_dir, file_name)] = (kind, file_name[:-len(suffix)])
+        commit_store = CommitStore(self.output_dir)
+        for chain in commit_store.get_chains():
+            chain_dir = path.join(commit_store.commits_dir, 'chain=' + chain)
+            for (dir_name, _, file_names) in os.walk(chain_dir):
+                for file_name in file_names:
+                    if file_name.endswith('.parquet'):
+                        current_sources[path.join(dir_name, file_name)] = ('commits', chain)
+
+        known_sources = {source_path: (mtime, size) for (source_path, mtime, size)
+                         in self.connection.execute('SELECT path, mtime, size FROM sources')}
+        with self.connection:
+            for source_path in set(known_sources) - set(current_sources):
+                self._forget_source(source_path)
+            repo_names = None
+            for (source_path, (kind, chain)) in current_sources.items():
+                stat = os.stat(source_path)
+                if known_sources.get(source_path) == (stat.st_mtime, stat.st_size):
+                    continue
+                if kind == 'stats':
+                    self._ingest_stats(chain, source_path)
+                elif kind == 'history':
+                    self._ingest_history(chain, source_path, stat.st_mtime)
+                elif kind == 'contributors':
+                    self._ingest_contributors(chain, source_path, stat.st_mtime)
+                elif kind == 'sketches':
+                    self._ingest_sketches(chain, source_path)
+                else:
+                    if repo_names is None:
+                        repos = commit_store.read_repos()
+                        repo_names = {int(repo_id): org + '/' + repo
+                                      for (repo_id, org, repo) in zip(repos['repo_id'], repos['org'], repos['repo'])}
+                    self._ingest_commits(chain, source_path, commit_store, repo_names)
+                self.connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)',
+                                        (source_path, stat.st_mtime, stat.st_size))
+
+    def _forget_source(self, source_path: str):
+        file_name = path.basename(source_path)
+        for (suffix, kind) in CHAIN_FILE_SUFFIXES.items():
+            if file_name.endswith(suffix):
+                chain = file_name[:-len(suffix)]
+                table = {'stats': 'chain_stats', 'history': 'chain_weekly', 'contributors': 'monthly_contributors',
+                         'sketches': 'contributor_sketches'}[kind]
+                self.connection.execute('DELETE FROM ' + table + ' WHERE chain = ?', (chain,))
+        self.connection.execute('DELETE FROM author_activity WHERE source = ?', (source_path,))
+        self.connection.execute('DELETE FROM sources WHERE path = ?', (source_path,))
+
+    def _ingest_stats(self, chain: str, source_path: str):
+        with open(source_path, 'r') as stats_json:
+            stats = json.load(stats_json)
+        self.connection.execute('INSERT OR REPLACE INTO chain_stats VALUES (?, ?, ?, ?, ?, ?, ?)', (
+            chain, stats.get('stars', 0), stats.get('forks', 0), stats.get('num_releases', 0),
+            stats.get('churn_4w', 0), stats.get('commits_4w', 0), stats.get('contributors', 0)))
+
+    # Weeks are relative to the time the history was written
+    def _ingest_history(self, chain: str, source_path: str, written_at: float):
+        with open(source_path, 'r') as history_json:
+            history = json.load(history_json)
+        self.connection.execute('DELETE FROM chain_weekly WHERE chain = ?', (chain,))
+        written_on = dt.datetime.utcfromtimestamp(written_at).date()
+        commits = history.get('weekly_commits', [])
+        churn = history.get('weekly_churn', [])
+        week_count = max(len(commits), len(churn))
+        rows = []
+        # Lists are oldest week first and can differ in length, align them on the latest week
+        for weeks_ago in range(week_count):
+            week_commits = commits[-1 - weeks_ago] if weeks_ago < len(commits) else None
+            if isinstance(week_commits, dict):
+                week_commits = week_commits['commits']
+            rows.append((chain, (written_on - dt.timedelta(days=7 * weeks_ago)).isoformat(), weeks_ago,
+                         week_commits, churn[-1 - weeks_ago] if weeks_ago < len(churn) else None))
+        self.connection.executemany('INSERT INTO chain_weekly VALUES (?, ?, ?, ?, ?)', rows)
+
+    def _ingest_contributors(self, chain: str, source_path: str, written_at: float):
+        with open(source_path, 'r') as contributors_json:
+            months = json.load(contributors_json)
+        self.connection.execute('DELETE FROM monthly_contributors WHERE chain = ?', (chain,))
+        # Yearly output is a flat list of logins, not per month
+        if months and not isinstance(months[0], list):
+            return
+        written_on = dt.datetime.utcfromtimestamp(written_at).date()
+        rows = []
+        for (month_index, authors) in enumerate(months):
+            month_start = written_on - dt.timedelta(days=CONTR_MONTH_DAYS * (len(months) - month_index))
+            rows.extend((chain, month_index, month_start.isoformat(), author) for author in set(authors))
+        self.connection.executemany('INSERT INTO monthly_contributors VALUES (?, ?, ?, ?)', rows)
+
+    def _ingest_sketches(self, chain: str, source_path: str):
+        with open(source_path, 'r') as sketches_json:
+            sketches = json.load(sketches_json)
+        self.connection.execute('DELETE FROM contributor_sketches WHERE chain = ?', (chain,))
+        self.connection.executemany('INSERT INTO contributor_sketches VALUES (?, ?, ?)',
+                                    [(chain, key, sketch) for (key, sketch) in sketches.items()])
+
+    def _ingest_commits(self, chain: str, source_path: str, commit_store: CommitStore, repo_names: Dict[int, str]):
+        self.connection.execute('DELETE FROM author_activity WHERE source = ?', (source_path,))
+        commits = pd.read_parquet(source_path, columns=['repo_id', 'author_id', 'authored_at'])
+        commits = commits[commits['author_id'].notna()]
+        if len(commits) == 0:
+            return
+        users = commit_store.read_users(columns=['id', 'login', 'email'])
+        authors = {int(user_id): login or email or str(user_id)
+                   for (user_id, login, email) in zip(users['id'], users['login'], users['email'])}
+        days = commits['authored_at'].dt.strftime('%Y-%m-%d')
+        counts = commits.groupby([commits['repo_id'], commits['author_id'], days]).size()
+        self.connection.executemany('INSERT INTO author_activity VALUES (?, ?, ?, ?, ?, ?)', [
+            (source_path, chain, repo_names.get(int(repo_id), str(repo_id)),
+             authors.get(int(author_id), str(author_id)), day, int(count))
+            for ((repo_id, author_id, day), count) in counts.items()])
+
+    def chains(self) -> List[str]:
+        return [chain for (chain,) in self.connection.execute(
+            'SELECT chain FROM chain_stats UNION SELECT chain FROM chain_weekly '
+            'UNION SELECT chain FROM monthly_contributors UNION SELECT chain FROM contributor_sketches '
+            'UNION SELECT chain FROM author_activity ORDER BY chain')]
+
+    def stats(self, chain: str) -> Dict:
+        row = self.connection.execute(
+            'SELECT stars, forks, num_releases, churn_4w, commits_4w, contributors FROM chain_stats WHERE chain = ?',
+            (chain,)).fetchone()
+        if row is None:
+            return {}
+        return dict(zip(['stars', 'forks', 'num_releases', 'churn_4w', 'commits_4w', 'contributors'], row))
+
+    # Distinct developers per period between start and end (YYYY-MM-DD, inclusive), oldest first.
+    # Commit records give any granularity; without them contr.py's 30 day months are used.
+    def active_devs(self, chain: str, start: str = '0000-01-01', end: str = '9999-12-31',
+                    granularity: str = 'month') -> List[Tuple[str, int]]:
+        if granularity not in PERIOD_START_SQL:
+            raise Exception("granularity must be one of " + ", ".join(PERIOD_START_SQL))
+        rows = self.connection.execute(
+            'SELECT ' + PERIOD_START_SQL[granularity] + ' AS period, COUNT(DISTINCT author) FROM author_activity '
+            'WHERE chain = ? AND day BETWEEN ? AND ? GROUP BY period ORDER BY period',
+            (chain, start, end)).fetchall()
+        if rows:
+            return rows
+        return self.connection.execute(
+            'SELECT month_start, COUNT(DISTINCT author) FROM monthly_contributors '
+            'WHERE chain = ? AND month_start BETWEEN ? AND ? GROUP BY month_index ORDER BY month_index',
+            (chain, start, end)).fetchall()
+
+    # Estimated distinct developers of several chains together, from the merged HyperLogLog
+    # sketches of dev.py. All-time contributors by default, else the authors of the
+    # 'YYYY-MM' months from start_month to end_month.
+    def distinct_devs(self, chains: List[str], start_month: str = None, end_month: str = None) -> int:
+        placeholders = ', '.join('?' * len(chains))
+        if start_month or end_month:
+            rows = self.connection.execute(
+                'SELECT sketch FROM contributor_sketches WHERE chain IN (' + placeholders + ') '
+                "AND sketch_key != 'all' AND sketch_key BETWEEN ? AND ?",
+                list(chains) + [start_month or '0000-00', end_month or '9999-99'])
+        else:
+            rows = self.connection.execute(
+                'SELECT sketch FROM contributor_sketches WHERE chain IN (' + placeholders + ") AND sketch_key = 'all'",
+                list(chains))
+        return merge_sketches(sketch for (sketch,) in rows).count()
+
+    # Monthly active developer counts of contr.py's output, oldest month first
+    def monthly_active_devs(self, chain: str) -> List[int]:
+        month_count = self.connection.execute(
+            'SELECT MAX(month_index) + 1 FROM monthly_contributors WHERE chain = ?', (chain,)).fetchone()[0] or 0
+        counts = [0] * month_count
+        for (month_index, count) in self.connection.execute(
+                'SELECT month_index, COUNT(DISTINCT author) FROM monthly_contributors WHERE chain = ? '
+                'GROUP BY month_index', (chain,)):
+            counts[month_index] = count
+        return counts
+
+    # Weekly `commits` or `churn` of a chain, oldest week first
+    def weekly_series(self, chain: str, metric: str = 'commits') -> List[int]:
+        if metric not in ('commits', 'churn'):
+            raise Exception("metric must be commits or churn")
+        return [value for (value,) in self.connection.execute(
+            'SELECT ' + metric + ' FROM chain_weekly WHERE chain = ? AND ' + metric + ' IS NOT NULL '
+            'ORDER BY weeks_ago DESC', (chain,))]
+
+    # Churn of a chain over its latest `window` weeks
+    def churn(self, chain: str, window: int = 4) -> int:
+        return self.connection.execute(
+            'SELECT COALESCE(SUM(churn), 0) FROM chain_weekly WHERE chain = ? AND weeks_ago < ?',
+            (chain, window)).fetchone()[0]
+
+    def commits(self, chain: str, window: int = 4) -> int:
+        return self.connection.execute(
+            'SELECT COALESCE(SUM(commits), 0) FROM chain_weekly WHERE chain = ? AND weeks_ago < ?',
+            (chain, window)).fetchone()[0]
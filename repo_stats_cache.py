@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from os import path
+
+from config import get_repo_stats_cache_dir, get_repo_stats_cache_ttl_secs, get_repo_stats_cache_max_bytes
+
+LOGGER = logging.getLogger(__name__)
+
+# Run a full eviction pass every n writes instead of on every write
+EVICTION_INTERVAL_WRITES = 50
+# Background refreshes run one at a time, they compete with the crawl for the rate limit
+REVALIDATION_WORKERS = 1
+
+
+# DevOracle's repo_data per repo, keyed on the full org/repo name and the number of years
+# crawled. Entries older than `ttl_secs` are stale: they are still served, and refreshed in
+# the background (stale-while-revalidate). File mtimes are the LRU clock for the size limit.
+class RepoStatsCache:
+    def __init__(self, cache_dir: str, ttl_secs: int, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.ttl_secs = ttl_secs
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._writes_since_eviction = 0
+        self._executor = None
+        # (org/repo, year_count) -> Future of the refresh in flight
+        self._revalidating = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.evict()
+
+    # joblib ships the DevOracle holding the cache to worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        del state['_executor']
+        del state['_revalidating']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._revalidating = {}
+
+    def _entry_path(self, org_then_slash_then_repo: str, year_count: int):
+        file_name = org_then_slash_then_repo.lower().replace('/', '__') + '.' + str(year_count) + 'y.json'
+        return path.join(self.cache_dir, file_name)
+
+    def has(self, org_then_slash_then_repo: str, year_count: int):
+        return path.exists(self._entry_path(org_then_slash_then_repo, year_count))
+
+    # (repo_data, fresh), (None, False) on a miss
+    def get(self, org_then_slash_then_repo: str, year_count: int):
+        entry_path = self._entry_path(org_then_slash_then_repo, year_count)
+        try:
+            with open(entry_path, 'r') as entry_file:
+                entry = json.load(entry_file)
+            # Reads count as use for the LRU eviction
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            return None, False
+        return entry['repo_data'], time.time() - entry['fetched_at'] <= self.ttl_secs
+
+    def put(self, org_then_slash_then_repo: str, year_count: int, repo_data: dict):
+        entry = {
+            'name': org_then_slash_then_repo,
+            'year_count': year_count,
+            'fetched_at': time.time(),
+            'repo_data': repo_data
+        }
+        entry_path = self._entry_path(org_then_slash_then_repo, year_count)
+        tmp_path = entry_path + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_path, 'w') as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(tmp_path, entry_path)
+
+        with self._lock:
+            self._writes_since_eviction += 1
+            run_eviction = self._writes_since_eviction >= EVICTION_INTERVAL_WRITES
+            if run_eviction:
+                self._writes_since_eviction = 0
+        if run_eviction:
+            self.evict()
+
+    # Refresh a stale entry in the background with `fetch(org_then_slash_then_repo, year_count)`,
+    # unless a refresh of it is already in flight
+    def revalidate(self, org_then_slash_then_repo: str, year_count: int, fetch):
+        key = (org_then_slash_then_repo.lower(), year_count)
+        with self._lock:
+            if key in self._revalidating:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=REVALIDATION_WORKERS)
+            LOGGER.info("Revalidating stale repo data of %s in the background", org_then_slash_then_repo)
+            self._revalidating[key] = self._executor.submit(
+                self._revalidate, key, org_then_slash_then_repo, year_count, fetch)
+
+    def _revalidate(self, key, org_then_slash_then_repo: str, year_count: int, fetch):
+        try:
+            self.put(org_then_slash_then_repo, year_count, fetch(org_then_slash_then_repo, year_count))
+        # A failed refresh leaves the stale entry, it is retried on the next read
+        except (Exception, SystemExit) as e:
+            LOGGER.warning("Failed to revalidate repo data of %s %s", org_then_slash_then_repo, e)
+        finally:
+            with self._lock:
+                del self._revalidating[key]
+
+    # Block until the background refreshes in flight are done
+    def wait(self):
+        with self._lock:
+            pending = list(self._revalidating.values())
+        if pending:
+            LOGGER.info("Waiting for %d background revalidations ...", len(pending))
+            wait(pending)
+
+    @staticmethod
+    def _remove(entry_path):
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+
+    # Drop least recently used entries until under max_bytes
+    def evict(self):
+        entries = []
+        total_bytes = 0
+        for file_name in os.listdir(self.cache_dir):
+            entry_path = path.join(self.cache_dir, file_name)
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+            total_bytes += stat.st_size
+        if total_bytes <= self.max_bytes:
+            return
+        entries.sort()
+        for (_, size, entry_path) in entries:
+            self._remove(entry_path)
+            total_bytes -= size
+            if total_bytes <= self.max_bytes:
+                break
+
+
+_repo_stats_cache = None
+_repo_stats_cache_lock = threading.Lock()
+
+
+def get_repo_stats_cache():
+    global _repo_stats_cache
+    with _repo_stats_cache_lock:
+        if _repo_stats_cache is None:
+            _repo_stats_cache = RepoStatsCache(
+                get_repo_stats_cache_dir(), get_repo_stats_cache_ttl_secs(), get_repo_stats_cache_max_bytes())
+    return _repo_stats_cache
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+import atexit
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from os import path
+from urllib.parse import urlparse
+
+from config import is_request_metrics_enabled, get_request_metrics_dir
+from github_http import add_response_observer, observe_pygithub_requests, GITHUB_API_URL
+
+LOGGER = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets
+LATENCY_BUCKETS_SECS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Path segments replaced by placeholders, so requests group by endpoint template
+ENDPOINT_TEMPLATE_RULES = (
+    (re.compile(r'^/repos/[^/]+/[^/]+'), '/repos/{owner}/{repo}'),
+    (re.compile(r'^/orgs/[^/]+'), '/orgs/{org}'),
+    (re.compile(r'^/users/[^/]+'), '/users/{user}'),
+    (re.compile(r'/[0-9a-f]{40}(?=/|$)'), '/{sha}'),
+    (re.compile(r'/\d+(?=/|$)'), '/{id}'),
+)
+REPO_PATH_PATTERN = re.compile(r'^/repos/([^/]+/[^/]+)')
+
+# Chain the requests of the current thread or task are made for, a label of the metrics
+_request_chain = contextvars.ContextVar('request_chain', default=None)
+
+
+def set_request_chain(chain: str):
+    _request_chain.set(chain)
+
+
+# `function` run with the context (chain) of the caller, for thread pools which don't carry it over
+def bind_request_context(function):
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(function, *args)
+
+
+def get_endpoint_template(url_path: str):
+    for (pattern, placeholder) in ENDPOINT_TEMPLATE_RULES:
+        url_path = pattern.sub(placeholder, url_path)
+    return url_path
+
+
+# Tokens are labelled by a short hash, PATs never reach the outputs
+def get_token_label(pat: str):
+    return 'token-' + hashlib.sha256(pat.encode('utf-8')).hexdigest()[:8] if pat else 'anonymous'
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(**labels) -> str:
+    return '{' + ','.join('%s="%s"' % (name, _escape_label(value)) for (name, value) in labels.items()) + '}'
+
+
+class _LatencyHistogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS_SECS)
+        self.count = 0
+        self.sum_secs = 0.0
+
+    def observe(self, secs: float):
+        self.count += 1
+        self.sum_secs += secs
+        for (index, upper_bound) in enumerate(LATENCY_BUCKETS_SECS):
+            if secs <= upper_bound:
+                self.bucket_counts[index] += 1
+                break
+
+    # Prometheus buckets are cumulative
+    def cumulative_buckets(self):
+        cumulative = []
+        total = 0
+        for (upper_bound, count) in zip(LATENCY_BUCKETS_SECS, self.bucket_counts):
+            total += count
+            cumulative.append((str(upper_bound), total))
+        cumulative.append(('+Inf', self.count))
+        return cumulative
+
+
+# Budget of a token for one rate limit resource (core, search, graphql). The remaining count
+# of each reset window is followed from its highest to its lowest value, so responses
+# arriving out of order don't count twice.
+class _TokenBudget:
+    def __init__(self):
+        self.requests = 0
+        self.consumed = 0
+        self.limit = None
+        self.reset_epoch = None
+        self.window_max_remaining = None
+        self.window_min_remaining = None
+
+    def observe(self, remaining: int, limit: int, reset_epoch: int):
+        self.requests += 1
+        self.limit = limit
+        if reset_epoch != self.reset_epoch:
+            self._close_window()
+            self.reset_epoch = reset_epoch
+        self.window_max_remaining = max(remaining, self.window_max_remaining or remaining)
+        self.window_min_remaining = min(remaining, remaining if self.window_min_remaining is None
+                                        else self.window_min_remaining)
+
+    def _close_window(self):
+        if self.window_max_remaining is not None:
+            self.consumed += self.window_max_remaining - self.window_min_remaining
+        self.window_max_remaining = None
+        self.window_min_remaining = None
+
+    def get_consumed(self):
+        if self.window_max_remaining is None:
+            return self.consumed
+        return self.consumed + self.window_max_remaining - self.window_min_remaining
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'consumed': self.get_consumed(),
+            'remaining': self.window_min_remaining,
+            'limit': self.limit,
+            'reset_epoch': self.reset_epoch
+        }
+
+
+# Accounting of every response from GitHub, through the github_http observers (which
+# PyGithub's requests reach too, see observe_pygithub_requests): requests by endpoint
+# template, chain and repo, statuses and latencies by endpoint, and the budget used per token.
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        # API root path, e.g. /api/v3 on GitHub Enterprise
+        self.api_path = urlparse(GITHUB_API_URL).path.rstrip('/')
+        # (endpoint, chain, repo) -> requests
+        self.requests = {}
+        # (endpoint, status) -> responses
+        self.statuses = {}
+        # endpoint -> _LatencyHistogram
+        self.latencies = {}
+        # (token label, resource) -> _TokenBudget
+        self.budgets = {}
+
+    def install(self):
+        add_response_observer(self.observe)
+        observe_pygithub_requests()
+        return self
+
+    def observe(self, pat, url, status_code, headers, elapsed_secs):
+        url_path = urlparse(url).path
+        if self.api_path and url_path.startswith(self.api_path):
+            url_path = url_path[len(self.api_path):]
+        endpoint = get_endpoint_template(url_path)
+        repo_match = REPO_PATH_PATTERN.match(url_path)
+        repo = repo_match.group(1).lower() if repo_match else ''
+        chain = _request_chain.get() or ''
+        with self._lock:
+            key = (endpoint, chain, repo)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            key = (endpoint, status_code)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+            self.latencies.setdefault(endpoint, _LatencyHistogram()).observe(elapsed_secs)
+            if 'X-RateLimit-Remaining' in headers:
+                key = (get_token_label(pat), headers.get('X-RateLimit-Resource', 'core'))
+                self.budgets.setdefault(key, _TokenBudget()).observe(
+                    int(headers['X-RateLimit-Remaining']), int(headers.get('X-RateLimit-Limit', 0)),
+                    int(headers.get('X-RateLimit-Reset', 0)))
+
+    def _sum_requests_by(self, index: int):
+        totals = {}
+        for (key, count) in self.requests.items():
+            totals[key[index]] = totals.get(key[index], 0) + count
+        return totals
+
+    def to_dict(self):
+        with self._lock:
+            endpoints = {}
+            for (endpoint, count) in sorted(self._sum_requests_by(0).items(), key=lambda item: -item[1]):
+                histogram = self.latencies[endpoint]
+                endpoints[endpoint] = {
+                    'requests': count,
+                    'statuses': {str(status): status_count for ((status_endpoint, status), status_count)
+                                 in sorted(self.statuses.items()) if status_endpoint == endpoint},
+                    'latency_secs': {
+                        'count': histogram.count,
+                        'sum': round(histogram.sum_secs, 3),
+                        'mean': round(histogram.sum_secs / histogram.count, 3),
+                        'buckets': dict(histogram.cumulative_buckets())
+                    }
+                }
+            tokens = {}
+            for ((token, resource), budget) in sorted(self.budgets.items()):
+                tokens.setdefault(token, {})[resource] = budget.to_dict()
+            return {
+                'started_at': self.started_at,
+                'finished_at': time.time(),
+                'requests': sum(self.requests.values()),
+                'endpoints': endpoints,
+                'chains': self._sum_requests_by(1),
+                'repos': dict(sorted(self._sum_requests_by(2).items(), key=lambda item: -item[1])),
+                'requests_by_endpoint_chain_repo': [
+                    {'endpoint': endpoint, 'chain': chain, 'repo': repo, 'requests': count}
+                    for ((endpoint, chain, repo), count) in sorted(self.requests.items())],
+                'tokens': tokens
+            }
+
+    def to_prometheus(self) -> str:
+        with self._lock:
+            lines = ['# HELP github_requests_total GitHub API requests by endpoint template, chain and repo',
+                     '# TYPE github_requests_total counter']
+            for ((endpoint, chain, repo), count) in sorted(self.requests.items()):
+                lines.append('github_requests_total%s %d' % (_format_labels(endpoint=endpoint, chain=chain, repo=repo),
+                                                             count))
+            lines += ['# HELP github_responses_total GitHub API responses by endpoint template and status',
+                      '# TYPE github_responses_total counter']
+            for ((endpoint, status), count) in sorted(self.statuses.items()):
+                lines.append('github_responses_total%s %d' % (_format_labels(endpoint=endpoint, status=status), count))
+            lines += ['# HELP github_request_duration_seconds GitHub API request latency by endpoint template',
+                      '# TYPE github_request_duration_seconds histogram']
+            for (endpoint, histogram) in sorted(self.latencies.items()):
+                for (upper_bound, count) in histogram.cumulative_buckets():
+                    lines.append('github_request_duration_seconds_bucket%s %d'
+                                 % (_format_labels(endpoint=endpoint, le=upper_bound), count))
+                lines.append('github_request_duration_seconds_sum%s %f'
+                             % (_format_labels(endpoint=endpoint), histogram.sum_secs))
+                lines.append('github_request_duration_seconds_count%s %d'
+                             % (_format_labels(endpoint=endpoint), histogram.count))
+            lines += ['# HELP github_rate_limit_consumed Rate limit budget used during the run per token and resource',
+                      '# TYPE github_rate_limit_consumed gauge']
+            for ((token, resource), budget) in sorted(self.budgets.items()):
+                lines.append('github_rate_limit_consumed%s %d'
+                             % (_format_labels(token=token, resource=resource), budget.get_consumed()))
+            lines += ['# HELP github_rate_limit_remaining Rate limit budget left at the end of the run',
+                      '# TYPE github_rate_limit_remaining gauge']
+            for ((token, resource), budget) in sorted(self.budgets.items()):
+                if budget.window_min_remaining is not None:
+                    lines.append('github_rate_limit_remaining%s %d'
+                                 % (_format_labels(token=token, resource=resource), budget.window_min_remaining))
+            return '\n'.join(lines) + '\n'
+
+    # `<path_prefix>.json` and `<path_prefix>.prom`
+    def write(self, path_prefix: str):
+        os.makedirs(path.dirname(path.abspath(path_prefix)), exist_ok=True)
+        with open(path_prefix + '.json', 'w') as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
+        with open(path_prefix + '.prom', 'w') as prom_file:
+            prom_file.write(self.to_prometheus())
+        LOGGER.info("Request metrics written to %s.json and %s.prom", path_prefix, path_prefix)
+
+
+_request_metrics = None
+_request_metrics_lock = threading.Lock()
+
+
+def get_request_metrics():
+    global _request_metrics
+    with _request_metrics_lock:
+        if _request_metrics is None:
+            _request_metrics = RequestMetrics().install()
+    return _request_metrics
+
+
+# Entry points call this first. Writes `<script_name>_requests.json` and `.prom` to the
+# metrics dir when the script exits, also on sys.exit() after an error.
+def install_request_metrics(script_name: str):
+    if not is_request_metrics_enabled():
+        return None
+    request_metrics = get_request_metrics()
+    atexit.register(request_metrics.write, path.join(get_request_metrics_dir(), script_name + '_requests'))
+    return request_metrics
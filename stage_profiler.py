@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import atexit
+import contextvars
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from os import path
+
+LOGGER = logging.getLogger(__name__)
+
+# Allocation sites listed per stage in the --profile-dir memory reports
+TOP_ALLOCATION_SITES = 15
+
+# Stages the current thread or task is in, innermost last. A context variable rather than a
+# thread local, concurrent tasks of one event loop each have their own.
+_stage_stack = contextvars.ContextVar('stage_stack', default=())
+
+
+class _StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.wall_secs = 0.0
+        self.cpu_secs = 0.0
+        self.memory_delta_bytes = 0
+        self.peak_bytes = 0
+        # One cProfile per thread running the stage, merged in the dump
+        self.profiles = []
+        # Largest growth of traced memory over one call: (bytes, top allocation site diffs)
+        self.largest_snapshot_diff = (0, None)
+
+
+class _StageFrame:
+    def __init__(self, name: str, profile: cProfile.Profile = None):
+        self.name = name
+        self.thread_id = threading.get_ident()
+        self.profile = profile
+        self.peak_bytes = 0
+
+
+# Wall time, CPU time of the calling thread, traced memory growth and peak of every call of a
+# stage, summed per stage. Stages nest: a stage's times include its nested stages, its cProfile
+# (with `profile_dir`) doesn't. Coroutine stages are timed across their awaits, so their times
+# include the tasks that ran meanwhile, and they are not cProfiled. The memory peak is global,
+# approximate when stages run concurrently.
+class StageProfiler:
+    def __init__(self, profile_dir: str = None):
+        self.profile_dir = profile_dir
+        self.stats = {}
+        self._lock = threading.Lock()
+        # stage name -> cProfile of the stage in this thread
+        self._local = threading.local()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _get_stats(self, name: str) -> _StageStats:
+        with self._lock:
+            return self.stats.setdefault(name, _StageStats())
+
+    def _get_thread_profile(self, name: str) -> cProfile.Profile:
+        if not hasattr(self._local, 'profiles'):
+            self._local.profiles = {}
+        profile = self._local.profiles.get(name)
+        if profile is None:
+            profile = self._local.profiles[name] = cProfile.Profile()
+            stats = self._get_stats(name)
+            with self._lock:
+                stats.profiles.append(profile)
+        return profile
+
+    # The enclosing stage's profile is paused while a nested stage runs in the same thread
+    @staticmethod
+    def _get_parent_profile(stack):
+        if stack and stack[-1].profile is not None and stack[-1].thread_id == threading.get_ident():
+            return stack[-1].profile
+        return None
+
+    def _enter(self, name: str, profile: bool):
+        stack = _stage_stack.get()
+        frame = _StageFrame(name, self._get_thread_profile(name) if profile else None)
+        stack_token = _stage_stack.set(stack + (frame,))
+        parent_profile = self._get_parent_profile(stack)
+        if parent_profile is not None:
+            parent_profile.disable()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        snapshot = tracemalloc.take_snapshot() if self.profile_dir else None
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        if frame.profile is not None:
+            frame.profile.enable()
+        return frame, stack_token, snapshot, start_bytes, time.perf_counter(), time.thread_time()
+
+    def _exit(self, frame: _StageFrame, stack_token, snapshot, start_bytes: int, start_wall: float,
+              start_cpu: float):
+        wall_secs = time.perf_counter() - start_wall
+        cpu_secs = time.thread_time() - start_cpu
+        if frame.profile is not None:
+            frame.profile.disable()
+        (current_bytes, peak_bytes) = tracemalloc.get_traced_memory()
+        frame.peak_bytes = max(frame.peak_bytes, peak_bytes)
+        _stage_stack.reset(stack_token)
+        stack = _stage_stack.get()
+        if stack:
+            # The peak was reset for this stage, hand it up
+            stack[-1].peak_bytes = max(stack[-1].peak_bytes, frame.peak_bytes)
+        growth = current_bytes - start_bytes
+        stats = self._get_stats(frame.name)
+        with self._lock:
+            stats.calls += 1
+            stats.wall_secs += wall_secs
+            stats.cpu_secs += cpu_secs
+            stats.memory_delta_bytes += growth
+            stats.peak_bytes = max(stats.peak_bytes, frame.peak_bytes - start_bytes)
+            record_snapshot = snapshot is not None and growth > stats.largest_snapshot_diff[0]
+        if record_snapshot:
+            diff = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')[:TOP_ALLOCATION_SITES]
+            with self._lock:
+                stats.largest_snapshot_diff = max(stats.largest_snapshot_diff, (growth, diff), key=lambda item: item[0])
+        parent_profile = self._get_parent_profile(stack)
+        if parent_profile is not None:
+            parent_profile.enable()
+
+    def wrap(self, function, name: str):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def profiled_coroutine(*args, **kwargs):
+                entered = self._enter(name, False)
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self._exit(*entered)
+            return profiled_coroutine
+
+        profile = self.profile_dir is not None
+
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            entered = self._enter(name, profile)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._exit(*entered)
+        return profiled
+
+    def report(self):
+        with self._lock:
+            stages = sorted(self.stats.items(), key=lambda item: -item[1].wall_secs)
+        LOGGER.info("%-58s %7s %10s %10s %10s %10s", 'stage', 'calls', 'wall s', 'cpu s', 'mem +MiB', 'peak MiB')
+        for (name, stats) in stages:
+            LOGGER.info("%-58s %7d %10.3f %10.3f %10.1f %10.1f",
+                        name, stats.calls, stats.wall_secs, stats.cpu_secs,
+                        stats.memory_delta_bytes / 2 ** 20, stats.peak_bytes / 2 ** 20)
+        if self.profile_dir:
+            self._dump(stages)
+
+    # <stage>.prof for pstats or snakeviz, and <stage>.memory.txt with the top allocation
+    # sites of the call that grew traced memory the most
+    def _dump(self, stages):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        for (name, stats) in stages:
+            if stats.profiles:
+                try:
+                    pstats.Stats(*stats.profiles).dump_stats(path.join(self.profile_dir, name + '.prof'))
+                except TypeError:
+                    # No calls recorded, e.g. every call of the stage had a nested stage only
+                    pass
+            (growth, diff) = stats.largest_snapshot_diff
+            if diff:
+                with open(path.join(self.profile_dir, name + '.memory.txt'), 'w') as memory_file:
+                    memory_file.write("Largest growth over one call: %.1f MiB\n" % (growth / 2 ** 20))
+                    for stat in diff:
+                        memory_file.write(str(stat) + '\n')
+        LOGGER.info("Stage profiles written to %s", self.profile_dir)
+
+
+_stage_profiler = None
+
+
+# Entry points call this for --profile. The breakdown is printed, and with `profile_dir`
+# the profiles dumped, when the script exits.
+def enable_stage_profiling(profile_dir: str = None):
+    global _stage_profiler
+    if _stage_profiler is None:
+        _stage_profiler = StageProfiler(profile_dir)
+        atexit.register(_stage_profiler.report)
+    return _stage_profiler
+
+
+# Marks a pipeline stage, named by its qualified name. Profiling is enabled after the modules
+# are imported, so it is checked on every call, which is all a stage costs without --profile.
+def profile_stage(function):
+    name = function.__qualname__
+    profiled = {}
+
+    def get_profiled():
+        if _stage_profiler not in profiled:
+            profiled[_stage_profiler] = _stage_profiler.wrap(function, name)
+        return profiled[_stage_profiler]
+
+    if asyncio.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def stage_coroutine(*args, **kwargs):
+            if _stage_profiler is None:
+                return await function(*args, **kwargs)
+            return await get_profiled()(*args, **kwargs)
+        return stage_coroutine
+
+    @functools.wraps(function)
+    def stage(*args, **kwargs):
+        if _stage_profiler is None:
+            return function(*args, **kwargs)
+        return get_profiled()(*args, **kwargs)
+    return stage
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from typing import List
+
+from gitTokenHelper import GithubTokenPool
+from github_http import github_get, GITHUB_API_URL
+
+LOGGER = logging.getLogger(__name__)
+
+STATS_ENDPOINTS = ('code_frequency', 'contributors')
+# Polls of a repo still computing its statistics back off from 2s to 64s, 8 polls is ~4 minutes
+STATS_POLL_BASE_SECS = 2
+STATS_POLL_MAX_SECS = 64
+STATS_POLL_ATTEMPTS = 8
+
+
+def get_stats_poll_delay(attempt: int):
+    return min(STATS_POLL_BASE_SECS * 2 ** attempt, STATS_POLL_MAX_SECS)
+
+
+# GitHub answers 202 on the statistics endpoints while it computes them in the background.
+# The queue asks for the statistics of many repos up front, so GitHub warms them all at once,
+# and hands repos out in the order their statistics become ready: one cold repo doesn't
+# block the others. Repos still computing are polled with exponential backoff.
+class DeferredStatsQueue:
+    def __init__(self, token_pool: GithubTokenPool, endpoints=STATS_ENDPOINTS):
+        self.token_pool = token_pool
+        self.endpoints = endpoints
+        # (org/repo, endpoint) -> JSON of a 200, [] for 204 or when GitHub never got done
+        self.results = {}
+        # (org/repo, endpoint) -> [polls so far, epoch of the next poll]
+        self.pending = {}
+
+    def _get(self, url: str):
+        while True:
+            with self.token_pool.lease() as pat:
+                r = github_get(url, pat)
+            if r.status_code == 403 and r.headers.get('X-RateLimit-Remaining') == '0':
+                LOGGER.warning("Token rate limit reached, switching tokens")
+                self.token_pool.mark_rate_limited(pat, int(r.headers.get('X-RateLimit-Reset', 0)) or None)
+                continue
+            return r
+
+    def _poll(self, org_then_slash_then_repo: str, endpoint: str):
+        key = (org_then_slash_then_repo, endpoint)
+        r = self._get(f"{GITHUB_API_URL}/repos/{org_then_slash_then_repo}/stats/{endpoint}")
+        if r.status_code == 202:
+            (attempt, _) = self.pending.get(key, (0, None))
+            if attempt + 1 >= STATS_POLL_ATTEMPTS:
+                LOGGER.warning("Statistics not ready in time for %s %s", org_then_slash_then_repo, endpoint)
+                self.pending.pop(key, None)
+                self.results[key] = []
+            else:
+                self.pending[key] = [attempt + 1, time.time() + get_stats_poll_delay(attempt)]
+            return
+        self.pending.pop(key, None)
+        if r.status_code == 204:
+            # Empty repo
+            self.results[key] = []
+        elif r.status_code == 200:
+            self.results[key] = r.json()
+        else:
+            raise Exception(f"Error {r.status_code} while fetching {endpoint} statistics of {org_then_slash_then_repo}")
+
+    def _is_ready(self, org_then_slash_then_repo: str):
+        return all((org_then_slash_then_repo, endpoint) in self.results for endpoint in self.endpoints)
+
+    # Ask for the statistics of the repos, without waiting for the ones still computing
+    def request(self, org_then_slash_then_repos: List[str]):
+        for org_then_slash_then_repo in org_then_slash_then_repos:
+            for endpoint in self.endpoints:
+                key = (org_then_slash_then_repo, endpoint)
+                if key not in self.results and key not in self.pending:
+                    self._poll(org_then_slash_then_repo, endpoint)
+
+    def _poll_due(self):
+        now = time.time()
+        for ((org_then_slash_then_repo, endpoint), (_, next_poll)) in list(self.pending.items()):
+            if next_poll <= now:
+                self._poll(org_then_slash_then_repo, endpoint)
+
+    # Yield the requested repos as their statistics become ready, polling the others in between
+    def iter_ready(self, org_then_slash_then_repos: List[str]):
+        self.request(org_then_slash_then_repos)
+        waiting = list(org_then_slash_then_repos)
+        while waiting:
+            ready = [repo for repo in waiting if self._is_ready(repo)]
+            for repo in ready:
+                waiting.remove(repo)
+                yield repo
+            if not waiting:
+                return
+            self._poll_due()
+            if not any(self._is_ready(repo) for repo in waiting):
+                time.sleep(max(0, min(next_poll for (_, next_poll) in self.pending.values()) - time.time()))
+
+    # Statistics of one repo, waiting for them if they are not ready yet
+    def get(self, org_then_slash_then_repo: str, endpoint: str):
+        key = (org_then_slash_then_repo, endpoint)
+        if key not in self.results:
+            self.request([org_then_slash_then_repo])
+            while key not in self.results:
+                time.sleep(max(0, self.pending[key][1] - time.time()))
+                self._poll(org_then_slash_then_repo, endpoint)
+        return self.results.pop(key)
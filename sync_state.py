@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+import json
+import logging
+import os
+from os import path
+
+LOGGER = logging.getLogger(__name__)
+
+GITHUB_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def parse_github_date(date_string):
+    return dt.datetime.strptime(date_string, GITHUB_DATE_FORMAT)
+
+
+# Per-repo high-water marks of the commit crawl plus the aggregates built from
+# the commits seen so far, so a rerun only fetches commits `since=` the watermark.
+# One JSON file per repo and kind of aggregate.
+class SyncStateStore:
+    def __init__(self, state_dir: str, lookback_days: int = 7):
+        self.state_dir = state_dir
+        # Commits of merged branches keep their older committer dates, so the
+        # watermark is moved back a bit. Aggregates are merged idempotently.
+        self.lookback_days = lookback_days
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def _state_path(self, org_then_slash_then_repo: str, kind: str):
+        file_name = org_then_slash_then_repo.lower().replace('/', '__') + '.' + kind + '.json'
+        return path.join(self.state_dir, file_name)
+
+    def load(self, org_then_slash_then_repo: str, kind: str):
+        state_path = self._state_path(org_then_slash_then_repo, kind)
+        if path.exists(state_path):
+            try:
+                with open(state_path, 'r') as state_file:
+                    return json.load(state_file)
+            except ValueError:
+                LOGGER.warning('Ignoring corrupt sync state %s', state_path)
+        return {
+            'last_commit_date': None,
+            'last_commit_sha': None,
+            'aggregate': None
+        }
+
+    def save(self, org_then_slash_then_repo: str, kind: str, state: dict):
+        state_path = self._state_path(org_then_slash_then_repo, kind)
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_path, state_path)
+
+    # `since=` value for the next crawl of a repo, None for a full crawl
+    def get_since(self, state: dict):
+        if not state['last_commit_date']:
+            return None
+        since = parse_github_date(state['last_commit_date']) - dt.timedelta(days=self.lookback_days)
+        return since.strftime(GITHUB_DATE_FORMAT)
+
+    # Move the watermark to the newest commit of a crawl. GitHub lists commits newest first.
+    @staticmethod
+    def advance(state: dict, commits: list):
+        for commit in commits:
+            committer = commit['commit']['committer'] or commit['commit']['author']
+            if not committer:
+                continue
+            if state['last_commit_date'] is None or committer['date'] > state['last_commit_date']:
+                state['last_commit_date'] = committer['date']
+                state['last_commit_sha'] = commit['sha']
+        return state
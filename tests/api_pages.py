@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+
+SECONDS_PER_DAY = 24 * 60 * 60
+COMMITS_PER_PAGE = 100
+
+
+# A commits API item, with the fields that make up most of its size
+def make_api_commit(rng: random.Random, login: str, epoch: int):
+    date = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+    sha = '%040x' % rng.getrandbits(160)
+    git_user = {'name': login, 'email': login + '@example.com', 'date': date}
+    github_user = {'login': login, 'id': hash(login) & 0xffffff, 'type': 'User', 'site_admin': False,
+                   'url': 'https://api.github.com/users/' + login,
+                   'html_url': 'https://github.com/' + login,
+                   'avatar_url': 'https://avatars.githubusercontent.com/u/1?v=4'}
+    return {
+        'sha': sha,
+        'url': 'https://api.github.com/repos/org/repo/commits/' + sha,
+        'commit': {'author': git_user, 'committer': dict(git_user), 'message': 'Change ' * 20,
+                   'tree': {'sha': sha, 'url': 'https://api.github.com/repos/org/repo/git/trees/' + sha}},
+        'author': github_user,
+        'committer': dict(github_user),
+        'parents': [{'sha': sha, 'url': 'https://api.github.com/repos/org/repo/commits/' + sha}]
+    }
+
+
+# Page `page` of a commit listing, the same commits every time it is made
+def make_api_page(page: int, login_count: int, years: int, now: float):
+    rng = random.Random(page)
+    return [make_api_commit(rng, 'dev' + str(rng.randrange(login_count)),
+                            int(now - rng.random() * years * 365 * SECONDS_PER_DAY))
+            for _ in range(COMMITS_PER_PAGE)]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# The modules are top-level scripts, and read config.ini from the working directory
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import pytest
+
+from gitTokenHelper import GithubTokenPool, _TokenState, DEFAULT_RATE_LIMIT
+
+
+# Token pool with full budgets, without querying the rate limit endpoint
+@pytest.fixture
+def token_pool(monkeypatch):
+    def initialize_pats(self, pats):
+        for pat in pats:
+            self._tokens[pat] = _TokenState(pat, DEFAULT_RATE_LIMIT, DEFAULT_RATE_LIMIT, 0)
+    monkeypatch.setattr(GithubTokenPool, '_initialize_pats', initialize_pats)
+    return GithubTokenPool(['token-1', 'token-2'])
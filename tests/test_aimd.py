@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+
+import contr
+from aimd import AimdConcurrencyController
+from contr import Contributors
+
+PAGE_COUNT = 60
+
+
+def test_shared_controller_bounds_requests_in_flight_across_threads(monkeypatch):
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    async def get_commits(session, pat, org_then_slash_then_repo, page, since=None):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        await asyncio.sleep(0.005)
+        with lock:
+            in_flight[0] -= 1
+        return {"error": None, "error_code": None, "pat": pat, "data": [{'page': page}],
+                "total_pages": PAGE_COUNT if page == 1 else None, "rate_limit_remaining": 5000,
+                "sent_at": time.time(), "latency_secs": 0.005}
+
+    monkeypatch.setattr(contr, 'get_commits', get_commits)
+    # Like the orchestrator's workers, each thread has its own Contributors and event loop
+    controller = AimdConcurrencyController(initial_limit=10, max_limit=10)
+    page_counts = []
+
+    def crawl(repo: str):
+        contributors = object.__new__(Contributors)
+        contributors.pat = 'token'
+        contributors.concurrency = controller
+
+        async def count_pages():
+            return len([page async for page in contributors._iter_commit_pages(repo)])
+        page_counts.append(asyncio.run(count_pages()))
+
+    workers = [threading.Thread(target=crawl, args=('org/repo-%d' % index,)) for index in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert page_counts == [PAGE_COUNT] * 3
+    assert in_flight[1] <= 10
+    assert controller.in_flight == 0
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+import tracemalloc
+
+import contr
+from aimd import AimdConcurrencyController
+from api_pages import make_api_page
+from contr import Contributors
+
+LOGIN_COUNT = 50
+YEARS = 2
+# Pages held at once may double for the temporaries of the fold
+CEILING_FACTOR = 2
+
+
+# Stand-in for contr.get_commits, every page is generated on request like a decoded response
+def _stub_get_commits(page_count: int, now: float):
+    async def get_commits(session, pat, org_then_slash_then_repo, page, since=None):
+        return {
+            "error": None,
+            "error_code": None,
+            "pat": pat,
+            "data": make_api_page(page, LOGIN_COUNT, YEARS, now),
+            "total_pages": page_count if page == 1 else None,
+            "rate_limit_remaining": 5000,
+            "sent_at": time.time(),
+            "latency_secs": 0.01
+        }
+    return get_commits
+
+
+def _get_page_bytes(now: float):
+    tracemalloc.start()
+    page = make_api_page(1, LOGIN_COUNT, YEARS, now)
+    page_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del page
+    return page_bytes
+
+
+# Folds `page_count` pages through the real page iterator with the controller held at
+# `max_limit` pages in flight. Returns the activity and the peak memory above what it keeps.
+def _fold_pages(monkeypatch, page_count: int, max_limit: int, now: float):
+    monkeypatch.setattr(contr, 'get_commits', _stub_get_commits(page_count, now))
+    contributors = object.__new__(Contributors)
+    contributors.pat = 'token'
+    contributors.token_pool = None
+    # Starting at the maximum, every batch holds the most pages the controller allows
+    contributors.concurrency = AimdConcurrencyController(initial_limit=max_limit, max_limit=max_limit)
+    activity = {}
+    state = {'last_commit_date': None, 'last_commit_sha': None}
+    tracemalloc.start()
+    folded_page_count = asyncio.run(Contributors._fold_commit_pages_into_activity(
+        activity, state, contributors._iter_commit_pages('org/repo')))
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert folded_page_count == page_count
+    return activity, peak - current
+
+
+def test_streaming_fold_peak_is_bounded_by_pages_in_flight(monkeypatch):
+    now = time.time()
+    max_limit = 20
+    ceiling_pages = CEILING_FACTOR * max_limit
+    # Holding every page would take ten times the ceiling
+    page_count = 10 * ceiling_pages
+
+    (activity, peak_bytes) = _fold_pages(monkeypatch, page_count, max_limit, now)
+
+    assert peak_bytes <= ceiling_pages * _get_page_bytes(now)
+    expected = {}
+    for page in range(1, page_count + 1):
+        Contributors._fold_commits_into_activity(expected, make_api_page(page, LOGIN_COUNT, YEARS, now))
+    assert activity == expected
+
+
+def test_streaming_fold_peak_does_not_grow_with_page_count(monkeypatch):
+    now = time.time()
+    max_limit = 10
+
+    (_, short_peak_bytes) = _fold_pages(monkeypatch, 5 * max_limit, max_limit, now)
+    (_, long_peak_bytes) = _fold_pages(monkeypatch, 40 * max_limit, max_limit, now)
+
+    # Eight times the pages, about the same peak: one batch in flight either way
+    assert long_peak_bytes <= 1.25 * short_peak_bytes
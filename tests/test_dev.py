@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from dev import DevOracle
+from hll import HyperLogLog
+
+
+def test_all_sketch_counts_commit_authors_beyond_the_top_contributors():
+    # The statistics endpoint lists the top 100 contributors, the commits have 300 authors
+    contributors = ['dev%d' % index for index in range(100)]
+    monthly_sketches = {
+        '2024-01': HyperLogLog().update('dev%d' % index for index in range(0, 200)),
+        '2024-02': HyperLogLog().update('dev%d' % index for index in range(150, 300))
+    }
+
+    sketches = DevOracle._encode_contributor_sketches(contributors, monthly_sketches)
+
+    assert set(sketches) == {'all', '2024-01', '2024-02'}
+    assert abs(HyperLogLog.from_string(sketches['all']).count() - 300) <= 15
+    assert HyperLogLog.from_string(sketches['2024-02']).count() < 200
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import pickle
+
+import pytest
+
+from dev_async import AsyncDevOracle
+from github_http import CachedResponse, GITHUB_API_URL
+from org_inventory import OrgInventory
+
+LISTED_REPO = {'name': 'repo', 'full_name': 'org/repo', 'fork': False, 'stargazers_count': 1, 'forks_count': 0}
+
+
+def test_oracle_pickles_after_fetching_chain_data(monkeypatch, tmp_path, token_pool):
+    async def get_stats(self, session, url):
+        return []
+
+    # Leaves a statistics task and a background revalidation behind, like a real run
+    async def get_repo_data_for_org(self, session, org_name, year_count=1):
+        await self._get_stats_task(session, org_name + '/repo', 'code_frequency')
+        self.revalidations[org_name + '/repo'] = asyncio.ensure_future(asyncio.sleep(0))
+        return []
+
+    pickled_oracles = []
+    monkeypatch.setattr(AsyncDevOracle, '_read_orgs_for_chain_from_toml',
+                        lambda self, chain_name: ['https://github.com/org'])
+    monkeypatch.setattr(AsyncDevOracle, '_get_stats', get_stats)
+    monkeypatch.setattr(AsyncDevOracle, '_get_repo_data_for_org_async', get_repo_data_for_org)
+    # DevOracle's joblib stages pickle the oracle here
+    monkeypatch.setattr(AsyncDevOracle, '_save_chain_stats',
+                        lambda self, chain_name, orgs, org_repo_data_lists: pickled_oracles.append(pickle.dumps(self)))
+    oracle = AsyncDevOracle(str(tmp_path), 4, token_pool=token_pool)
+
+    oracle.get_and_save_full_stats('chain', 1)
+
+    copy = pickle.loads(pickled_oracles[0])
+    assert (copy.stats_tasks, copy.revalidations, copy.semaphore) == ({}, {}, None)
+
+
+def test_oracle_pickles_with_tasks_in_flight(tmp_path, token_pool):
+    oracle = AsyncDevOracle(str(tmp_path), 4, token_pool=token_pool)
+
+    async def pickle_while_running():
+        oracle.semaphore = asyncio.Semaphore(oracle.concurrency)
+        oracle.stats_tasks[('org/repo', 'contributors')] = asyncio.ensure_future(asyncio.sleep(0))
+        pickled = pickle.dumps(oracle)
+        await oracle.stats_tasks[('org/repo', 'contributors')]
+        return pickled
+
+    copy = pickle.loads(asyncio.run(pickle_while_running()))
+    assert copy.stats_tasks == {}
+    assert copy.token_pool.pats == ['token-1', 'token-2']
+
+
+@pytest.fixture
+def listing_oracle(monkeypatch, tmp_path, token_pool):
+    oracle = AsyncDevOracle(str(tmp_path), 4, token_pool=token_pool)
+    oracle.org_inventory = OrgInventory(token_pool, cache_dir=str(tmp_path / 'org_inventory'))
+    return oracle
+
+
+# Answers the orgs and users listings with the given statuses
+def _stub_listings(monkeypatch, orgs_status: int, users_status: int):
+    async def get(self, session, url):
+        status = orgs_status if url.startswith(GITHUB_API_URL + '/orgs/') else users_status
+        return CachedResponse(status, {}, json.dumps([LISTED_REPO] if status == 200 else {}).encode('utf-8'))
+    monkeypatch.setattr(AsyncDevOracle, '_get', get)
+
+
+@pytest.mark.parametrize('orgs_status, users_status', [(500, 200), (403, 200), (404, 502)])
+def test_failed_org_listing_raises_and_is_not_cached(monkeypatch, listing_oracle, orgs_status, users_status):
+    _stub_listings(monkeypatch, orgs_status, users_status)
+    with pytest.raises(Exception, match='Error'):
+        asyncio.run(listing_oracle._get_org_repo_listing(None, 'org'))
+    assert listing_oracle.org_inventory.get_cached('org') is None
+
+
+@pytest.mark.parametrize('orgs_status, users_status, listed', [(404, 404, 0), (404, 200, 1), (200, 404, 1)])
+def test_org_listing_is_cached(monkeypatch, listing_oracle, orgs_status, users_status, listed):
+    _stub_listings(monkeypatch, orgs_status, users_status)
+    repos = asyncio.run(listing_oracle._get_org_repo_listing(None, 'org'))
+    assert len(repos) == listed
+    assert listing_oracle.org_inventory.get_cached('org') == repos
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+
+import pytest
+import requests
+
+import get_contributors
+from get_contributors import RepoStats
+from github_http import CachedResponse
+from sync_state import SyncStateStore
+
+REPO = 'org/repo'
+PAGE_COUNT = 20
+
+
+def _make_commit(page: int, index: int):
+    date = '2024-01-%02dT00:00:00Z' % (1 + index % 28)
+    user = {'name': 'dev', 'email': 'dev@example.com', 'date': date}
+    return {'sha': '%d-%d' % (page, index), 'author': {'id': 1, 'login': 'dev'}, 'committer': None,
+            'commit': {'author': user, 'committer': user}}
+
+
+def _response(status_code: int, body, headers: dict = None):
+    return CachedResponse(status_code, headers or {}, json.dumps(body).encode('utf-8'))
+
+
+def _get_page_number(url: str):
+    return int(url.split('page=')[1].split('&')[0])
+
+
+@pytest.fixture
+def repo_stats(tmp_path, token_pool):
+    stats = object.__new__(RepoStats)
+    stats.token_pool = token_pool
+    stats.sync_state = SyncStateStore(str(tmp_path))
+    stats.session = requests.Session()
+    return stats
+
+
+def test_rate_limited_tokens_are_leased_per_request(monkeypatch, repo_stats):
+    requests_by_pat = {}
+    lock = threading.Lock()
+
+    # token-1 runs out on its second request, page 3 hits a secondary limit once
+    def github_get(url, pat, session=None):
+        page = _get_page_number(url)
+        with lock:
+            requests_by_pat[pat] = requests_by_pat.get(pat, 0) + 1
+            if pat == 'token-1' and requests_by_pat[pat] == 2:
+                return _response(403, {}, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '9999999999'})
+            if page == 3 and not requests_by_pat.get('secondary'):
+                requests_by_pat['secondary'] = 1
+                return _response(403, {}, {'Retry-After': '0'})
+        headers = {'link': '<https://api.github.com/x?page=%d>; rel="last"' % PAGE_COUNT} if page == 1 else {}
+        return _response(200, [_make_commit(page, index) for index in range(3)], headers)
+
+    monkeypatch.setattr(get_contributors, 'github_get', github_get)
+
+    (commits, users) = repo_stats._get_commits('chain', REPO)
+
+    assert len(commits) == 3 * PAGE_COUNT
+    assert 1 in users
+    # Every lease was handed back, token-1 is left alone until its reset
+    assert all(token.leases == 0 for token in repo_stats.token_pool._tokens.values())
+    assert repo_stats.token_pool._tokens['token-1'].remaining == 0
+
+
+def test_failed_page_cancels_the_queued_pages(monkeypatch, repo_stats):
+    requested_pages = []
+
+    def github_get(url, pat, session=None):
+        page = _get_page_number(url)
+        requested_pages.append(page)
+        if page == 2:
+            return _response(500, {})
+        headers = {'link': '<https://api.github.com/x?page=1000>; rel="last"'} if page == 1 else {}
+        return _response(200, [_make_commit(page, 0)], headers)
+
+    monkeypatch.setattr(get_contributors, 'github_get', github_get)
+
+    with pytest.raises(Exception, match='Error 500'):
+        repo_stats._get_commits('chain', REPO)
+    assert len(requested_pages) < 1000
+    assert repo_stats.sync_state.load(REPO, 'commits')['last_commit_date'] is None
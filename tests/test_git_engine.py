@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import time
+
+import pytest
+
+from dev import DevOracle
+from git_engine import GitCloneEngine, get_code_frequency_week
+
+REPO = 'org/repo'
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def _git(repo_path, *args, epoch: int = None, author: str = None):
+    env = dict(os.environ)
+    if author:
+        env.update({'GIT_AUTHOR_NAME': author.capitalize(), 'GIT_AUTHOR_EMAIL': author + '@example.com',
+                    'GIT_COMMITTER_NAME': author.capitalize(), 'GIT_COMMITTER_EMAIL': author + '@example.com'})
+    if epoch:
+        env.update({'GIT_AUTHOR_DATE': '@%d +0000' % epoch, 'GIT_COMMITTER_DATE': '@%d +0000' % epoch})
+    subprocess.run(['git', '-C', str(repo_path)] + list(args), check=True, env=env,
+                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def _commit(repo_path, author: str, epoch: int, files: dict):
+    for (name, lines) in files.items():
+        file_path = repo_path / name
+        if lines is None:
+            file_path.unlink()
+        else:
+            file_path.write_text(''.join(line + '\n' for line in lines))
+    _git(repo_path, 'add', '-A')
+    _git(repo_path, 'commit', '-q', '-m', 'Change by ' + author, epoch=epoch, author=author)
+
+
+@pytest.fixture
+def origin(tmp_path):
+    repo_path = tmp_path / 'origin' / REPO
+    repo_path.mkdir(parents=True)
+    _git(repo_path, 'init', '-q')
+    now = int(time.time())
+    # author, epoch, additions, deletions. Half days keep the commits off the week window edges.
+    commits = [
+        ('alice', now - int(400 * SECONDS_PER_DAY), 3, 0),
+        ('bob', now - int(17.5 * SECONDS_PER_DAY), 5, 0),
+        ('alice', now - int(10.5 * SECONDS_PER_DAY), 1, 1),
+        ('carol', now - int(3.5 * SECONDS_PER_DAY), 0, 5)
+    ]
+    _commit(repo_path, 'alice', commits[0][1], {'a.txt': ['one', 'two', 'three']})
+    _commit(repo_path, 'bob', commits[1][1], {'b.txt': ['1', '2', '3', '4', '5']})
+    _commit(repo_path, 'alice', commits[2][1], {'a.txt': ['one', 'TWO', 'three']})
+    _commit(repo_path, 'carol', commits[3][1], {'b.txt': None})
+    _git(repo_path, 'tag', 'v1.0')
+    return repo_path, commits
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return GitCloneEngine(str(tmp_path / 'cache'), 'file://' + str(tmp_path / 'origin') + '/{repo}')
+
+
+def test_get_repo_stats_counts_weekly_commits_churn_and_authors(origin, engine):
+    (_, commits) = origin
+    oracle = object.__new__(DevOracle)
+    oracle.git_engine = engine
+    repo_data = oracle._get_single_repo_data_from_git(REPO, 1)
+
+    # Same shape as the repo_data of the API crawl
+    assert set(repo_data) == {'name', 'repo', 'weekly_add_del', 'weekly_commits', 'contributors',
+                              'contributor_sketches', 'releases'}
+    assert repo_data['name'] == REPO
+    assert repo_data['repo'] == {'stargazers_count': 0, 'forks_count': 0}
+    assert all(set(week) == {'start_date', 'additions', 'deletions'} for week in repo_data['weekly_add_del'])
+    assert all(set(week) == {'start_date', 'end_date', 'commits'} for week in repo_data['weekly_commits'])
+    assert 'all' in repo_data['contributor_sketches']
+    assert repo_data['releases'] == 1
+
+    # Weeks are oldest first, the commit of 400 days ago is outside the year
+    assert [week['commits'] for week in repo_data['weekly_commits'][-3:]] == [1, 1, 1]
+    assert sum(week['commits'] for week in repo_data['weekly_commits']) == 3
+    assert repo_data['contributors'] == ['alice@example.com', 'bob@example.com', 'carol@example.com']
+
+    # Code frequency covers every week since the first commit
+    repo_stats = engine.get_repo_stats(REPO, DevOracle._get_week_windows(1)[::-1])
+    code_frequency = {week: [additions, -deletions] for (week, additions, deletions) in repo_stats['code_frequency']}
+    expected = {}
+    for (_, epoch, additions, deletions) in commits:
+        week = expected.setdefault(get_code_frequency_week(epoch), [0, 0])
+        week[0] += additions
+        week[1] += deletions
+    assert {week: churn for (week, churn) in code_frequency.items() if churn != [0, 0]} == expected
+    assert len(repo_data['weekly_add_del']) == len(code_frequency)
+    assert sorted(code_frequency) == list(range(min(expected), max(expected) + 1, 7 * SECONDS_PER_DAY))
+
+
+def test_get_activity_fetches_new_commits_since(origin, engine):
+    (repo_path, commits) = origin
+    activity = engine.get_activity(REPO)
+    assert set(activity) == {'alice@example.com', 'bob@example.com', 'carol@example.com'}
+    assert sorted(epochs[0] for days in activity.values() for epochs in days.values()) == \
+        sorted(epoch for (_, epoch, _, _) in commits)
+
+    # The clone is fetched again, commits older than `since_epoch` are left out
+    new_epoch = int(time.time()) - SECONDS_PER_DAY
+    _commit(repo_path, 'dave', new_epoch, {'c.txt': ['new']})
+    activity = engine.get_activity(REPO, since_epoch=int(time.time()) - 7 * SECONDS_PER_DAY)
+    day = time.strftime('%Y-%m-%d', time.gmtime(new_epoch))
+    assert activity == {
+        'carol@example.com': {time.strftime('%Y-%m-%d', time.gmtime(commits[3][1])): [commits[3][1]] * 2},
+        'dave@example.com': {day: [new_epoch, new_epoch]}
+    }
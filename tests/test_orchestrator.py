@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from orchestrator import Orchestrator
+
+
+# Stand-in for get_contributors.RepoStats, the 'commits' task of a chain
+class FakeRepoStats:
+    def __init__(self, repos_by_chain: dict):
+        self.repos_by_chain = repos_by_chain
+        self.fetches = []
+        self.saved = {}
+
+    def _read_repos_for_chain_from_toml(self, chain: str):
+        return self.repos_by_chain[chain]
+
+    def _get_commits(self, chain: str, org_and_repo: str):
+        self.fetches.append(org_and_repo)
+        return [{'repo': org_and_repo}], {}
+
+    def _save_commits(self, chain: str, repos: list, repo_commits_and_users: list):
+        self.saved[chain] = dict(zip(repos, repo_commits_and_users))
+
+
+def test_shared_repo_results_are_released_once_consumed(monkeypatch):
+    repo_stats = FakeRepoStats({'a': ['org/x', 'org/shared'], 'b': ['org/Shared', 'org/y']})
+    monkeypatch.setattr(Orchestrator, '_get_repo_stats', lambda self: repo_stats)
+    orchestrator = Orchestrator('./output', ['commits'], concurrency=1, token_pool=object())
+
+    assert orchestrator.run(['a', 'b']) == []
+
+    assert sorted(repo_stats.fetches) == ['org/shared', 'org/x', 'org/y']
+    assert orchestrator.shared_repo_count == 1
+    assert repo_stats.saved['b']['org/Shared'] == ([{'repo': 'org/shared'}], {})
+    assert list(repo_stats.saved['a']) == ['org/x', 'org/shared']
+    # Nothing is held once every chain is saved
+    assert orchestrator.repo_results == {}
+    assert orchestrator.repo_result_users == {}
+    assert all(job.results == {} for job in orchestrator.jobs.values())
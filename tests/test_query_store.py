@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+from api_pages import make_api_page
+from commit_store import CommitStore, compact_commit
+from query_store import DevQueryStore
+
+
+def _write_outputs(output_dir: str):
+    users = {}
+    commits = [compact_commit(commit, users) for commit in make_api_page(1, 10, 1, time.time())]
+    CommitStore(output_dir).write_chain('chain', {'org/repo': commits}, users)
+    with open(os.path.join(output_dir, 'chain_stats.json'), 'w') as stats_json:
+        json.dump({'stars': 3, 'contributors': 10}, stats_json)
+
+
+def _count_rows(store: DevQueryStore, table: str):
+    return store.connection.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+
+
+def test_sources_are_not_ingested_again_through_another_path(monkeypatch, tmp_path):
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    _write_outputs(str(output_dir))
+
+    store = DevQueryStore(os.path.relpath(str(output_dir)))
+    store.build()
+    activity_rows = _count_rows(store, 'author_activity')
+    source_count = _count_rows(store, 'sources')
+    store.close()
+    assert activity_rows > 0
+
+    ingested = []
+    for method in ('_ingest_stats', '_ingest_commits'):
+        monkeypatch.setattr(DevQueryStore, method, lambda self, chain, source_path, *args: ingested.append(source_path))
+    store = DevQueryStore(str(output_dir))
+    store.build()
+    assert ingested == []
+    assert _count_rows(store, 'author_activity') == activity_rows
+    assert _count_rows(store, 'sources') == source_count
+    assert store.stats('chain')['stars'] == 3
+    store.close()
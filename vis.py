@@ -1,16 +1,61 @@
+import matplotlib
+# Figures are only saved to files, also from worker processes
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
 import seaborn as sns
+import numpy as np
 import pandas as pd
-import json
 import sys
+import hashlib
+import json
+import optparse
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from os import path
-import shutil
-import glob
 from config import get_chain_names, get_chain_targets
+from query_store import DevQueryStore
 
 dir_path = path.dirname(path.realpath(__file__))
 
+RESULTS_DIR = './res'
+# Cache key of each figure in RESULTS_DIR, figures whose data didn't change are not drawn again
+RENDER_CACHE_FILE = '.render_cache.json'
+# Bump when the drawing code changes, so cached figures are drawn again
+RENDER_VERSION = 1
+
+# `kind`: 'line' or 'bar', `options`: seaborn arguments, `yscale`: e.g. 'log'
+Figure = namedtuple('Figure', ['file_name', 'kind', 'data', 'options', 'yscale'])
+
+
+def set_figure_style():
+    sns.set(style="darkgrid")
+    sns.set(rc={'figure.figsize': (24, 14)})
+
+
+def get_figure_cache_key(figure: Figure) -> str:
+    key = hashlib.sha256()
+    key.update(json.dumps([RENDER_VERSION, figure.kind, figure.options, figure.yscale], sort_keys=True).encode('utf-8'))
+    key.update(figure.data.to_csv().encode('utf-8'))
+    return key.hexdigest()
+
+
+# Draws and saves one figure, on its own matplotlib figure so figures can be drawn by several processes
+def render_figure(figure: Figure, output_path: str):
+    set_figure_style()
+    fig, ax = plt.subplots()
+    if figure.kind == 'line':
+        sns.lineplot(data=figure.data, ax=ax, **figure.options)
+    else:
+        sns.barplot(data=figure.data, ax=ax, **figure.options)
+    if figure.yscale:
+        ax.set_yscale(figure.yscale)
+    fig.savefig(output_path)
+    plt.close(fig)
+    return output_path
+
 
 class Visualize:
 
@@ -26,20 +71,18 @@ class Visualize:
             date_index = date_index.drop(date_index[-1])
         self.commits = pd.DataFrame({'Date': date_index})
         self.churn = pd.DataFrame({'Date': date_index})
+        self.store = DevQueryStore(path.join(dir_path, 'output'))
+        self.store.build()
         for chain in self.chains:
-            output_path = path.join(
-                dir_path, 'output', chain + '_history.json')
             try:
-                with open(output_path) as json_file:
-                    data = json.load(json_file)
-                self.commits[chain] = data['weekly_commits']
-                self.churn[chain] = data['weekly_churn'][-52:]
+                self.commits[chain] = self.store.weekly_series(chain, 'commits')
+                self.churn[chain] = self.store.weekly_series(chain, 'churn')[-52:]
             except:
                 print('Not found history output for ' + chain +
                       ', please remove from config and rerun')
-        sns.set(style="darkgrid")
-        sns.set(rc={'figure.figsize': (24, 14)})
+        set_figure_style()
 
+    # Means, percentage changes and moving averages of all chains at once, one column per chain
     def prep_code(self, commits_or_churn: str = 'commits'):
         if commits_or_churn == 'commits':
             commits_or_churn_df = self.commits
@@ -48,112 +91,122 @@ class Visualize:
         else:
             print('Usage: plot_code must be called on commits or churn.')
             sys.exit(1)
-        percentage_changes = pd.DataFrame({'Protocol': self.target_names})
-        change_list = []
-        for index, chain in enumerate(self.chains):
-            if commits_or_churn_df[chain].mean() < 10:
-                # Negligible commits or churn, dead protocol
-                print(commits_or_churn.capitalize(
-                ) + ': ' + self.target_names[index] + ' averaged fewer than 10 changes per week and can be considered a dead protocol.')
-                percentage_changes = percentage_changes[percentage_changes.Protocol !=
-                                                        self.target_names[index]]
-                continue
-            try:
-                # Average of first and last 8 weeks
-                percentage_change = round(
-                    ((sum(commits_or_churn_df[chain][-9:-1]) / sum(commits_or_churn_df[chain][0:8])) * 100) - 100)
-            except:
-                # None at the start of the year
-                percentage_change = 0
-            change_list.append(percentage_change)
+        weekly = commits_or_churn_df[self.chains]
+        target_names = pd.Series(self.target_names, index=self.chains)
+        means = weekly.mean()
+        # Negligible commits or churn, dead protocol
+        for chain in means.index[means < 10]:
+            print(commits_or_churn.capitalize() + ': ' + target_names[chain] +
+                  ' averaged fewer than 10 changes per week and can be considered a dead protocol.')
+        live_chains = means.index[~(means < 10)]
+        # Average of first and last 8 weeks, 0 when undefined (none at the start of the year)
+        percentage_change = (weekly.iloc[-9:-1].sum(skipna=False) / weekly.iloc[0:8].sum(skipna=False)) * 100 - 100
+        percentage_change = percentage_change.replace([np.inf, -np.inf], np.nan).fillna(0).round().astype(int)
+        if len(live_chains):
             # Compute a 4-period MA to smooth data
-            commits_or_churn_df[chain] = commits_or_churn_df[chain].rolling(
-                4).mean()
+            commits_or_churn_df[live_chains] = weekly[live_chains].rolling(4).mean()
         commits_or_churn_df.columns = ['Date'] + self.target_names
-        percentage_changes['Percentage change in ' +
-                           commits_or_churn] = change_list
-        percentage_changes = percentage_changes.sort_values(
-            'Percentage change in ' + commits_or_churn)
+        percentage_changes = pd.DataFrame({
+            'Protocol': target_names[live_chains].values,
+            'Percentage change in ' + commits_or_churn: percentage_change[live_chains].values
+        }).sort_values('Percentage change in ' + commits_or_churn)
         code = commits_or_churn_df.melt(
             'Date', var_name='Protocol',  value_name=commits_or_churn)
         return code, percentage_changes
 
     def prep_devs(self):
-        protocols_comparison = pd.DataFrame({'Month': self.xaxis})
-        percentage_changes = pd.DataFrame({'Protocol': self.chains})
-        change_list = []
-        for chain in self.chains:
-            monthly_active_dev_count = []
-            output_path = path.join(
-                dir_path, 'output', chain + '_contributors.json')
-            with open(output_path) as json_file:
-                data = json.load(json_file)
-            for month in data:
-                monthly_active_dev_count.append(len(month))
-            protocols_comparison[chain] = monthly_active_dev_count
-            try:
-                percentage_change = round((((monthly_active_dev_count[-2] + monthly_active_dev_count[-1]) / (
-                    monthly_active_dev_count[0] + monthly_active_dev_count[1])) * 100) - 100)
-            except:
-                percentage_change = 0
-            change_list.append(percentage_change)
+        monthly_active_devs = pd.DataFrame({chain: self.store.monthly_active_devs(chain) for chain in self.chains})
+        protocols_comparison = pd.concat([pd.DataFrame({'Month': self.xaxis}), monthly_active_devs], axis=1)
+        if len(monthly_active_devs) >= 2:
+            percentage_change = (((monthly_active_devs.iloc[-2] + monthly_active_devs.iloc[-1]) /
+                                  (monthly_active_devs.iloc[0] + monthly_active_devs.iloc[1])) * 100) - 100
+            percentage_change = percentage_change.replace([np.inf, -np.inf], np.nan).fillna(0).round().astype(int)
+        else:
+            percentage_change = pd.Series(0, index=self.chains)
         protocols_comparison.columns = ['Month'] + self.target_names
-        percentage_changes['Protocol'] = self.target_names
-        percentage_changes['Percentage change in active devs'] = change_list
-        percentage_changes = percentage_changes.sort_values(
-            'Percentage change in active devs')
+        percentage_changes = pd.DataFrame({
+            'Protocol': self.target_names,
+            'Percentage change in active devs': percentage_change[self.chains].values
+        }).sort_values('Percentage change in active devs')
         protocols_comparison = protocols_comparison.melt(
             'Month', var_name='Protocol', value_name='Monthly Active Devs')
         return protocols_comparison, percentage_changes
 
-    # Each of the below is separate as seaborn requires plots to have different figure variable names and clearing memory completely is not possible.
+    # The plot_ methods write the CSV of the figures and return the figures to draw
 
     def plot_commits(self, code: pd.DataFrame, percentage_changes: pd.DataFrame):
-        code.to_csv('commits.csv')
-        fig1 = sns.lineplot(x="Date", y='commits', hue='Protocol', data=code)
-        fig1.get_figure().savefig('commits.png')
-        fig1.clear()
-        fig2 = sns.barplot(y="Protocol", x="Percentage change in commits",
-                           data=percentage_changes, palette="RdYlGn")
-        fig2.get_figure().savefig('commits_change.png')
-        fig2.clear()
+        code.to_csv(path.join(RESULTS_DIR, 'commits.csv'))
+        return [
+            Figure('commits.png', 'line', code, {'x': "Date", 'y': 'commits', 'hue': 'Protocol'}, None),
+            Figure('commits_change.png', 'bar', percentage_changes,
+                   {'y': "Protocol", 'x': "Percentage change in commits", 'palette': "RdYlGn"}, None)
+        ]
 
     def plot_churn(self, code: pd.DataFrame, percentage_changes: pd.DataFrame):
-        code.to_csv('churn.csv')
-        fig3 = sns.lineplot(x="Date", y='churn', hue='Protocol', data=code)
-        fig3.set_yscale("log")
-        fig3.get_figure().savefig('churn.png')
-        fig3.clear()
-        fig4 = sns.barplot(y="Protocol", x="Percentage change in churn",
-                           data=percentage_changes, palette="RdYlGn")
-        fig4.get_figure().savefig('churn_change.png')
-        fig4.clear()
+        code.to_csv(path.join(RESULTS_DIR, 'churn.csv'))
+        return [
+            Figure('churn.png', 'line', code, {'x': "Date", 'y': 'churn', 'hue': 'Protocol'}, 'log'),
+            Figure('churn_change.png', 'bar', percentage_changes,
+                   {'y': "Protocol", 'x': "Percentage change in churn", 'palette': "RdYlGn"}, None)
+        ]
 
     def plot_devs(self, protocols_comparison: pd.DataFrame, percentage_changes: pd.DataFrame):
-        protocols_comparison.to_csv('devs.csv')
-        # Disable Seaborn sorting or months appear out of order
-        fig5 = sns.lineplot(x="Month", y="Monthly Active Devs", hue='Protocol',
-                            data=protocols_comparison, sort=False, palette="Dark2_r")
-        fig5.get_figure().savefig('devs.png')
-        fig5.clear()
-        fig6 = sns.barplot(y="Protocol", x="Percentage change in active devs",
-                           data=percentage_changes, palette="RdYlGn")
-        fig6.get_figure().savefig('devs_change.png')
-        fig6.clear()
-
-    def run(self):
+        protocols_comparison.to_csv(path.join(RESULTS_DIR, 'devs.csv'))
+        return [
+            # Disable Seaborn sorting or months appear out of order
+            Figure('devs.png', 'line', protocols_comparison,
+                   {'x': "Month", 'y': "Monthly Active Devs", 'hue': 'Protocol', 'sort': False, 'palette': "Dark2_r"},
+                   None),
+            Figure('devs_change.png', 'bar', percentage_changes,
+                   {'y': "Protocol", 'x': "Percentage change in active devs", 'palette': "RdYlGn"}, None)
+        ]
+
+    # Draws the figures whose data changed since they were last drawn, on `workers` processes
+    def render(self, figures, workers: int = None, force: bool = False):
+        cache_path = path.join(RESULTS_DIR, RENDER_CACHE_FILE)
+        try:
+            with open(cache_path, 'r') as cache_file:
+                render_cache = json.load(cache_file)
+        except (OSError, ValueError):
+            render_cache = {}
+        cache_keys = {figure.file_name: get_figure_cache_key(figure) for figure in figures}
+        stale_figures = [figure for figure in figures
+                         if force or render_cache.get(figure.file_name) != cache_keys[figure.file_name]
+                         or not path.exists(path.join(RESULTS_DIR, figure.file_name))]
+        stale_file_names = {figure.file_name for figure in stale_figures}
+        for figure in figures:
+            if figure.file_name not in stale_file_names:
+                print('Unchanged, not drawn again: ' + figure.file_name)
+        if stale_figures:
+            output_paths = [path.join(RESULTS_DIR, figure.file_name) for figure in stale_figures]
+            workers = min(workers or os.cpu_count() or 1, len(stale_figures))
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(render_figure, stale_figures, output_paths))
+            else:
+                list(map(render_figure, stale_figures, output_paths))
+            for figure in stale_figures:
+                render_cache[figure.file_name] = cache_keys[figure.file_name]
+            with open(cache_path, 'w') as cache_file:
+                json.dump(render_cache, cache_file)
+
+    def run(self, workers: int = None, force: bool = False):
+        os.makedirs(RESULTS_DIR, exist_ok=True)
         code, percentage_changes = self.prep_code('commits')
-        self.plot_commits(code, percentage_changes)
+        figures = self.plot_commits(code, percentage_changes)
         code, percentage_changes = self.prep_code('churn')
-        self.plot_churn(code, percentage_changes)
+        figures += self.plot_churn(code, percentage_changes)
         protocols_comparison, percentage_changes = self.prep_devs()
-        self.plot_devs(protocols_comparison, percentage_changes)
-        for file in glob.glob('./*.png'):
-            shutil.move(file, './res')
-        for file in glob.glob('./*.csv'):
-            shutil.move(file, './res')
+        figures += self.plot_devs(protocols_comparison, percentage_changes)
+        self.render(figures, workers, force)
 
 
 if __name__ == '__main__':
+    p = optparse.OptionParser()
+    p.add_option('--workers', type='int', dest='workers',
+                 help='Processes drawing the figures, default one per CPU')
+    p.add_option('--force', action='store_true', dest='force', default=False,
+                 help='Draw every figure, also those whose data did not change')
+    options, arguments = p.parse_args()
     v = Visualize()
-    v.run()
+    v.run(options.workers, options.force)